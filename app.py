@@ -1,12 +1,28 @@
-﻿import math
+﻿import io
+import array
+import math
 import random
 import json
 import base64
+import csv
+import bisect
+import gzip
+import hashlib
+import heapq
+import multiprocessing
+import queue
 import secrets
 import threading
+import time
 import unicodedata
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from collections.abc import MutableMapping
+from contextlib import ExitStack, contextmanager
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from urllib import error as urllib_error
 from urllib import parse as urllib_parse
 from urllib import request as urllib_request
@@ -15,13 +31,32 @@ import os
 from pathlib import Path
 import qrcode
 from qrcode.image.pure import PyPNGImage
-from flask import Flask, jsonify, render_template, request, redirect, session, url_for
+from markupsafe import escape
+from flask import (
+    Flask,
+    Response,
+    g,
+    has_request_context,
+    jsonify,
+    render_template,
+    request,
+    redirect,
+    session,
+    stream_with_context,
+    url_for,
+)
 
 try:
     import psycopg2
+    import psycopg2.extras
 except Exception:
     psycopg2 = None
 
+try:
+    import numpy as np
+except Exception:
+    np = None
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "change-this-secret-in-production")
 app.config["SESSION_COOKIE_HTTPONLY"] = True
@@ -49,9 +84,27 @@ auth_session_store: Dict[str, Dict] = {}
 auth_session_lock = threading.Lock()
 external_state_cache = {"state": None, "ts": None}
 external_state_lock = threading.Lock()
-
-
-WAREHOUSE = {"lat": 36.834, "lon": -2.4637, "name": "Almacen Almeria"}
+sim_clock = {"now": None}
+sim_clock_lock = threading.Lock()
+# Motor de alertas: banda de histeresis en fraccion de capacidad y cola de transiciones para clientes
+ALERT_HYSTERESIS_PCT = float(os.environ.get("ALERT_HYSTERESIS_PCT", "0.02"))
+ALERT_EVENTS_MAX = 1000
+ALERT_RANK = {"ok": 0, "warn": 1, "alert": 2, "critical": 3}
+alert_engine = {"tanks": {}, "active": {}, "events": deque(maxlen=ALERT_EVENTS_MAX), "seq": 0}
+alert_engine_lock = threading.Lock()
+SENSOR_SIM_SEED = os.environ.get("SENSOR_SIM_SEED")
+sensor_sim = {"signature": None, "tanks": [], "cols": {}, "rng": None, "dirty": False}
+sensor_sim_lock = threading.Lock()
+
+
+WAREHOUSE = {"id": os.environ.get("WAREHOUSE_ID", "almeria"), "lat": 36.834, "lon": -2.4637, "name": "Almacen Almeria"}
+if os.environ.get("WAREHOUSE_STOCK_L"):
+    WAREHOUSE["stock_l"] = float(os.environ["WAREHOUSE_STOCK_L"])
+DEFAULT_HOURLY_USE_RATIO = 0.018
+# Estimacion del consumo real a partir del historico de lecturas de Savian
+CONSUMPTION_WINDOW_H = float(os.environ.get("CONSUMPTION_WINDOW_H", "24"))
+CONSUMPTION_MIN_SPAN_H = 1.0
+CONSUMPTION_MIN_READINGS = 3
 
 TEST_TRUCKS = [
     {
@@ -71,6 +124,23 @@ TEST_TRUCKS = [
     },
 ]
 
+# El almacen principal es WAREHOUSE; el resto llega de DEPOTS_JSON con sus camiones y stock:
+# [{"id": "vicar", "name": "Almacen Vicar", "lat": 36.83, "lon": -2.64, "stock_l": 60000,
+#   "trucks": [{"id": "TR-11", "driver": "Ana", "capacity_l": 12000}]}]
+DEPOTS: List[Dict] = [WAREHOUSE]
+for _depot_cfg in json.loads(os.environ.get("DEPOTS_JSON") or "[]"):
+    _depot = {
+        "id": str(_depot_cfg["id"]),
+        "name": _depot_cfg.get("name") or f"Almacen {_depot_cfg['id']}",
+        "lat": float(_depot_cfg["lat"]),
+        "lon": float(_depot_cfg["lon"]),
+    }
+    if _depot_cfg.get("stock_l") is not None:
+        _depot["stock_l"] = float(_depot_cfg["stock_l"])
+    DEPOTS.append(_depot)
+    for _truck_cfg in _depot_cfg.get("trucks", []):
+        TEST_TRUCKS.append({**_truck_cfg, "depot_id": _depot["id"]})
+
 WORKERS = {
     "prueba1": {"password": "123", "name": "Operador 1"},
     "prueba2": {"password": "123", "name": "Operador 2"},
@@ -80,6 +150,34 @@ WORKERS = {
 ADMIN = {"username": "admin", "password": "123"}
 
 DB_URL = os.environ.get("DATABASE_URL")
+# Historico de niveles: tamano fijo por deposito (2880 lecturas = 24 h a 30 s) y volcado a DB por lotes
+LEVEL_HISTORY_SIZE = int(os.environ.get("LEVEL_HISTORY_SIZE", "2880"))
+LEVEL_HISTORY_FLUSH_S = float(os.environ.get("LEVEL_HISTORY_FLUSH_S", "300"))
+# new_rows: lecturas (centro, deposito, epoch, litros) aun no guardadas en la tabla level_readings
+level_history = {"buffers": {}, "pending": 0, "flushed_at": 0.0, "new_rows": [], "table_ready": False}
+level_history_lock = threading.Lock()
+# Agregados por centro a varias resoluciones: (segundos por cubo, cubos que se conservan)
+ROLLUP_RESOLUTIONS = {"minute": (60, 720), "hour": (3600, 1440), "day": (86400, 730)}
+ROLLUP_FIELDS = ("consumed_l", "delivered_l", "deliveries", "level_min", "level_max", "level_last")
+ROLLUP_ALL = "*"
+rollups = {"scopes": {}, "tank_last": {}, "center_level": {}, "pending": 0}
+rollup_lock = threading.Lock()
+# Informes: agregados por dia que se actualizan al cerrar cada ruta
+REPORT_STOP_FIELDS = ("stops", "delivered_l", "dwell_min", "dwell_n", "leg_min", "leg_n", "visits", "visits_ok")
+REPORT_ROUTE_FIELDS = ("routes", "routes_ok", "return_min", "return_n")
+REPORT_MAX_DAYS = 366
+report_aggregates = {"days": {}, "routes": set()}
+report_lock = threading.Lock()
+# Idempotency-Key: respuestas de las mutaciones de /api/routes y /api/admin guardadas para repetirlas en reintentos.
+# En memoria por orden de llegada (todas caducan a la vez, asi que la primera es la mas antigua) y en la tabla
+# idempotency_keys de Postgres cuando hay DB, que es la que comparten los workers
+IDEMPOTENCY_TTL_S = float(os.environ.get("IDEMPOTENCY_TTL_S", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "5000"))
+IDEMPOTENCY_PREFIXES = ("/api/routes/", "/api/admin/")
+idempotency_cache: Dict[str, Dict] = {}
+idempotency_lock = threading.Lock()
+idempotency_db = {"table_ready": False}
+route_store: Dict = {"table_ready": False, "claims": {}}
 
 
 def _strip_accents(value: str) -> str:
@@ -368,6 +466,196 @@ def _is_request_authenticated() -> bool:
     return _ensure_auth_session(refresh_if_needed=True) is not None
 
 
+_MISSING = object()
+_ATOMIC_TYPES = frozenset({str, int, float, bool, type(None), datetime})
+
+
+# Modelos compactos del estado en memoria: cada campo conocido es un slot en lugar de una entrada de dict.
+# Siguen siendo mappings (tank["current_l"], .get, .setdefault, {**route}) para el resto del codigo; las
+# claves fuera de FIELDS van a un dict aparte que solo se crea si hace falta. to_dict/from_dict son los
+# codecs de persistencia y to_api el formato JSON de la API
+class _Model(MutableMapping):
+    __slots__ = ("_extra",)
+    FIELDS: Tuple[str, ...] = ()
+    NESTED: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+
+    def __init__(self, data=None, **fields):
+        self._extra = None
+        field_set, nested = self._field_set, self.NESTED
+        for source in (data or {}, fields):
+            for key, value in source.items():
+                if key in field_set and key not in nested:
+                    setattr(self, key, value)
+                else:
+                    self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(data)
+
+    def to_dict(self) -> Dict:
+        out = {key: value for key in self.FIELDS if (value := getattr(self, key, _MISSING)) is not _MISSING}
+        for key in self.NESTED:
+            if isinstance(out.get(key), list):
+                out[key] = [_plain(item) for item in out[key]]
+        if self._extra:
+            out.update(self._extra)
+        return out
+
+    def _iso(self, key):
+        value = getattr(self, key, None)
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra else default
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            nested = self.NESTED.get(key)
+            if nested is not None and isinstance(value, list):
+                value = [nested.from_dict(item) for item in value]
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return bool(self._extra) and key in self._extra
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for key in self.FIELDS if hasattr(self, key)) + len(self._extra or ())
+
+    def copy(self):
+        return type(self)(self)
+
+    def __deepcopy__(self, memo):
+        clone = type(self).__new__(type(self))
+        memo[id(self)] = clone
+        clone._extra = deepcopy(self._extra, memo) if self._extra else None
+        for key in self.FIELDS:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                continue
+            # Los valores inmutables se comparten; deepcopy solo para listas/dicts anidados
+            setattr(clone, key, value if type(value) in _ATOMIC_TYPES else deepcopy(value, memo))
+        return clone
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Tank(_Model):
+    FIELDS = (
+        "id", "label", "product", "capacity_l", "current_l", "warn_at", "crit_at",
+        "location", "sensors", "hourly_use_l",
+    )
+    __slots__ = FIELDS
+
+
+class Truck(_Model):
+    FIELDS = (
+        "id", "depot_id", "driver", "status", "current_load_l", "capacity_l", "position",
+        "destination", "started_at", "eta_minutes", "route_id", "notes",
+    )
+    __slots__ = FIELDS
+
+
+class Stop(_Model):
+    FIELDS = ("center_id", "tank_id", "liters", "product", "status", "arrival_at", "depart_at", "delivered_l")
+    __slots__ = FIELDS
+
+    def to_api(self) -> Dict:
+        return {
+            **{k: getattr(self, k, None) for k in ["center_id", "tank_id", "liters", "product", "status"]},
+            "arrival_at": self._iso("arrival_at"),
+            "depart_at": self._iso("depart_at"),
+            "delivered_l": getattr(self, "delivered_l", None),
+        }
+
+
+class RouteEvent(_Model):
+    FIELDS = ("event", "note", "ts")
+    __slots__ = FIELDS
+
+    def to_api(self) -> Dict:
+        return {"event": getattr(self, "event", None), "note": getattr(self, "note", None), "ts": self.ts.isoformat()}
+
+
+class Route(_Model):
+    FIELDS = (
+        "id", "worker", "truck_id", "depot_id", "origin", "product_type", "stops", "status",
+        "current_stop_idx", "started_at", "finished_at", "history", "current_leg", "total_delivered",
+        "success", "auto_generated", "pending_worker", "planned_load_l", "version",
+    )
+    __slots__ = FIELDS
+    NESTED = {"stops": Stop, "history": RouteEvent}
+
+    def to_api(self) -> Dict:
+        leg = getattr(self, "current_leg", None)
+        return {
+            **{k: getattr(self, k, None) for k in ["id", "worker", "truck_id", "depot_id", "origin", "status", "success"]},
+            "started_at": self._iso("started_at"),
+            "finished_at": self._iso("finished_at"),
+            "total_delivered": getattr(self, "total_delivered", 0),
+            "product_type": getattr(self, "product_type", None),
+            "current_stop_idx": getattr(self, "current_stop_idx", 0),
+            "pending_worker": getattr(self, "pending_worker", False),
+            "auto_generated": getattr(self, "auto_generated", False),
+            "planned_load_l": getattr(self, "planned_load_l", None),
+            "version": getattr(self, "version", 0),
+            "stops": [Stop.from_dict(stop).to_api() for stop in getattr(self, "stops", [])],
+            "history": [RouteEvent.from_dict(h).to_api() for h in getattr(self, "history", [])],
+            "current_leg": {
+                **{k: leg.get(k) for k in ["eta_minutes", "label"]},
+                "started_at": leg["started_at"].isoformat(),
+                "destination": leg["destination"],
+            }
+            if leg
+            else None,
+        }
+
+
+def _plain(item):
+    return item.to_dict() if isinstance(item, _Model) else item
+
+
 def _make_tank(prefix: str, idx: int, base_lat: float, base_lon: float, product: str):
     capacity = random.choice([14000, 16000, 18000, 20000])
     current = random.randint(int(capacity * 0.38), int(capacity * 0.86))
@@ -388,7 +676,7 @@ def _make_tank(prefix: str, idx: int, base_lat: float, base_lon: float, product:
         },
         "drain_pct": random.randint(14, 30),
     }
-    return {
+    return Tank({
         "id": f"{prefix}-{idx}",
         "label": f"Deposito {idx}",
         "product": product,
@@ -398,7 +686,7 @@ def _make_tank(prefix: str, idx: int, base_lat: float, base_lon: float, product:
         "crit_at": 0.18,
         "location": {"lat": base_lat + offset, "lon": base_lon + offset, "name": prefix},
         "sensors": sensors,
-    }
+    })
 
 
 def _build_centers():
@@ -560,7 +848,7 @@ def _build_centers():
 centers = _build_centers()
 
 trucks = [
-    {
+    Truck({
         "id": "TR-01",
         "driver": "Alba",
         "status": "parked",  # parked | outbound | delivering | returning
@@ -572,8 +860,8 @@ trucks = [
         "eta_minutes": None,
         "route_id": None,
         "notes": "Disponible en almacen",
-    },
-    {
+    }),
+    Truck({
         "id": "TR-02",
         "driver": "Raul",
         "status": "parked",
@@ -585,8 +873,8 @@ trucks = [
         "eta_minutes": None,
         "route_id": None,
         "notes": "Revisado y libre",
-    },
-    {
+    }),
+    Truck({
         "id": "TR-03",
         "driver": "Sofia",
         "status": "parked",
@@ -598,12 +886,336 @@ trucks = [
         "eta_minutes": None,
         "route_id": None,
         "notes": "Listo para cargar",
-    },
+    }),
 ]
 
-active_routes: List[Dict] = []
-route_history: List[Dict] = []
-delivery_log: List[Dict] = []
+active_routes: List[Route] = []
+route_history: List[Route] = []
+store_history_cache: Dict[str, Dict[int, Tuple[Route, int, str]]] = {"routes": {}}
+
+
+# Registro de descargas por columnas: ts/litros en arrays tipados y textos internados (codigo -1 = None).
+# Indices secundarios ordenados por tiempo para centro, camion y operario; se recorre como lista de dicts
+class _DeliveryLog:
+    TEXT_FIELDS = ("truck_id", "tank_id", "center_id", "center", "by", "note")
+    INDEXED = ("center_id", "truck_id", "by")
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._ts = array.array("d")
+        self._liters = array.array("d")
+        self._codes = {field: array.array("i") for field in self.TEXT_FIELDS}
+        self._strings: List[str] = []
+        self._string_codes: Dict[str, int] = {}
+        self._extras: Dict[int, Dict] = {}
+        # (ts ordenados, filas) global y por valor de cada campo indexado
+        self._by_time = (array.array("d"), array.array("i"))
+        self._indexes: Dict[str, Dict[int, Tuple[array.array, array.array]]] = {f: {} for f in self.INDEXED}
+
+    def _intern(self, value) -> int:
+        if value is None:
+            return -1
+        text = str(value)
+        code = self._string_codes.get(text)
+        if code is None:
+            code = self._string_codes[text] = len(self._strings)
+            self._strings.append(text)
+        return code
+
+    def _epoch(self, value) -> float:
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return (value - self.EPOCH).total_seconds()
+
+    @staticmethod
+    def _insert(index: Tuple[array.array, array.array], ts: float, row: int):
+        stamps, rows = index
+        # Lo normal es llegar en orden de tiempo: append; si no, insercion por biseccion
+        if not stamps or ts >= stamps[-1]:
+            stamps.append(ts)
+            rows.append(row)
+            return
+        pos = bisect.bisect_right(stamps, ts)
+        stamps.insert(pos, ts)
+        rows.insert(pos, row)
+
+    def append(self, item: Dict):
+        # Un escritor a la vez; la fila se completa antes de entrar en los indices que recorren los lectores
+        ts = self._epoch(item.get("ts") or _now())
+        with self._lock:
+            row = len(self._ts)
+            self._ts.append(ts)
+            self._liters.append(_to_float(item.get("delivered_l"), 0.0) or 0.0)
+            for field in self.TEXT_FIELDS:
+                self._codes[field].append(self._intern(item.get(field)))
+            extras = {k: v for k, v in item.items() if k not in self.TEXT_FIELDS and k not in ("ts", "delivered_l")}
+            if extras:
+                self._extras[row] = extras
+            for field in self.INDEXED:
+                code = self._codes[field][row]
+                if code >= 0:
+                    index = self._indexes[field].setdefault(code, (array.array("d"), array.array("i")))
+                    self._insert(index, ts, row)
+            self._insert(self._by_time, ts, row)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def row(self, row: int) -> Dict:
+        liters = self._liters[row]
+        item = {
+            "ts": self.EPOCH + timedelta(seconds=self._ts[row]),
+            "delivered_l": int(liters) if liters.is_integer() else liters,
+        }
+        for field in self.TEXT_FIELDS:
+            code = self._codes[field][row]
+            item[field] = self._strings[code] if code >= 0 else None
+        item.update(self._extras.get(row, {}))
+        return item
+
+    def __len__(self):
+        return len(self._by_time[1])
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.row(row)
+
+    def __getitem__(self, idx: int) -> Dict:
+        return self.row(range(len(self))[idx])
+
+    def _index_for(self, filters: Dict[str, Optional[str]]):
+        # Se recorre el indice mas pequeno de los filtros pedidos; el resto se comprueba fila a fila
+        chosen, checks = self._by_time, []
+        for field in self.INDEXED:
+            value = filters.get(field)
+            if value is None:
+                continue
+            code = self._string_codes.get(str(value))
+            index = self._indexes[field].get(code) if code is not None else None
+            if index is None:
+                return None, []
+            checks.append((field, code))
+            if chosen is self._by_time or len(index[1]) < len(chosen[1]):
+                chosen = index
+        return chosen, checks
+
+    def iter_rows(self, since=None, until=None, newest_first: bool = False, **filters):
+        index, checks = self._index_for(filters)
+        if index is None:
+            return
+        stamps, rows = index
+        lo = bisect.bisect_left(stamps, self._epoch(since)) if since else 0
+        hi = bisect.bisect_right(stamps, self._epoch(until)) if until else len(stamps)
+        positions = range(hi - 1, lo - 1, -1) if newest_first else range(lo, hi)
+        for pos in positions:
+            row = rows[pos]
+            if all(self._codes[field][row] == code for field, code in checks):
+                yield row
+
+    def latest(self, k: int, since=None, until=None, **filters) -> List[Dict]:
+        # Top-k por tiempo: biseccion en el indice y k pasos hacia atras, sin ordenar el registro
+        result = []
+        for row in self.iter_rows(since, until, newest_first=True, **filters):
+            result.append(self.row(row))
+            if len(result) >= k:
+                break
+        return result
+
+
+delivery_log = _DeliveryLog()
+
+
+# Lock lectores/escritor del estado compartido. Entran como lectores las instantaneas (estado, guardado,
+# exportaciones) y las mutaciones de una sola ruta, que ademas cogen el lock de esa ruta y de su camion;
+# como escritor, las altas/bajas en listas e indices y las pasadas globales (planificador, sync, consumo).
+# Reentrante en el mismo hilo; no se puede pasar de lector a escritor. Un escritor en espera frena a los
+# lectores nuevos para no quedarse sin turno
+class _RWLock:
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("No se puede pasar de lectura a escritura sobre el estado")
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
+state_lock = _RWLock()
+entity_locks: Dict[str, Dict] = {"routes": {}, "trucks": {}, "tanks": {}, "depots": {}}
+entity_locks_guard = threading.Lock()
+route_ids = {"last": None}
+route_id_lock = threading.Lock()
+
+
+def _entity_lock(kind: str, key):
+    with entity_locks_guard:
+        lock = entity_locks[kind].get(key)
+        if lock is None:
+            lock = entity_locks[kind][key] = threading.RLock()
+        return lock
+
+
+@contextmanager
+def _route_access(route: Dict, *truck_ids):
+    # Orden fijo para no cruzarse entre hilos: estado (lector) -> ruta -> camiones (por id) -> deposito/almacen
+    truck_keys = sorted({route.get("truck_id"), *truck_ids}, key=str)
+    with ExitStack() as stack:
+        stack.enter_context(state_lock.read())
+        stack.enter_context(_entity_lock("routes", route["id"]))
+        for key in truck_keys:
+            stack.enter_context(_entity_lock("trucks", key))
+        yield
+
+
+# Control optimista por ruta: cada mutacion sube "version"; si el cliente manda la version que leyo y la
+# ruta ha cambiado desde entonces se responde 409 con la ruta actual en vez de pisar el cambio del otro.
+# Comprobar y subir se hace con el lock de la ruta cogido, asi que es un compare-and-set dentro del proceso;
+# entre workers lo hace _claim_route_version contra la fila de la ruta en Postgres
+def _route_version_conflict(route: Dict, payload: Dict):
+    expected = payload.get("version")
+    if expected is None or _to_int(expected, -1) == route.get("version", 0):
+        return None
+    return _route_conflict(route)
+
+
+def _route_conflict(route: Dict):
+    return (
+        jsonify(
+            {
+                "ok": False,
+                "error": "La ruta ha cambiado mientras tanto. Recarga y vuelve a intentarlo",
+                "conflict": True,
+                "route": _serialize_routes([route])[0],
+            }
+        ),
+        409,
+    )
+
+
+def _bump_route_version(route: Dict):
+    route["version"] = route.get("version", 0) + 1
+
+
+# Indices por id sobre centers/trucks/active_routes. Se actualizan en cada alta/baja; si la longitud
+# de una lista no coincide con su indice (p.ej. un benchmark que la sustituye) se reconstruye al consultar
+registry = {"centers": {}, "tanks": {}, "trucks": {}, "routes": {}, "truck_routes": {}}
+
+
+def _reindex_centers():
+    registry["centers"] = {c["id"]: c for c in centers}
+    registry["tanks"] = {(c["id"], t["id"]): t for c in centers for t in c["tanks"]}
+
+
+def _reindex_trucks():
+    registry["trucks"] = {t["id"]: t for t in trucks}
+
+
+def _reindex_routes():
+    registry["routes"] = {}
+    registry["truck_routes"] = {}
+    for route in active_routes:
+        _index_route(route)
+
+
+def _reindex_registry():
+    _reindex_centers()
+    _reindex_trucks()
+    _reindex_routes()
+
+
+def _index_route(route: Dict):
+    registry["routes"][route["id"]] = route
+    registry["truck_routes"].setdefault(route.get("truck_id"), {})[route["id"]] = route
+
+
+def _unindex_route(route: Dict):
+    registry["routes"].pop(route["id"], None)
+    registry["truck_routes"].get(route.get("truck_id"), {}).pop(route["id"], None)
+
+
+def _add_active_route(route: Dict):
+    active_routes.append(route)
+    _index_route(route)
+
+
+def _registry_index(kind: str) -> Dict:
+    source = {"centers": centers, "trucks": trucks, "routes": active_routes}[kind]
+    if len(registry[kind]) != len(source):
+        {"centers": _reindex_centers, "trucks": _reindex_trucks, "routes": _reindex_routes}[kind]()
+    return registry[kind]
+
+
+def _find_truck(truck_id: str) -> Optional[Dict]:
+    return _registry_index("trucks").get(truck_id)
+
+
+def _find_route(route_id: str) -> Optional[Dict]:
+    return _registry_index("routes").get(route_id)
+
+
+def _truck_for_route(route_id: str) -> Optional[Dict]:
+    route = _find_route(route_id)
+    truck = _find_truck(route.get("truck_id")) if route else None
+    if truck is not None and truck.get("route_id") == route_id:
+        return truck
+    # El camion asignado no siempre coincide con route["truck_id"] (p.ej. tras reasignar): se busca
+    return next((t for t in trucks if t.get("route_id") == route_id), None)
+
+
+def _truck_routes(truck_id: str) -> List[Dict]:
+    _registry_index("routes")
+    return list(registry["truck_routes"].get(truck_id, {}).values())
 
 
 def _get_base_url() -> str:
@@ -621,6 +1233,8 @@ def _db_enabled():
 def _json_default(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
+    if isinstance(obj, _Model):
+        return obj.to_dict()
     return obj
 
 
@@ -631,14 +1245,40 @@ def _ensure_state_table(conn):
 
 
 def _serialize_for_store():
-    return {
-        "warehouse": WAREHOUSE,
-        "centers": centers,
-        "trucks": trucks,
-        "active_routes": active_routes,
-        "route_history": route_history,
-        "delivery_log": delivery_log,
-    }
+    if sensor_sim["dirty"]:
+        _flush_sensor_view()
+    with state_lock.read():
+        return {
+            "warehouse": WAREHOUSE,
+            "depot_stock": {d["id"]: d["stock_l"] for d in DEPOTS if d.get("stock_l") is not None},
+            "centers": [{**c, "tanks": [_plain(t) for t in c["tanks"]]} for c in centers],
+            "trucks": [_plain(t) for t in trucks],
+            "active_routes": [_plain(r) for r in active_routes],
+            "delivery_log": list(delivery_log),
+        }, _encoded_route_history()
+
+
+def _encoded_route_history() -> List[str]:
+    # Una ruta del historial ya no cambia: su JSON se guarda por objeto y version, y cada _save_state solo
+    # codifica las rutas recien cerradas en lugar de todo route_history (que no tiene tope)
+    previous = store_history_cache["routes"]
+    current = {}
+    encoded = []
+    for route in route_history:
+        version = route.get("version", 0)
+        cached = previous.get(id(route))
+        if cached is None or cached[0] is not route or cached[1] != version:
+            cached = (route, version, json.dumps(_plain(route), default=_json_default))
+        current[id(route)] = cached
+        encoded.append(cached[2])
+    store_history_cache["routes"] = current
+    return encoded
+
+
+def _store_payload() -> str:
+    data, history = _serialize_for_store()
+    head = json.dumps(data, default=_json_default)
+    return f'{head[:-1]}, "route_history": [{", ".join(history)}]}}'
 
 
 def _convert_dates(obj):
@@ -666,6 +1306,7 @@ def _load_state_from_db():
             if not row:
                 return
             data = row[0]
+        route_rows = _fetch_route_rows(conn)
     except Exception as exc:  # noqa: BLE001
         print("No se pudo cargar estado desde DB:", exc)
         return
@@ -677,18 +1318,27 @@ def _load_state_from_db():
     restored = _convert_dates(data)
     if restored.get("trucks"):
         trucks.clear()
-        trucks.extend(restored["trucks"])
+        trucks.extend(Truck.from_dict(t) for t in restored["trucks"])
     if restored.get("centers"):
+        for center in restored["centers"]:
+            center["tanks"] = [Tank.from_dict(t) for t in center.get("tanks", [])]
         centers.clear()
         centers.extend(restored["centers"])
     if restored.get("warehouse"):
         WAREHOUSE.update(restored["warehouse"])
+    for depot in DEPOTS:
+        stock = (restored.get("depot_stock") or {}).get(depot["id"])
+        if stock is not None:
+            depot["stock_l"] = stock
     if restored.get("active_routes") is not None:
         active_routes.clear()
-        active_routes.extend(restored.get("active_routes", []))
+        active_routes.extend(Route.from_dict(r) for r in restored.get("active_routes", []))
     if restored.get("route_history") is not None:
         route_history.clear()
-        route_history.extend(restored.get("route_history", []))
+        route_history.extend(Route.from_dict(r) for r in restored.get("route_history", []))
+    _apply_route_rows(route_rows)
+    _reindex_registry()
+    route_ids["last"] = None
     if restored.get("delivery_log") is not None:
         delivery_log.clear()
         delivery_log.extend(restored.get("delivery_log", []))
@@ -703,7 +1353,7 @@ def _save_state():
     try:
         conn = psycopg2.connect(DB_URL, sslmode="require")
         _ensure_state_table(conn)
-        payload = json.dumps(_serialize_for_store(), default=_json_default)
+        payload = _store_payload()
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -723,6 +1373,572 @@ def _save_state():
             pass
 
 
+# Una fila por ruta (tabla routes) con su version: es el compare-and-set que comparten los workers. app_state
+# sigue guardando la foto completa; al arrancar, la fila con version mayor sustituye a la ruta de la foto
+def _ensure_routes_table(conn):
+    if route_store["table_ready"]:
+        return
+    with conn.cursor() as cur:
+        cur.execute("create table if not exists routes (id text primary key, version integer not null, data jsonb)")
+    conn.commit()
+    route_store["table_ready"] = True
+
+
+def _fetch_route_rows(conn) -> List[Dict]:
+    _ensure_routes_table(conn)
+    with conn.cursor() as cur:
+        cur.execute("select data from routes")
+        return [row[0] for row in cur.fetchall()]
+
+
+def _apply_route_rows(rows: List[Dict]):
+    known = {r["id"]: r for r in [*active_routes, *route_history]}
+    for data in rows:
+        fresh = Route.from_dict(_convert_dates(data))
+        current = known.get(fresh.get("id"))
+        if current is not None and current.get("version", 0) >= fresh.get("version", 0):
+            continue
+        active_routes[:] = [r for r in active_routes if r.get("id") != fresh["id"]]
+        route_history[:] = [r for r in route_history if r.get("id") != fresh["id"]]
+        if fresh.get("status") == "finalizada":
+            route_history.insert(0, fresh)
+        elif fresh.get("status") != "eliminada":
+            active_routes.append(fresh)
+
+
+@contextmanager
+def _route_store_cursor():
+    # En una peticion reutiliza su conexion (se cierra en teardown); fuera de ella, en el hilo del
+    # planificador, abre una solo para esta operacion
+    owned = not has_request_context()
+    conn = None if owned else g.get("route_store_conn")
+    if conn is None or conn.closed:
+        conn = psycopg2.connect(DB_URL, sslmode="require")
+        if not owned:
+            g.route_store_conn = conn
+    try:
+        _ensure_routes_table(conn)
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if owned:
+            conn.close()
+
+
+def _claim_route_row(route: Dict) -> bool:
+    # Sube la version de la fila solo si sigue siendo la que tiene este proceso; se llama con el lock de la
+    # ruta (o el de escritura) cogido y antes de aplicar nada. Si otro worker la cambio, la ruta se recarga
+    # de la fila y devuelve False. Sin DB, o si falla, vale el control en memoria
+    if not _db_enabled():
+        return True
+    version = route.get("version", 0)
+    row = None
+    try:
+        with _route_store_cursor() as cur:
+            cur.execute(
+                """
+                insert into routes(id, version, data) values (%s, %s, %s::jsonb)
+                on conflict (id) do update set version = EXCLUDED.version where routes.version = %s
+                returning id
+                """,
+                (route["id"], version + 1, json.dumps(_plain(route), default=_json_default), version),
+            )
+            claimed = cur.fetchone() is not None
+            if not claimed:
+                cur.execute("select data from routes where id = %s", (route["id"],))
+                row = cur.fetchone()
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo reservar la version de la ruta en DB:", exc)
+        return True
+    if claimed:
+        route_store["claims"][route["id"]] = version + 1
+        return True
+    if row and row[0]:
+        fresh = Route.from_dict(_convert_dates(row[0]))
+        _unindex_route(route)
+        route.clear()
+        route.update(fresh)
+        if route.get("status") not in ("finalizada", "eliminada"):
+            _index_route(route)
+    return False
+
+
+def _claim_route_version(route: Dict):
+    return None if _claim_route_row(route) else _route_conflict(route)
+
+
+def _persist_route(route: Dict):
+    # Guarda la ruta ya cambiada sobre la version que se reservo; un lote puede haberla subido varias veces
+    claimed = route_store["claims"].pop(route["id"], None)
+    if not _db_enabled() or claimed is None:
+        return
+    try:
+        with _route_store_cursor() as cur:
+            cur.execute(
+                "update routes set data = %s::jsonb, version = %s where id = %s and version = %s",
+                (json.dumps(_plain(route), default=_json_default), route.get("version", 0), route["id"], claimed),
+            )
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo guardar la ruta en DB:", exc)
+
+
+def _archive_route(route: Dict):
+    # Pasar la ruta al historial cambia las listas: escritor, pero solo para el movimiento
+    with state_lock.write():
+        if any(r is route for r in active_routes):
+            active_routes[:] = [r for r in active_routes if r is not route]
+            route_history.insert(0, route)
+    _aggregate_finished_route(route)
+
+
+def _history_array(typecode: str, size: int):
+    if np is not None:
+        return np.zeros(size, dtype=np.float64 if typecode == "d" else np.float32)
+    return array.array(typecode, bytes(array.array(typecode).itemsize * size))
+
+
+def _new_level_buffer():
+    # Anillo de (epoch UTC, litros): 12 bytes por lectura, memoria constante por deposito
+    return {
+        "ts": _history_array("d", LEVEL_HISTORY_SIZE),
+        "liters": _history_array("f", LEVEL_HISTORY_SIZE),
+        "head": 0,
+        "count": 0,
+        "last_reading": None,
+    }
+
+
+def _naive_utc(moment: datetime) -> datetime:
+    # El estado trabaja en UTC sin zona (_now): las fechas con zona se convierten antes de comparar
+    if moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _reading_epoch(value) -> Optional[float]:
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        text = _safe_iso_ts(value)
+        if not text:
+            return None
+        try:
+            moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    return (_naive_utc(moment) - datetime(1970, 1, 1)).total_seconds()
+
+
+def _append_level(buf: Dict, epoch: float, liters: float):
+    head = buf["head"]
+    buf["ts"][head] = epoch
+    buf["liters"][head] = liters
+    buf["head"] = (head + 1) % LEVEL_HISTORY_SIZE
+    buf["count"] = min(buf["count"] + 1, LEVEL_HISTORY_SIZE)
+
+
+def _record_level_reading(center_id: str, tank_id: str, last_reading, liters: Optional[float]) -> bool:
+    if liters is None:
+        return False
+    epoch = _reading_epoch(last_reading)
+    if epoch is None:
+        return False
+    key = (str(center_id), str(tank_id))
+    with level_history_lock:
+        buf = level_history["buffers"].get(key)
+        if buf is None:
+            buf = level_history["buffers"][key] = _new_level_buffer()
+        # Savian repite la misma lectura hasta que el sensor envia otra: solo cuenta si avanza la fecha
+        if buf["last_reading"] is not None and epoch <= buf["last_reading"]:
+            return False
+        _append_level(buf, epoch, liters)
+        buf["last_reading"] = epoch
+        level_history["pending"] += 1
+        if _db_enabled():
+            new_rows = level_history["new_rows"]
+            new_rows.append((key[0], key[1], epoch, liters))
+            # Con la DB caida mucho tiempo no se acumula mas de lo que cabe en los anillos
+            overflow = len(new_rows) - LEVEL_HISTORY_SIZE * len(level_history["buffers"])
+            if overflow > 0:
+                del new_rows[:overflow]
+    _rollup_levels(epoch, [(key[0], key[1], liters)])
+    return True
+
+
+def _level_buffer_rows(buf: Dict) -> Tuple[List[float], List[float]]:
+    count, head = buf["count"], buf["head"]
+    start = (head - count) % LEVEL_HISTORY_SIZE
+    if np is not None:
+        order = (np.arange(count) + start) % LEVEL_HISTORY_SIZE
+        return buf["ts"][order].tolist(), buf["liters"][order].tolist()
+    order = [(start + i) % LEVEL_HISTORY_SIZE for i in range(count)]
+    return [buf["ts"][i] for i in order], [buf["liters"][i] for i in order]
+
+
+def _level_history_range(
+    center_id: str,
+    tank_id: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: Optional[int] = None,
+) -> List[Dict]:
+    with level_history_lock:
+        buf = level_history["buffers"].get((str(center_id), str(tank_id)))
+        if buf is None:
+            return []
+        ts, liters = _level_buffer_rows(buf)
+    # Las lecturas entran en orden creciente, asi que el rango se busca por biseccion
+    lo = bisect.bisect_left(ts, _reading_epoch(since)) if since else 0
+    hi = bisect.bisect_right(ts, _reading_epoch(until)) if until else len(ts)
+    if limit is not None and hi - lo > limit:
+        lo = hi - limit
+    epoch = datetime(1970, 1, 1)
+    return [
+        {"ts": (epoch + timedelta(seconds=ts[i])).isoformat(), "liters": round(liters[i], 1)}
+        for i in range(lo, hi)
+    ]
+
+
+def _consumption_rates_loop(rows: List[Tuple[Tuple[str, str], Dict]]) -> Dict[Tuple[str, str], float]:
+    rates = {}
+    for key, buf in rows:
+        ts, liters = _level_buffer_rows(buf)
+        cutoff = ts[-1] - CONSUMPTION_WINDOW_H * 3600
+        used_l = hours = 0.0
+        for i in range(bisect.bisect_left(ts, cutoff) + 1, len(ts)):
+            drop = liters[i - 1] - liters[i]
+            if drop >= 0:
+                used_l += drop
+                hours += (ts[i] - ts[i - 1]) / 3600
+        if hours >= CONSUMPTION_MIN_SPAN_H:
+            rates[key] = used_l / hours
+    return rates
+
+
+def _estimate_consumption_rates(keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+    # Litros/hora por deposito en la ventana reciente. Los tramos en que el nivel sube (descargas de
+    # complete-stop o rellenos manuales) se descartan enteros: ni su subida ni su duracion cuentan
+    with level_history_lock:
+        rows = []
+        for key in keys:
+            buf = level_history["buffers"].get((str(key[0]), str(key[1])))
+            if buf is not None and buf["count"] >= CONSUMPTION_MIN_READINGS:
+                rows.append((key, buf))
+        if not rows:
+            return {}
+        if np is None:
+            return _consumption_rates_loop(rows)
+        ts_parts, liter_parts, seg_parts = [], [], []
+        for idx, (_key, buf) in enumerate(rows):
+            order = (np.arange(buf["count"]) + buf["head"] - buf["count"]) % LEVEL_HISTORY_SIZE
+            ts = buf["ts"][order]
+            start = int(np.searchsorted(ts, ts[-1] - CONSUMPTION_WINDOW_H * 3600))
+            ts_parts.append(ts[start:])
+            liter_parts.append(buf["liters"][order][start:].astype(np.float64))
+            seg_parts.append(np.full(len(ts) - start, idx))
+    # Todas las series concatenadas: una sola pasada de diferencias y sumas por segmento
+    ts = np.concatenate(ts_parts)
+    liters = np.concatenate(liter_parts)
+    seg = np.concatenate(seg_parts)
+    drop = liters[:-1] - liters[1:]
+    valid = (seg[1:] == seg[:-1]) & (drop >= 0)
+    owner = seg[1:][valid]
+    used_l = np.bincount(owner, weights=drop[valid], minlength=len(rows))
+    hours = np.bincount(owner, weights=np.diff(ts)[valid] / 3600, minlength=len(rows))
+    return {
+        key: float(used_l[idx] / hours[idx])
+        for idx, (key, _buf) in enumerate(rows)
+        if hours[idx] >= CONSUMPTION_MIN_SPAN_H
+    }
+
+
+def _new_rollup_scope() -> Dict:
+    scope = {}
+    for resolution, (_step, slots) in ROLLUP_RESOLUTIONS.items():
+        bucket = np.full(slots, -1.0) if np is not None else array.array("d", [-1.0]) * slots
+        scope[resolution] = {"bucket": bucket, "cols": _history_array("d", slots * len(ROLLUP_FIELDS))}
+    return scope
+
+
+def _rollup_slot(series: Dict, step: int, slots: int, epoch: float) -> Optional[int]:
+    # Cada cubo ocupa la posicion bucket_id % slots: al llegar un cubo nuevo se recicla la del mas antiguo
+    bucket_id = int(epoch // step)
+    slot = bucket_id % slots
+    current = series["bucket"][slot]
+    if current != bucket_id:
+        if bucket_id < current:
+            return None
+        series["bucket"][slot] = bucket_id
+        base = slot * len(ROLLUP_FIELDS)
+        cols = series["cols"]
+        cols[base] = cols[base + 1] = cols[base + 2] = cols[base + 5] = 0.0
+        cols[base + 3] = math.inf
+        cols[base + 4] = -math.inf
+    return slot * len(ROLLUP_FIELDS)
+
+
+def _rollup_add_locked(
+    scope_key: str,
+    epoch: float,
+    consumed_l: float = 0.0,
+    delivered_l: float = 0.0,
+    level_l: Optional[float] = None,
+):
+    scope = rollups["scopes"].get(scope_key)
+    if scope is None:
+        scope = rollups["scopes"][scope_key] = _new_rollup_scope()
+    for resolution, (step, slots) in ROLLUP_RESOLUTIONS.items():
+        series = scope[resolution]
+        base = _rollup_slot(series, step, slots, epoch)
+        if base is None:
+            continue
+        cols = series["cols"]
+        cols[base] += consumed_l
+        if delivered_l:
+            cols[base + 1] += delivered_l
+            cols[base + 2] += 1
+        if level_l is not None:
+            cols[base + 3] = min(cols[base + 3], level_l)
+            cols[base + 4] = max(cols[base + 4], level_l)
+            cols[base + 5] = level_l
+    rollups["pending"] += 1
+
+
+def _rollup_levels(epoch: float, rows: List[Tuple[str, str, float]]):
+    # Consumo = bajadas de nivel entre lecturas (las subidas son descargas); nivel = suma de depositos del centro
+    with rollup_lock:
+        consumed: Dict[str, float] = {}
+        for center_id, tank_id, liters in rows:
+            key = (str(center_id), str(tank_id))
+            previous = rollups["tank_last"].get(key)
+            rollups["tank_last"][key] = liters
+            rollups["center_level"][key[0]] = rollups["center_level"].get(key[0], 0.0) + liters - (previous or 0.0)
+            drop = (previous - liters) if previous is not None and previous > liters else 0.0
+            consumed[key[0]] = consumed.get(key[0], 0.0) + drop
+        for center_id, consumed_l in consumed.items():
+            _rollup_add_locked(center_id, epoch, consumed_l=consumed_l, level_l=rollups["center_level"][center_id])
+        _rollup_add_locked(
+            ROLLUP_ALL,
+            epoch,
+            consumed_l=sum(consumed.values()),
+            level_l=sum(rollups["center_level"].values()),
+        )
+
+
+def _rollup_delivery(center_id: str, moment: datetime, delivered_l: float):
+    epoch = _reading_epoch(moment)
+    with rollup_lock:
+        _rollup_add_locked(str(center_id), epoch, delivered_l=delivered_l)
+        _rollup_add_locked(ROLLUP_ALL, epoch, delivered_l=delivered_l)
+
+
+def _rollup_resolution_for(span_s: float) -> str:
+    # Se elige la resolucion para que cualquier rango devuelva del orden de cientos de cubos
+    if span_s <= 6 * 3600:
+        return "minute"
+    if span_s <= 14 * 86400:
+        return "hour"
+    return "day"
+
+
+def _rollup_range(scope_key: str, resolution: str, since: datetime, until: datetime) -> List[Dict]:
+    step, slots = ROLLUP_RESOLUTIONS[resolution]
+    first, last = int(_reading_epoch(since) // step), int(_reading_epoch(until) // step)
+    first = max(first, last - slots + 1)
+    epoch = datetime(1970, 1, 1)
+    rows = []
+    with rollup_lock:
+        scope = rollups["scopes"].get(scope_key)
+        if scope is None:
+            return rows
+        series = scope[resolution]
+        for bucket_id in range(first, last + 1):
+            slot = bucket_id % slots
+            if series["bucket"][slot] != bucket_id:
+                continue
+            base = slot * len(ROLLUP_FIELDS)
+            values = [float(v) for v in series["cols"][base : base + len(ROLLUP_FIELDS)]]
+            has_level = values[3] != math.inf
+            rows.append(
+                {
+                    "ts": (epoch + timedelta(seconds=bucket_id * step)).isoformat(),
+                    "consumed_l": round(values[0], 1),
+                    "delivered_l": round(values[1], 1),
+                    "deliveries": int(values[2]),
+                    "level_min": round(values[3], 1) if has_level else None,
+                    "level_max": round(values[4], 1) if has_level else None,
+                    "level_last": round(values[5], 1) if has_level else None,
+                }
+            )
+    return rows
+
+
+def _serialize_rollups() -> Dict:
+    with rollup_lock:
+        scopes = {}
+        for scope_key, scope in rollups["scopes"].items():
+            scopes[scope_key] = {}
+            for resolution, series in scope.items():
+                rows = []
+                for slot, bucket_id in enumerate(series["bucket"]):
+                    if bucket_id >= 0:
+                        base = slot * len(ROLLUP_FIELDS)
+                        values = [float(v) for v in series["cols"][base : base + len(ROLLUP_FIELDS)]]
+                        # JSON no admite infinitos: un cubo sin lecturas de nivel se guarda con None
+                        rows.append([int(bucket_id)] + [v if math.isfinite(v) else None for v in values])
+                scopes[scope_key][resolution] = rows
+        return {
+            "scopes": scopes,
+            "tank_last": {f"{cid}/{tid}": liters for (cid, tid), liters in rollups["tank_last"].items()},
+        }
+
+
+def _restore_rollups(data: Dict):
+    with rollup_lock:
+        for scope_key, resolutions in (data.get("scopes") or {}).items():
+            scope = rollups["scopes"][scope_key] = _new_rollup_scope()
+            for resolution, rows in resolutions.items():
+                if resolution not in ROLLUP_RESOLUTIONS:
+                    continue
+                step, slots = ROLLUP_RESOLUTIONS[resolution]
+                series = scope[resolution]
+                for bucket_id, *values in rows:
+                    base = _rollup_slot(series, step, slots, bucket_id * step)
+                    if base is None:
+                        continue
+                    for offset, value in enumerate(values[: len(ROLLUP_FIELDS)]):
+                        if value is not None:
+                            series["cols"][base + offset] = value
+        for key, liters in (data.get("tank_last") or {}).items():
+            center_id, _sep, tank_id = key.partition("/")
+            rollups["tank_last"][(center_id, tank_id)] = liters
+            rollups["center_level"][center_id] = rollups["center_level"].get(center_id, 0.0) + liters
+
+
+def _ensure_level_readings_table(conn):
+    # Una vez por proceso: lecturas sueltas, solo se insertan las nuevas en cada volcado
+    if level_history["table_ready"]:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            create table if not exists level_readings (
+                center_id text, tank_id text, ts double precision, liters real,
+                primary key (center_id, tank_id, ts)
+            )
+            """
+        )
+    conn.commit()
+    level_history["table_ready"] = True
+
+
+def _flush_level_history(force: bool = False):
+    # Se persiste en lote: como mucho una escritura cada LEVEL_HISTORY_FLUSH_S aunque lleguen lecturas cada 30 s
+    with level_history_lock:
+        if not level_history["pending"] and not rollups["pending"]:
+            return
+        if not force and time.monotonic() - level_history["flushed_at"] < LEVEL_HISTORY_FLUSH_S:
+            return
+        level_history["flushed_at"] = time.monotonic()
+        # El lote sale de la cola aqui mismo: lo que llegue durante la escritura (y sus recortes) ya va a otra lista
+        rows = level_history["new_rows"]
+        level_history["new_rows"] = []
+        pending = level_history["pending"]
+        # Las lecturas que ya no estan en ningun anillo no se volveran a cargar: se borran de la tabla
+        oldest = [
+            buf["ts"][(buf["head"] - buf["count"]) % LEVEL_HISTORY_SIZE]
+            for buf in level_history["buffers"].values()
+            if buf["count"]
+        ]
+    with rollup_lock:
+        rollups_pending = rollups["pending"]
+    if _db_enabled():
+        try:
+            conn = psycopg2.connect(DB_URL, sslmode="require")
+            _ensure_state_table(conn)
+            _ensure_level_readings_table(conn)
+            with conn.cursor() as cur:
+                if rows:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        "insert into level_readings(center_id, tank_id, ts, liters) values %s on conflict do nothing",
+                        rows,
+                    )
+                if oldest:
+                    cur.execute("delete from level_readings where ts < %s", (float(min(oldest)),))
+                cur.execute(
+                    """
+                    insert into app_state(key, data)
+                    values (%s, %s::jsonb)
+                    on conflict (key) do update set data = EXCLUDED.data
+                    """,
+                    ("rollups", json.dumps(_serialize_rollups())),
+                )
+            conn.commit()
+        except Exception as exc:  # noqa: BLE001
+            # El lote vuelve delante de lo llegado mientras tanto, con el mismo tope que _record_level_reading
+            print("No se pudo guardar historico de niveles en DB:", exc)
+            with level_history_lock:
+                new_rows = rows + level_history["new_rows"]
+                overflow = len(new_rows) - LEVEL_HISTORY_SIZE * len(level_history["buffers"])
+                if overflow > 0:
+                    del new_rows[:overflow]
+                level_history["new_rows"] = new_rows
+            return
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    with level_history_lock:
+        level_history["pending"] = max(level_history["pending"] - pending, 0)
+    with rollup_lock:
+        rollups["pending"] = max(rollups["pending"] - rollups_pending, 0)
+
+
+def _load_level_history_from_db():
+    if not _db_enabled():
+        return
+    try:
+        conn = psycopg2.connect(DB_URL, sslmode="require")
+        _ensure_state_table(conn)
+        _ensure_level_readings_table(conn)
+        with conn.cursor() as cur:
+            cur.execute("select key, data from app_state where key in (%s, %s)", ("level_history", "rollups"))
+            stored = dict(cur.fetchall())
+            cur.execute("select center_id, tank_id, ts, liters from level_readings order by center_id, tank_id, ts")
+            readings = cur.fetchall()
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo cargar historico de niveles desde DB:", exc)
+        return
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _restore_rollups(stored.get("rollups") or {})
+    series: Dict[Tuple[str, str], List[Tuple[float, float]]] = {}
+    for center_id, tank_id, epoch, liters in readings:
+        series.setdefault((center_id, tank_id), []).append((epoch, liters))
+    if not series:
+        # Volcados anteriores guardaban el anillo entero como un documento JSON en app_state
+        for key, rows in (stored.get("level_history") or {}).items():
+            center_id, _sep, tank_id = key.partition("/")
+            series[(center_id, tank_id)] = list(zip(rows.get("ts", []), rows.get("liters", [])))
+    with level_history_lock:
+        for key, rows in series.items():
+            buf = _new_level_buffer()
+            # Si LEVEL_HISTORY_SIZE ha bajado desde el ultimo volcado se conservan las lecturas mas recientes
+            for epoch, liters in rows[-LEVEL_HISTORY_SIZE:]:
+                _append_level(buf, epoch, liters)
+                buf["last_reading"] = epoch
+            level_history["buffers"][key] = buf
+
+
 def _qr_targets(base_url: str):
     targets = []
     for tr in trucks:
@@ -730,6 +1946,9 @@ def _qr_targets(base_url: str):
             {
                 "filename": f"truck_{tr['id']}.png",
                 "url": f"{base_url}/scan?type=truck&id={tr['id']}",
+                "kind": "truck",
+                "id": tr["id"],
+                "label": f"Camion {tr['id']}",
             }
         )
     for center in centers:
@@ -738,24 +1957,207 @@ def _qr_targets(base_url: str):
                 {
                     "filename": f"center_{center['id']}_{tank['id']}.png",
                     "url": f"{base_url}/scan?type=center&center_id={center['id']}&tank_id={tank['id']}",
+                    "kind": "center",
+                    "id": tank["id"],
+                    "center_id": center["id"],
+                    "label": f"{center['name']} / {tank.get('label') or tank['id']}",
                 }
             )
-    targets.append({"filename": "warehouse_main.png", "url": f"{base_url}/scan?type=warehouse&id=main"})
+    targets.append(
+        {
+            "filename": "warehouse_main.png",
+            "url": f"{base_url}/scan?type=warehouse&id=main",
+            "kind": "warehouse",
+            "id": "main",
+            "label": WAREHOUSE.get("name") or "Almacen",
+        }
+    )
     return targets
 
 
+def _qr_dir() -> Path:
+    return Path(app.root_path) / "static" / "qr"
+
+
+def _write_qr_png(target: Dict, out_dir: Path) -> Path:
+    img_path = out_dir / target["filename"]
+    img = qrcode.make(target["url"], image_factory=PyPNGImage)
+    with open(img_path, "wb") as f:
+        img.save(f)
+    return img_path
+
+
 def _ensure_qr_codes(base_url: str):
-    out_dir = Path(app.root_path) / "static" / "qr"
+    out_dir = _qr_dir()
     out_dir.mkdir(parents=True, exist_ok=True)
     for target in _qr_targets(base_url):
-        img_path = out_dir / target["filename"]
-        img = qrcode.make(target["url"], image_factory=PyPNGImage)
-        with open(img_path, "wb") as f:
-            img.save(f)
+        _write_qr_png(target, out_dir)
+
+
+QR_EXPORT_CHUNK_BYTES = 64 * 1024
+QR_SHEET_LABELS_PER_PAGE = 12
+# Cache de exportaciones por version de flota y filtro, limitada en bytes; las mas antiguas salen primero
+QR_EXPORT_CACHE_BYTES = int(os.environ.get("QR_EXPORT_CACHE_BYTES", str(32 * 1024 * 1024)))
+qr_export_cache = {"version": None, "entries": {}, "bytes": 0}
+qr_export_lock = threading.Lock()
+
+
+def _qr_fleet_version(targets: List[Dict]) -> str:
+    digest = hashlib.sha1()
+    for target in targets:
+        digest.update(f"{target['filename']}|{target['url']}|{target.get('label')}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _filter_qr_targets(
+    targets: List[Dict],
+    kind: Optional[str] = None,
+    center_id: Optional[str] = None,
+    ids: Optional[set] = None,
+) -> List[Dict]:
+    selected = []
+    for target in targets:
+        if kind and kind != "all" and target["kind"] != kind:
+            continue
+        if center_id and target.get("center_id") != center_id:
+            continue
+        if ids and target["id"] not in ids:
+            continue
+        selected.append(target)
+    return selected
+
+
+def _iter_qr_png_chunks(target: Dict):
+    # Lee el PNG ya cacheado en static/qr a trozos; solo se genera si falta
+    out_dir = _qr_dir()
+    img_path = out_dir / target["filename"]
+    if not img_path.exists():
+        out_dir.mkdir(parents=True, exist_ok=True)
+        _write_qr_png(target, out_dir)
+    with open(img_path, "rb") as f:
+        while True:
+            chunk = f.read(QR_EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+
+# Destino no posicionable para zipfile: solo retiene lo escrito desde el ultimo drain()
+class _StreamSink(io.RawIOBase):
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _iter_qr_zip(targets: List[Dict]):
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for target in targets:
+            # Los PNG ya van comprimidos: se guardan tal cual con descriptor de datos
+            with zf.open(target["filename"], mode="w") as entry:
+                for chunk in _iter_qr_png_chunks(target):
+                    entry.write(chunk)
+                    pending = sink.drain()
+                    if pending:
+                        yield pending
+            pending = sink.drain()
+            if pending:
+                yield pending
+    pending = sink.drain()
+    if pending:
+        yield pending
+
+
+def _iter_qr_sheet(targets: List[Dict], title: str):
+    yield (
+        "<!doctype html><html lang=\"es\"><head><meta charset=\"utf-8\" />"
+        f"<title>{escape(title)}</title><style>"
+        "body{font-family:sans-serif;margin:0}"
+        ".page{display:grid;grid-template-columns:repeat(3,1fr);gap:8mm;padding:10mm;"
+        "page-break-after:always;break-after:page}"
+        ".page:last-child{page-break-after:auto;break-after:auto}"
+        ".label{border:1px dashed #999;padding:4mm;text-align:center;font-size:11pt}"
+        ".label img{width:45mm;height:45mm}"
+        "</style></head><body>"
+    ).encode("utf-8")
+    for idx, target in enumerate(targets):
+        if idx % QR_SHEET_LABELS_PER_PAGE == 0:
+            if idx:
+                yield b"</section>"
+            yield b"<section class=\"page\">"
+        png = b"".join(_iter_qr_png_chunks(target))
+        yield (
+            "<figure class=\"label\">"
+            f"<img alt=\"{escape(target['filename'])}\" src=\"data:image/png;base64,"
+            f"{base64.b64encode(png).decode('ascii')}\" />"
+            # Las etiquetas llevan nombres de centro que vienen de la API de Savian
+            f"<figcaption>{escape(target['label'])}</figcaption></figure>"
+        ).encode("utf-8")
+    if targets:
+        yield b"</section>"
+    yield b"</body></html>"
+
+
+def _cached_qr_export(version: str, key: Tuple, producer):
+    # Sirve desde cache si existe; si no, emite en streaming y guarda el resultado al terminar
+    with qr_export_lock:
+        if qr_export_cache["version"] != version:
+            qr_export_cache["version"] = version
+            qr_export_cache["entries"] = {}
+            qr_export_cache["bytes"] = 0
+        cached = qr_export_cache["entries"].get(key)
+    if cached is not None:
+        yield from cached[1]
+        return
+    produced = []
+    size = 0
+    for chunk in producer:
+        size += len(chunk)
+        if size <= QR_EXPORT_CACHE_BYTES:
+            produced.append(chunk)
+        yield chunk
+    if size > QR_EXPORT_CACHE_BYTES:
+        return
+    with qr_export_lock:
+        if qr_export_cache["version"] != version or key in qr_export_cache["entries"]:
+            return
+        entries = qr_export_cache["entries"]
+        while entries and qr_export_cache["bytes"] + size > QR_EXPORT_CACHE_BYTES:
+            old_size, _chunks = entries.pop(next(iter(entries)))
+            qr_export_cache["bytes"] -= old_size
+        entries[key] = (size, produced)
+        qr_export_cache["bytes"] += size
 
 
 def _now():
-    return datetime.utcnow()
+    # Con el reloj de simulacion activo todo el modelo (tramos, consumo, entregas) usa la hora simulada
+    sim_now = sim_clock["now"]
+    return sim_now if sim_now is not None else datetime.utcnow()
+
+
+def _set_sim_clock(value: Optional[datetime]):
+    with sim_clock_lock:
+        sim_clock["now"] = value
+
+
+def _advance_sim_clock(minutes: float) -> datetime:
+    with sim_clock_lock:
+        current = sim_clock["now"] or datetime.utcnow()
+        sim_clock["now"] = current + timedelta(minutes=minutes)
+        return sim_clock["now"]
 
 
 def _seed_history():
@@ -765,7 +2167,7 @@ def _seed_history():
     stop2_arrival = stop1_depart + timedelta(minutes=30)
     stop2_depart = stop2_arrival + timedelta(minutes=22)
     finished = stop2_depart + timedelta(minutes=36)
-    route = {
+    route = Route({
         "id": "R-000",
         "worker": "prueba2",
         "truck_id": "TR-02",
@@ -806,7 +2208,7 @@ def _seed_history():
         "current_leg": None,
         "total_delivered": 5700,
         "success": True,
-    }
+    })
     route_history.append(route)
     delivery_log.extend(
         [
@@ -832,9 +2234,155 @@ def _seed_history():
     )
 
 
+def _minutes_between(start, end) -> Optional[float]:
+    if not isinstance(start, datetime) or not isinstance(end, datetime):
+        return None
+    return max((end - start).total_seconds() / 60, 0.0)
+
+
+def _report_day(day: str) -> Dict:
+    return report_aggregates["days"].setdefault(day, {"stops": {}, "routes": {}})
+
+
+def _aggregate_finished_route(route: Dict):
+    # Celdas por dia: (centro, camion, operario) para paradas y (camion, operario) para rutas.
+    # Cada ruta se suma una sola vez, cuando pasa a finalizada
+    finished_at = route.get("finished_at")
+    if not isinstance(finished_at, datetime):
+        return
+    truck_id = route.get("truck_id") or "-"
+    worker = route.get("worker") or "sin_operario"
+    success = bool(route.get("success", True))
+    with report_lock:
+        if route["id"] in report_aggregates["routes"]:
+            return
+        report_aggregates["routes"].add(route["id"])
+        previous_depart = route.get("started_at")
+        visited = set()
+        for stop in route.get("stops", []):
+            arrival, depart = stop.get("arrival_at"), stop.get("depart_at")
+            moment = depart if isinstance(depart, datetime) else finished_at
+            cells = _report_day(moment.date().isoformat())["stops"]
+            cell = cells.setdefault((stop["center_id"], truck_id, worker), dict.fromkeys(REPORT_STOP_FIELDS, 0.0))
+            leg = _minutes_between(previous_depart, arrival)
+            if leg is not None:
+                cell["leg_min"] += leg
+                cell["leg_n"] += 1
+            if stop.get("delivered_l") is not None and stop.get("status") == "completado":
+                cell["stops"] += 1
+                cell["delivered_l"] += _to_float(stop.get("delivered_l"), 0.0) or 0.0
+                dwell = _minutes_between(arrival, depart)
+                if dwell is not None:
+                    cell["dwell_min"] += dwell
+                    cell["dwell_n"] += 1
+            if stop["center_id"] not in visited:
+                visited.add(stop["center_id"])
+                cell["visits"] += 1
+                cell["visits_ok"] += 1 if success else 0
+            if isinstance(depart, datetime):
+                previous_depart = depart
+        cells = _report_day(finished_at.date().isoformat())["routes"]
+        cell = cells.setdefault((truck_id, worker), dict.fromkeys(REPORT_ROUTE_FIELDS, 0.0))
+        cell["routes"] += 1
+        cell["routes_ok"] += 1 if success else 0
+        back = _minutes_between(previous_depart, finished_at) if route.get("stops") else None
+        if back is not None:
+            cell["return_min"] += back
+            cell["return_n"] += 1
+
+
+def _rebuild_report_aggregates():
+    with report_lock:
+        report_aggregates["days"].clear()
+        report_aggregates["routes"].clear()
+    for route in route_history:
+        if route.get("status") == "finalizada":
+            _aggregate_finished_route(route)
+
+
+def _report_row(key, stop_cells: List[Dict], route_cells: Optional[List[Dict]]) -> Dict:
+    total = lambda cells, field: sum(c[field] for c in cells)  # noqa: E731
+    leg_min, leg_n = total(stop_cells, "leg_min"), total(stop_cells, "leg_n")
+    if route_cells is None:
+        # Agrupando por centro no hay rutas propias: cuentan las rutas que pasaron por el centro
+        routes, routes_ok = total(stop_cells, "visits"), total(stop_cells, "visits_ok")
+    else:
+        routes, routes_ok = total(route_cells, "routes"), total(route_cells, "routes_ok")
+        leg_min += total(route_cells, "return_min")
+        leg_n += total(route_cells, "return_n")
+    dwell_n = total(stop_cells, "dwell_n")
+    return {
+        "key": key,
+        "deliveries": int(total(stop_cells, "stops")),
+        "delivered_l": round(total(stop_cells, "delivered_l"), 1),
+        "dwell_min": round(total(stop_cells, "dwell_min"), 1),
+        "avg_dwell_min": round(total(stop_cells, "dwell_min") / dwell_n, 1) if dwell_n else None,
+        "avg_leg_min": round(leg_min / leg_n, 1) if leg_n else None,
+        "routes": int(routes),
+        "success_rate": round(routes_ok / routes, 3) if routes else None,
+    }
+
+
+def _build_report(since: datetime, until: datetime, filters: Dict[str, Optional[str]]) -> Dict:
+    center_id, truck_id, worker = filters.get("center_id"), filters.get("truck_id"), filters.get("worker")
+    stop_groups: Dict[str, Dict] = {"center": {}, "truck": {}, "worker": {}, "day": {}, "center_worker": {}}
+    route_groups: Dict[str, Dict] = {"truck": {}, "worker": {}, "day": {}}
+    all_stops: List[Dict] = []
+    all_routes: List[Dict] = []
+    with report_lock:
+        # El coste depende del numero de dias del rango (como mucho REPORT_MAX_DAYS), no del de rutas cerradas
+        for offset in range((until.date() - since.date()).days + 1):
+            key = (since.date() + timedelta(days=offset)).isoformat()
+            bucket = report_aggregates["days"].get(key)
+            if not bucket:
+                continue
+            for (c_id, t_id, w), cell in bucket["stops"].items():
+                if (center_id and c_id != center_id) or (truck_id and t_id != truck_id) or (worker and w != worker):
+                    continue
+                cell = dict(cell)
+                all_stops.append(cell)
+                for group, value in (("center", c_id), ("truck", t_id), ("worker", w), ("day", key)):
+                    stop_groups[group].setdefault(value, []).append(cell)
+                stop_groups["center_worker"].setdefault((c_id, w), []).append(cell)
+            if center_id:
+                continue
+            for (t_id, w), cell in bucket["routes"].items():
+                if (truck_id and t_id != truck_id) or (worker and w != worker):
+                    continue
+                cell = dict(cell)
+                all_routes.append(cell)
+                for group, value in (("truck", t_id), ("worker", w), ("day", key)):
+                    route_groups[group].setdefault(value, []).append(cell)
+
+    def rows(group: str) -> List[Dict]:
+        keys = set(stop_groups[group]) | set(route_groups.get(group, {}))
+        return [
+            _report_row(
+                key,
+                stop_groups[group].get(key, []),
+                None if center_id or group == "center" else route_groups[group].get(key, []),
+            )
+            for key in sorted(keys)
+        ]
+
+    return {
+        "totals": _report_row("total", all_stops, None if center_id else all_routes),
+        "by_center": rows("center"),
+        "by_truck": rows("truck"),
+        "by_worker": rows("worker"),
+        "by_day": rows("day"),
+        "by_center_worker": [
+            {**_report_row(None, cells, None), "key": f"{c_id}/{w}", "center_id": c_id, "worker": w}
+            for (c_id, w), cells in sorted(stop_groups["center_worker"].items())
+        ],
+    }
+
+
 _load_state_from_db()
+_load_level_history_from_db()
 if not route_history:
     _seed_history()
+_rebuild_report_aggregates()
 _save_state()
 _ensure_qr_codes(_get_base_url())
 
@@ -851,19 +2399,559 @@ def _haversine_km(a, b):
     return 2 * r * math.asin(math.sqrt(h))
 
 
+TRUCK_SPEED_KMH = 60
+LEG_MIN_MINUTES = 8
+DISTANCE_MATRIX_BLOCK = 512
+WAREHOUSE_SITE = "warehouse"
+PLANNER_ENGINE = os.environ.get("PLANNER_ENGINE", "vrp")
+PLANNER_TIME_BUDGET_S = float(os.environ.get("PLANNER_TIME_BUDGET_S", "0.5"))
+PLANNER_MIN_STOP_L = 1000
+PLANNER_URGENT_PCT = 0.2
+PLANNER_FILL_DETOUR_FACTOR = 1.5
+PLANNER_HORIZON_H = float(os.environ.get("PLANNER_HORIZON_H", "48"))
+PLANNER_STOP_SERVICE_MIN = 20
+PLANNER_LATE_PENALTY_KM = 5.0
+PLANNER_DUE_BUCKET_MIN = 6 * 60
+PLANNER_WAVE_WINDOW_MIN = 30
+PLANNER_CANDIDATE_FACTOR = 10
+PLANNER_SAVINGS_NEIGHBOURS = 25
+PLANNER_WORKERS = int(os.environ.get("PLANNER_WORKERS", str(min(4, os.cpu_count() or 1))))
+PLANNER_AUTO_REPLAN = os.environ.get("PLANNER_AUTO_REPLAN", "1") == "1"
+PLANNER_REPLAN_BUDGET_S = float(os.environ.get("PLANNER_REPLAN_BUDGET_S", "0.05"))
+planner_state = {"urgent_tanks": None, "events": 0, "replans": 0, "last": None}
+planner_lock = threading.Lock()
+planner_events_queue: "queue.Queue[List[Dict]]" = queue.Queue()
+planner_worker = {"thread": None}
+planner_pool = {"executor": None}
+planner_pool_lock = threading.Lock()
+distance_matrix_cache = {"signature": None, "matrix": None}
+distance_matrix_lock = threading.Lock()
+ROAD_GRAPH_PATH = os.environ.get("ROAD_GRAPH_PATH", str(Path(__file__).parent / "data" / "road_graph.json"))
+ROAD_DEFAULT_SPEED_KMH = 50
+ROAD_ACCESS_SPEED_KMH = 20
+ROAD_SNAP_MAX_KM = 3.0
+ROAD_PATH_CACHE_SIZE = 2048
+road_graph_cache = {"mtime": None, "graph": None}
+road_graph_lock = threading.Lock()
+SPATIAL_CELL_DEG = 0.01
+PLANNER_NEAREST_CANDIDATES = 8
+spatial_index = {"version": 0, "cells": {}, "points": {}, "bounds": None}
+spatial_index_lock = threading.Lock()
+
+
+def _eta_minutes_for_km(km: float) -> int:
+    return max(LEG_MIN_MINUTES, math.ceil(km / TRUCK_SPEED_KMH * 60))
+
+
+def _center_site(center_id) -> str:
+    return f"center:{center_id}"
+
+
+def _depot_site(depot_id) -> str:
+    # El almacen principal conserva la clave historica del planificador
+    return WAREHOUSE_SITE if depot_id in (None, WAREHOUSE["id"]) else f"depot:{depot_id}"
+
+
+def _find_depot(depot_id) -> Dict:
+    return next((d for d in DEPOTS if d["id"] == depot_id), WAREHOUSE)
+
+
+def _truck_depot(truck: Dict) -> Dict:
+    return _find_depot(truck.get("depot_id"))
+
+
+def _truck_depot_site(truck: Dict) -> str:
+    return _depot_site(truck.get("depot_id"))
+
+
+def _tank_site(center_id, tank_id) -> str:
+    return f"tank:{center_id}:{tank_id}"
+
+
+def _planner_sites() -> List[Tuple[str, float, float]]:
+    sites = [(_depot_site(d["id"]), float(d["lat"]), float(d["lon"])) for d in DEPOTS]
+    for center in centers:
+        loc = center["location"]
+        sites.append((_center_site(center["id"]), float(loc["lat"]), float(loc["lon"])))
+        for tank in center["tanks"]:
+            tloc = tank.get("location") or loc
+            sites.append((_tank_site(center["id"], tank["id"]), float(tloc["lat"]), float(tloc["lon"])))
+    return sites
+
+
+def _haversine_rows(lat_rows, lon_rows, lats, lons):
+    # lat/lon en radianes; devuelve una matriz (filas x columnas) en km
+    dlat = lats[None, :] - lat_rows[:, None]
+    dlon = lons[None, :] - lon_rows[:, None]
+    h = np.sin(dlat / 2) ** 2 + np.cos(lat_rows)[:, None] * np.cos(lats)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * 6371 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def _build_road_graph(data: Dict, version) -> Dict:
+    # Extracto offline: {"nodes": [[id, lat, lon], ...], "edges": [[desde, hasta, km, kmh, sentido_unico], ...]}
+    index = {}
+    lats: List[float] = []
+    lons: List[float] = []
+    for node_id, lat, lon in data.get("nodes", []):
+        index[str(node_id)] = len(lats)
+        lats.append(float(lat))
+        lons.append(float(lon))
+    adj: List[List[Tuple[int, float, float]]] = [[] for _ in lats]
+    max_speed = float(ROAD_DEFAULT_SPEED_KMH)
+    for edge in data.get("edges", []):
+        a, b = index.get(str(edge[0])), index.get(str(edge[1]))
+        if a is None or b is None or a == b:
+            continue
+        km = _to_float(edge[2] if len(edge) > 2 else None)
+        if km is None:
+            km = _haversine_km({"lat": lats[a], "lon": lons[a]}, {"lat": lats[b], "lon": lons[b]})
+        speed = _to_float(edge[3] if len(edge) > 3 else None) or float(ROAD_DEFAULT_SPEED_KMH)
+        minutes = km * 60 / speed
+        adj[a].append((b, minutes, km))
+        if not (len(edge) > 4 and edge[4]):
+            adj[b].append((a, minutes, km))
+        max_speed = max(max_speed, speed)
+    graph = {
+        "version": version,
+        "lat": lats,
+        "lon": lons,
+        "adj": adj,
+        "max_speed_kmh": max_speed,
+        "paths": {},
+        "rows": {},
+    }
+    if np is not None:
+        graph["lat_rad"] = np.radians(np.array(lats, dtype=np.float64))
+        graph["lon_rad"] = np.radians(np.array(lons, dtype=np.float64))
+    return graph
+
+
+def _load_road_graph() -> Optional[Dict]:
+    path = Path(ROAD_GRAPH_PATH)
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None
+    with road_graph_lock:
+        if road_graph_cache["mtime"] == mtime:
+            return road_graph_cache["graph"]
+    try:
+        raw = path.read_bytes()
+        if path.suffix == ".gz":
+            raw = gzip.decompress(raw)
+        graph = _build_road_graph(json.loads(raw), mtime)
+        if not graph["lat"]:
+            graph = None
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo cargar el grafo de carreteras:", exc)
+        graph = None
+    with road_graph_lock:
+        road_graph_cache["mtime"] = mtime
+        road_graph_cache["graph"] = graph
+    return graph
+
+
+def _road_graph_version():
+    graph = _load_road_graph()
+    return graph["version"] if graph else None
+
+
+def _snap_points(graph: Dict, points: List[Dict]) -> List[Tuple[int, float]]:
+    # Nodo de carretera mas cercano a cada punto y distancia en km hasta el
+    if np is not None:
+        lats = np.radians(np.array([float(p["lat"]) for p in points], dtype=np.float64))
+        lons = np.radians(np.array([float(p["lon"]) for p in points], dtype=np.float64))
+        snapped = []
+        for start in range(0, len(points), DISTANCE_MATRIX_BLOCK):
+            stop = min(start + DISTANCE_MATRIX_BLOCK, len(points))
+            km = _haversine_rows(lats[start:stop], lons[start:stop], graph["lat_rad"], graph["lon_rad"])
+            nearest = np.argmin(km, axis=1)
+            snapped.extend((int(n), float(km[i, n])) for i, n in enumerate(nearest))
+        return snapped
+    nodes = [{"lat": lat, "lon": lon} for lat, lon in zip(graph["lat"], graph["lon"])]
+    snapped = []
+    for point in points:
+        dists = [_haversine_km(point, node) for node in nodes]
+        best = min(range(len(dists)), key=dists.__getitem__)
+        snapped.append((best, dists[best]))
+    return snapped
+
+
+def _road_path(graph: Dict, source: int, target: int) -> Optional[Dict]:
+    # A* por tiempo; la heuristica es la linea recta a la velocidad maxima del grafo
+    key = (source, target)
+    with road_graph_lock:
+        if key in graph["paths"]:
+            return graph["paths"][key]
+    lat, lon, adj = graph["lat"], graph["lon"], graph["adj"]
+    goal = {"lat": lat[target], "lon": lon[target]}
+    min_per_km = 60 / graph["max_speed_kmh"]
+
+    def heuristic(node: int) -> float:
+        return _haversine_km({"lat": lat[node], "lon": lon[node]}, goal) * min_per_km
+
+    best = {source: 0.0}
+    km_to = {source: 0.0}
+    prev: Dict[int, Optional[int]] = {source: None}
+    heap = [(heuristic(source), 0.0, source)]
+    while heap:
+        _f, g, node = heapq.heappop(heap)
+        if node == target:
+            break
+        if g > best[node]:
+            continue
+        for nxt, minutes, km in adj[node]:
+            cost = g + minutes
+            if cost < best.get(nxt, float("inf")):
+                best[nxt] = cost
+                km_to[nxt] = km_to[node] + km
+                prev[nxt] = node
+                heapq.heappush(heap, (cost + heuristic(nxt), cost, nxt))
+    result = None
+    if target in best:
+        nodes = []
+        node: Optional[int] = target
+        while node is not None:
+            nodes.append(node)
+            node = prev[node]
+        nodes.reverse()
+        result = {"minutes": best[target], "km": km_to[target], "nodes": nodes, "at": [best[n] for n in nodes]}
+    with road_graph_lock:
+        paths = graph["paths"]
+        if len(paths) >= ROAD_PATH_CACHE_SIZE:
+            paths.pop(next(iter(paths)), None)
+        paths[key] = result
+    return result
+
+
+def _road_travel(origin: Dict, destination: Dict) -> Optional[Dict]:
+    # Trayecto por carretera entre dos puntos: km, minutos y polilinea [lat, lon, minuto]
+    graph = _load_road_graph()
+    if graph is None:
+        return None
+    (src, src_km), (dst, dst_km) = _snap_points(graph, [origin, destination])
+    if src_km > ROAD_SNAP_MAX_KM or dst_km > ROAD_SNAP_MAX_KM:
+        return None
+    route = _road_path(graph, src, dst)
+    if route is None:
+        return None
+    access_in = src_km * 60 / ROAD_ACCESS_SPEED_KMH
+    total = access_in + route["minutes"] + dst_km * 60 / ROAD_ACCESS_SPEED_KMH
+    path = [[float(origin["lat"]), float(origin["lon"]), 0.0]]
+    path.extend(
+        [graph["lat"][n], graph["lon"][n], round(access_in + at, 2)] for n, at in zip(route["nodes"], route["at"])
+    )
+    path.append([float(destination["lat"]), float(destination["lon"]), round(total, 2)])
+    return {"km": src_km + route["km"] + dst_km, "minutes": total, "path": path}
+
+
+def _road_rows(graph: Dict, source: int, targets: set) -> Tuple[Dict[int, float], Dict[int, float]]:
+    # Dijkstra desde source hasta asentar todos los targets; las filas se reutilizan entre reconstrucciones
+    cached = graph["rows"].get(source)
+    if cached and targets <= cached[0].keys():
+        return cached
+    adj = graph["adj"]
+    best = {source: 0.0}
+    km_to = {source: 0.0}
+    settled: Dict[int, float] = {}
+    settled_km: Dict[int, float] = {}
+    missing = set(targets)
+    heap = [(0.0, source)]
+    while heap and missing:
+        g, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled[node] = g
+        settled_km[node] = km_to[node]
+        missing.discard(node)
+        for nxt, minutes, km in adj[node]:
+            cost = g + minutes
+            if nxt not in settled and cost < best.get(nxt, float("inf")):
+                best[nxt] = cost
+                km_to[nxt] = km_to[node] + km
+                heapq.heappush(heap, (cost, nxt))
+    rows = ({n: settled[n] for n in targets if n in settled}, {n: settled_km[n] for n in targets if n in settled})
+    if not missing:
+        graph["rows"][source] = rows
+    return rows
+
+
+def _road_site_matrix(graph: Dict, sites: List[Tuple[str, float, float]], straight_km):
+    # Minutos y km por carretera entre todos los sitios; los que quedan fuera del grafo van en linea recta
+    snapped = _snap_points(graph, [{"lat": lat, "lon": lon} for _k, lat, lon in sites])
+    n = len(sites)
+    node_of = [node if km <= ROAD_SNAP_MAX_KM else None for node, km in snapped]
+    access_km = [km for _node, km in snapped]
+    uniq = sorted({node for node in node_of if node is not None})
+    if not uniq:
+        minutes = straight_km * 60 / TRUCK_SPEED_KMH if np is not None else [
+            [value * 60 / TRUCK_SPEED_KMH for value in row] for row in straight_km
+        ]
+        return straight_km, minutes
+    pos = {node: i for i, node in enumerate(uniq)}
+    targets = set(uniq)
+    inf = float("inf")
+    node_min = [[inf] * len(uniq) for _ in uniq]
+    node_km = [[inf] * len(uniq) for _ in uniq]
+    for i, source in enumerate(uniq):
+        mins, kms = _road_rows(graph, source, targets)
+        for node, value in mins.items():
+            node_min[i][pos[node]] = value
+            node_km[i][pos[node]] = kms[node]
+    access_speed = 60 / ROAD_ACCESS_SPEED_KMH
+    if np is not None:
+        straight = np.asarray(straight_km, dtype=np.float64)
+        straight_min = straight * 60 / TRUCK_SPEED_KMH
+        on_graph = np.array([node is not None for node in node_of], dtype=bool)
+        idx = np.array([pos[node] if node is not None else 0 for node in node_of], dtype=np.int64)
+        acc = np.array(access_km, dtype=np.float64)
+        block_min = np.array(node_min, dtype=np.float64).reshape(len(uniq), len(uniq))
+        block_km = np.array(node_km, dtype=np.float64).reshape(len(uniq), len(uniq))
+        road_min = block_min[np.ix_(idx, idx)] + (acc[:, None] + acc[None, :]) * access_speed
+        road_km = block_km[np.ix_(idx, idx)] + acc[:, None] + acc[None, :]
+        usable = on_graph[:, None] & on_graph[None, :] & np.isfinite(road_min)
+        minutes = np.where(usable, road_min, straight_min)
+        km = np.where(usable, np.maximum(road_km, straight), straight)
+        np.fill_diagonal(minutes, 0.0)
+        np.fill_diagonal(km, 0.0)
+        return km.astype(np.float32), minutes.astype(np.float32)
+    km = [[0.0] * n for _ in range(n)]
+    minutes = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(n):
+            if i == j:
+                continue
+            a, b = node_of[i], node_of[j]
+            road = node_min[pos[a]][pos[b]] if a is not None and b is not None else inf
+            if road == inf:
+                km[i][j] = straight_km[i][j]
+                minutes[i][j] = straight_km[i][j] * 60 / TRUCK_SPEED_KMH
+                continue
+            extra = access_km[i] + access_km[j]
+            minutes[i][j] = road + extra * access_speed
+            km[i][j] = max(node_km[pos[a]][pos[b]] + extra, straight_km[i][j])
+    return km, minutes
+
+
+def _build_distance_matrix(sites: List[Tuple[str, float, float]]) -> Dict:
+    keys = [key for key, _lat, _lon in sites]
+    index = {key: i for i, key in enumerate(keys)}
+    if np is not None:
+        lats = np.radians(np.array([lat for _k, lat, _lon in sites], dtype=np.float64))
+        lons = np.radians(np.array([lon for _k, _lat, lon in sites], dtype=np.float64))
+        n = len(sites)
+        km = np.empty((n, n), dtype=np.float32)
+        # Por bloques de filas para no crear temporales n x n en float64
+        for start in range(0, n, DISTANCE_MATRIX_BLOCK):
+            stop = min(start + DISTANCE_MATRIX_BLOCK, n)
+            km[start:stop] = _haversine_rows(lats[start:stop], lons[start:stop], lats, lons)
+    else:
+        points = [{"lat": lat, "lon": lon} for _k, lat, lon in sites]
+        km = [[_haversine_km(a, b) for b in points] for a in points]
+    # Con grafo de carreteras los km y minutos salen de la red; sin el, linea recta a TRUCK_SPEED_KMH
+    minutes = None
+    graph = _load_road_graph()
+    if graph is not None:
+        km, minutes = _road_site_matrix(graph, sites, km)
+    return {
+        "keys": keys,
+        "index": index,
+        "locations": {key: {"lat": lat, "lon": lon} for key, lat, lon in sites},
+        "km": km,
+        "minutes": minutes,
+    }
+
+
+def _distance_matrix() -> Dict:
+    sites = _planner_sites()
+    signature = hash((tuple(sites), _road_graph_version()))
+    with distance_matrix_lock:
+        if distance_matrix_cache["signature"] == signature and distance_matrix_cache["matrix"]:
+            return distance_matrix_cache["matrix"]
+    matrix = _build_distance_matrix(sites)
+    with distance_matrix_lock:
+        distance_matrix_cache["signature"] = signature
+        distance_matrix_cache["matrix"] = matrix
+    return matrix
+
+
+def _matrix_km(matrix: Dict, a: str, b: str) -> float:
+    i, j = matrix["index"][a], matrix["index"][b]
+    return float(matrix["km"][i][j])
+
+
+def _matrix_minutes(matrix: Dict, a: str, b: str) -> float:
+    if matrix.get("minutes") is None:
+        return _travel_minutes(_matrix_km(matrix, a, b))
+    i, j = matrix["index"][a], matrix["index"][b]
+    return float(matrix["minutes"][i][j])
+
+
+def _matrix_eta_minutes(matrix: Dict, a: str, b: str) -> int:
+    return max(LEG_MIN_MINUTES, math.ceil(_matrix_minutes(matrix, a, b)))
+
+
+def _nearest_site(matrix: Dict, origin: str, candidates: List[str]) -> int:
+    # Devuelve la posicion en candidates del sitio mas cercano a origin
+    row = matrix["km"][matrix["index"][origin]]
+    cols = [matrix["index"][c] for c in candidates]
+    if np is not None:
+        return int(np.argmin(row[cols]))
+    return min(range(len(cols)), key=lambda i: row[cols[i]])
+
+
+def _nearest_neighbour_order(matrix: Dict, origin: str, keys: List[str]) -> List[int]:
+    # Orden de visita (posiciones en keys) encadenando siempre el sitio mas cercano
+    cols = [matrix["index"][k] for k in keys]
+    order: List[int] = []
+    current = matrix["index"][origin]
+    if np is not None:
+        cols_arr = np.array(cols, dtype=np.int64)
+        visited = np.zeros(len(cols), dtype=bool)
+        for _ in range(len(cols)):
+            dist = matrix["km"][current, cols_arr].astype(np.float64)
+            dist[visited] = np.inf
+            pos = int(np.argmin(dist))
+            visited[pos] = True
+            order.append(pos)
+            current = cols[pos]
+        return order
+    remaining = list(range(len(cols)))
+    while remaining:
+        row = matrix["km"][current]
+        pos = min(remaining, key=lambda i: row[cols[i]])
+        remaining.remove(pos)
+        order.append(pos)
+        current = cols[pos]
+    return order
+
+
+def _spatial_cell(lat: float, lon: float) -> Tuple[int, int]:
+    return math.floor(lat / SPATIAL_CELL_DEG), math.floor(lon / SPATIAL_CELL_DEG)
+
+
+def _rebuild_spatial_index():
+    # Rejilla de celdas de SPATIAL_CELL_DEG grados con centros y depositos (claves de sitio del planificador)
+    cells: Dict[Tuple[int, int], List[str]] = {}
+    points: Dict[str, Tuple[float, float, str, str, Optional[str]]] = {}
+    for center in centers:
+        loc = center["location"]
+        entries = [(_center_site(center["id"]), loc, "center", None)]
+        entries.extend(
+            (_tank_site(center["id"], t["id"]), t.get("location") or loc, "tank", t["id"]) for t in center["tanks"]
+        )
+        for key, where, kind, tank_id in entries:
+            lat, lon = _to_float(where.get("lat")), _to_float(where.get("lon"))
+            if lat is None or lon is None:
+                continue
+            points[key] = (lat, lon, kind, center["id"], tank_id)
+            cells.setdefault(_spatial_cell(lat, lon), []).append(key)
+    bounds = None
+    if cells:
+        rows = [cell[0] for cell in cells]
+        cols = [cell[1] for cell in cells]
+        bounds = (min(rows), min(cols), max(rows), max(cols))
+    with spatial_index_lock:
+        spatial_index["cells"] = cells
+        spatial_index["points"] = points
+        spatial_index["bounds"] = bounds
+        spatial_index["version"] += 1
+
+
+_rebuild_spatial_index()
+
+
+def _spatial_bbox(south: float, west: float, north: float, east: float, kind: Optional[str] = None) -> List[str]:
+    with spatial_index_lock:
+        cells, points, bounds = spatial_index["cells"], spatial_index["points"], spatial_index["bounds"]
+    if bounds is None:
+        return []
+    r0, c0 = _spatial_cell(south, west)
+    r1, c1 = _spatial_cell(north, east)
+    r0, c0 = max(r0, bounds[0]), max(c0, bounds[1])
+    r1, c1 = min(r1, bounds[2]), min(c1, bounds[3])
+    if r0 > r1 or c0 > c1:
+        return []
+    if (r1 - r0 + 1) * (c1 - c0 + 1) > len(cells):
+        # Ventana mayor que la rejilla ocupada: recorrer solo las celdas con puntos
+        candidates = [cell for cell in cells if r0 <= cell[0] <= r1 and c0 <= cell[1] <= c1]
+    else:
+        candidates = [(r, c) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1) if (r, c) in cells]
+    found = []
+    for cell in candidates:
+        for key in cells[cell]:
+            lat, lon, point_kind, _center_id, _tank_id = points[key]
+            if (kind is None or point_kind == kind) and south <= lat <= north and west <= lon <= east:
+                found.append(key)
+    return found
+
+
+def _spatial_snapshot() -> Dict:
+    # Las estructuras se sustituyen enteras al reconstruir, asi que basta con copiar las referencias
+    with spatial_index_lock:
+        return dict(spatial_index)
+
+
+def _install_spatial_snapshot(snapshot: Optional[Dict]):
+    # En los procesos del pool el indice es el del fork; si el padre lo ha reconstruido (sync de Savian) se sustituye
+    if not snapshot:
+        return
+    with spatial_index_lock:
+        if spatial_index["version"] != snapshot["version"]:
+            spatial_index.update(snapshot)
+
+
+def _spatial_point(key: str):
+    with spatial_index_lock:
+        return spatial_index["points"].get(key)
+
+
+def _spatial_nearest(lat: float, lon: float, k: int = 1, kind: Optional[str] = None, accept=None) -> List[Tuple[float, str]]:
+    # Busqueda por anillos de celdas alrededor del punto; devuelve [(km, clave)] de menor a mayor
+    with spatial_index_lock:
+        cells, points, bounds = spatial_index["cells"], spatial_index["points"], spatial_index["bounds"]
+    if bounds is None or k <= 0:
+        return []
+    origin = {"lat": lat, "lon": lon}
+    row, col = _spatial_cell(lat, lon)
+    max_ring = max(abs(row - bounds[0]), abs(row - bounds[2]), abs(col - bounds[1]), abs(col - bounds[3]))
+    # Distancia minima garantizada por cada anillo de celdas (el lado corto de la celda)
+    ring_km = SPATIAL_CELL_DEG * 111.32 * min(1.0, math.cos(math.radians(min(abs(lat) + SPATIAL_CELL_DEG * max_ring, 89.0))))
+    best: List[Tuple[float, str]] = []
+    for ring in range(max_ring + 1):
+        if len(best) >= k and best[-1][0] <= ring_km * (ring - 1):
+            break
+        if ring == 0:
+            ring_cells = [(row, col)]
+        else:
+            ring_cells = [(row - ring, c) for c in range(col - ring, col + ring + 1)]
+            ring_cells += [(row + ring, c) for c in range(col - ring, col + ring + 1)]
+            ring_cells += [(r, col - ring) for r in range(row - ring + 1, row + ring)]
+            ring_cells += [(r, col + ring) for r in range(row - ring + 1, row + ring)]
+        for cell in ring_cells:
+            for key in cells.get(cell, ()):
+                p_lat, p_lon, point_kind, _center_id, _tank_id = points[key]
+                if kind is not None and point_kind != kind:
+                    continue
+                if accept is not None and not accept(key):
+                    continue
+                best.append((_haversine_km(origin, {"lat": p_lat, "lon": p_lon}), key))
+        best.sort()
+        del best[k:]
+    return best
+
+
 def _lerp(a, b, t):
     return a + (b - a) * t
 
 
 def _find_center(center_id: str) -> Optional[Dict]:
-    return next((c for c in centers if c["id"] == center_id), None)
+    return _registry_index("centers").get(center_id)
 
 
 def _find_tank(center_id: str, tank_id: str) -> Optional[Dict]:
-    center = _find_center(center_id)
-    if not center:
-        return None
-    return next((t for t in center["tanks"] if t["id"] == tank_id), None)
+    _registry_index("centers")
+    return registry["tanks"].get((center_id, tank_id))
 
 
 def _iter_tanks():
@@ -879,6 +2967,13 @@ def _flatten_tanks():
     return flat
 
 
+def _tank_hourly_use(tank: Dict) -> float:
+    if tank.get("hourly_use_l") is not None:
+        return _to_float(tank.get("hourly_use_l"), 0.0) or 0.0
+    capacity_l = _to_float(tank.get("capacity_l"), 0.0) or 0.0
+    return capacity_l * DEFAULT_HOURLY_USE_RATIO
+
+
 def _compute_tank_status(tank):
     capacity_l = _to_float(tank.get("capacity_l"), 0.0) or 0.0
     current_l = _to_float(tank.get("current_l"), 0.0) or 0.0
@@ -887,20 +2982,16 @@ def _compute_tank_status(tank):
     pct = current_l / capacity_l if capacity_l else 0
     urgent_threshold = min(max(crit_at, 0.0), 1.0)
     status = "ok"
-    hours_left = None
-    runout_eta = None
 
     if pct <= urgent_threshold:
         status = "critical"
-        hours_left = 48
-        runout_eta = _now() + timedelta(hours=hours_left)
     elif pct <= warn_at:
         status = "warn"
 
-    if hours_left is None:
-        hourly_use = capacity_l * 0.018
-        hours_left = (current_l / hourly_use) if hourly_use else None
-        runout_eta = (_now() + timedelta(hours=hours_left)) if hours_left else None
+    # El agotamiento sale siempre del consumo: el planificador lo usa como fecha limite
+    hourly_use = _tank_hourly_use(tank)
+    hours_left = (current_l / hourly_use) if hourly_use else None
+    runout_eta = (_now() + timedelta(hours=hours_left)) if hours_left is not None else None
 
     return pct, status, runout_eta, hours_left
 
@@ -911,50 +3002,73 @@ def _tank_deficit(tank: Dict) -> int:
     return int(max(capacity_l - current_l, 0))
 
 
-def _reserved_tank_pairs():
+def _reserved_tank_pairs(routes: Optional[List[Dict]] = None):
     pairs = set()
-    for r in active_routes:
-        if r.get("status") == "finalizada":
+    for r in active_routes if routes is None else routes:
+        if r.get("status") in ("finalizada", "eliminada"):
             continue
         for stop in r.get("stops", []):
             pairs.add((stop.get("center_id"), stop.get("tank_id")))
     return pairs
 
 
-def _collect_urgent_centers(reserved: Optional[set] = None):
+def _collect_urgent_centers(
+    reserved: Optional[set] = None,
+    horizon_h: Optional[float] = None,
+    source: Optional[List[Dict]] = None,
+    threshold: Optional[float] = None,
+):
+    return _scan_urgent_centers(reserved, horizon_h, source, threshold)[0]
+
+
+def _urgent_center_entry(center: Dict, tanks: List[Dict], urgent_count: int) -> Dict:
+    return {
+        "center_id": center["id"],
+        "center_name": center["name"],
+        "location": center["location"],
+        "tanks": sorted(tanks, key=lambda t: (t["hours_left"] is None, t["hours_left"] or 0.0)),
+        "total_deficit": sum(t["deficit_l"] for t in tanks),
+        "urgent_count": urgent_count,
+    }
+
+
+def _scan_urgent_centers(
+    reserved: Optional[set] = None,
+    horizon_h: Optional[float] = None,
+    source: Optional[List[Dict]] = None,
+    threshold: Optional[float] = None,
+) -> Tuple[List[Dict], List[Dict]]:
+    # El umbral decide que centros se visitan ya. Los depositos que se agotan dentro del horizonte se suman
+    # a un centro que ya tiene visita; si su centro no la tiene quedan aplazados para las olas siguientes
     reserved = reserved or set()
+    threshold = PLANNER_URGENT_PCT if threshold is None else threshold
     urgent = []
-    for center in centers:
-        urgent_tanks = []
+    deferred = []
+    for center in centers if source is None else source:
+        gated = []
+        upcoming = []
         for tank in center["tanks"]:
+            if (center["id"], tank["id"]) in reserved:
+                continue
             pct, status, runout_eta, hours_left = _compute_tank_status(tank)
-            if pct <= 0.2:
-                if (center["id"], tank["id"]) in reserved:
-                    continue
-                urgent_tanks.append(
-                    {
-                        "id": tank["id"],
-                        "label": tank["label"],
-                        "product": tank["product"],
-                        "percentage": round(pct * 100, 1),
-                        "deficit_l": _tank_deficit(tank),
-                        "runout_eta": runout_eta.isoformat() if runout_eta else None,
-                        "hours_left": hours_left,
-                    }
-                )
-        if urgent_tanks:
-            total_deficit = sum(t["deficit_l"] for t in urgent_tanks)
-            urgent.append(
-                {
-                    "center_id": center["id"],
-                    "center_name": center["name"],
-                    "location": center["location"],
-                    "tanks": urgent_tanks,
-                    "total_deficit": total_deficit,
-                    "urgent_count": len(urgent_tanks),
-                }
-            )
-    return urgent
+            entry = {
+                "id": tank["id"],
+                "label": tank["label"],
+                "product": tank["product"],
+                "percentage": round(pct * 100, 1),
+                "deficit_l": _tank_deficit(tank),
+                "runout_eta": runout_eta.isoformat() if runout_eta else None,
+                "hours_left": hours_left,
+            }
+            if pct <= threshold:
+                gated.append(entry)
+            elif horizon_h and hours_left is not None and hours_left <= horizon_h:
+                upcoming.append(entry)
+        if gated:
+            urgent.append(_urgent_center_entry(center, gated + upcoming, len(gated)))
+        elif upcoming:
+            deferred.append(_urgent_center_entry(center, upcoming, 0))
+    return urgent, deferred
 
 
 def _jitter(value: float, delta: float, min_v: float, max_v: float):
@@ -962,7 +3076,7 @@ def _jitter(value: float, delta: float, min_v: float, max_v: float):
     return max(min_v, min(max_v, round(jittered, 2)))
 
 
-def _simulate_sensors():
+def _simulate_sensors_loop():
     for tank, _center in _iter_tanks():
         sensors = tank["sensors"]
         sensors["ph"] = _jitter(sensors["ph"], 0.08, 5.5, 6.6)
@@ -983,27 +3097,161 @@ def _simulate_sensors():
         sensors["drain_pct"] = int(max(8, min(40, sensors["drain_pct"] + random.randint(-2, 2))))
 
 
-def _simulate_drain():
-    for tank, _center in _iter_tanks():
-        drain = random.randint(160, 420)
-        tank["current_l"] = max(tank["current_l"] - drain, 0)
+# Columna -> (ruta dentro de tank["sensors"], paso minimo, paso maximo, valor minimo, valor maximo, entero)
+SENSOR_SIM_FIELDS = {
+    "ph": (("ph",), -0.08, 0.08, 5.5, 6.6, False),
+    "ec": (("ec",), -0.12, 0.12, 1.8, 3.0, False),
+    "drain_ph": (("drain_ph",), -0.06, 0.06, 5.4, 6.7, False),
+    "drain_ec": (("drain_ec",), -0.1, 0.1, 1.4, 2.8, False),
+    "temp_c": (("climate", "temp_c"), -0.6, 0.6, 19, 35, False),
+    "humidity_pct": (("climate", "humidity_pct"), -2, 2, 48, 85, True),
+    "vpd": (("climate", "vpd"), -0.08, 0.08, 0.5, 1.8, False),
+    "mix_l": (("fertilizer", "mix_l"), -40, 60, 200, 1800, True),
+    "pressure_bar": (("fertilizer", "pressure_bar"), -0.05, 0.05, 1.5, 3.2, False),
+    "drain_pct": (("drain_pct",), -2, 2, 8, 40, True),
+}
+
+
+def _seed_sensor_sim(seed: Optional[int] = None):
+    with sensor_sim_lock:
+        sensor_sim["rng"] = np.random.default_rng(seed) if np is not None else None
+        if seed is not None:
+            random.seed(seed)
+
+
+def _sensor_sim_rng():
+    if sensor_sim["rng"] is None:
+        seed = int(SENSOR_SIM_SEED) if SENSOR_SIM_SEED else None
+        sensor_sim["rng"] = np.random.default_rng(seed)
+    return sensor_sim["rng"]
+
+
+def _sensor_value(sensors: Dict, path: Tuple[str, ...]) -> float:
+    node = sensors
+    for part in path[:-1]:
+        node = node.get(part) or {}
+    return _to_float(node.get(path[-1]), 0.0) or 0.0
+
+
+def _flush_sensor_view_locked():
+    if not sensor_sim["dirty"]:
+        return
+    for name, (path, _lo, _hi, _min_v, _max_v, integer) in SENSOR_SIM_FIELDS.items():
+        values = sensor_sim["cols"][name].tolist()
+        for tank, value in zip(sensor_sim["tanks"], values):
+            node = tank["sensors"]
+            for part in path[:-1]:
+                node = node.setdefault(part, {})
+            node[path[-1]] = int(value) if integer else value
+    sensor_sim["dirty"] = False
+
+
+def _flush_sensor_view():
+    # Las columnas son la fuente de verdad de los sensores; los dicts solo se actualizan al serializar
+    with sensor_sim_lock:
+        _flush_sensor_view_locked()
+
+
+def _sync_sensor_columns(tanks: List[Dict]):
+    # Se reconstruyen las columnas cuando cambia el conjunto de depositos (sync con Savian, restauracion)
+    signature = tuple(id(t["sensors"]) for t in tanks)
+    if signature == sensor_sim["signature"]:
+        return
+    _flush_sensor_view_locked()
+    sensor_sim["tanks"] = tanks
+    sensor_sim["signature"] = signature
+    sensor_sim["cols"] = {
+        name: np.fromiter((_sensor_value(t["sensors"], path) for t in tanks), dtype=np.float64, count=len(tanks))
+        for name, (path, *_rest) in SENSOR_SIM_FIELDS.items()
+    }
+
+
+def _simulate_sensors():
+    if np is None:
+        _simulate_sensors_loop()
+        return
+    tanks = [tank for tank, _center in _iter_tanks()]
+    with sensor_sim_lock:
+        _sync_sensor_columns(tanks)
+        rng = _sensor_sim_rng()
+        n = len(tanks)
+        for name, (_path, lo, hi, min_v, max_v, integer) in SENSOR_SIM_FIELDS.items():
+            col = sensor_sim["cols"][name]
+            if integer:
+                col = col + rng.integers(lo, hi + 1, n)
+            else:
+                col = np.round(col + rng.uniform(lo, hi, n), 2)
+            sensor_sim["cols"][name] = np.clip(col, min_v, max_v)
+        sensor_sim["dirty"] = True
+
+
+def _simulate_drain(hours: Optional[float] = None):
+    # Sin horas, un vaciado aleatorio (boton de demo); con horas, el consumo del modelo en ese intervalo
+    pairs = list(_iter_tanks())
+    if np is None:
+        for tank, _center in pairs:
+            drain = random.randint(160, 420) if hours is None else _tank_hourly_use(tank) * hours
+            tank["current_l"] = max(tank["current_l"] - drain, 0)
+    else:
+        n = len(pairs)
+        levels = np.fromiter((t["current_l"] for t, _c in pairs), dtype=np.float64, count=n)
+        if hours is None:
+            with sensor_sim_lock:
+                drain = _sensor_sim_rng().integers(160, 421, n)
+        else:
+            drain = np.fromiter((_tank_hourly_use(t) for t, _c in pairs), dtype=np.float64, count=n) * hours
+        # El nivel lo leen planificador y alertas directamente del dict: se escribe en un solo paso
+        for (tank, _center), level in zip(pairs, np.maximum(levels - drain, 0.0).tolist()):
+            tank["current_l"] = level
+    _rollup_levels(_reading_epoch(_now()), [(c["id"], t["id"], t["current_l"]) for t, c in pairs])
     _simulate_sensors()
 
 
+def _route_number(route_id) -> int:
+    digits = str(route_id or "").rpartition("-")[2]
+    return int(digits) if digits.isdigit() else 0
+
+
 def _new_route_id():
-    return f"R-{len(active_routes) + len(route_history) + 1:03d}"
+    # Contador atomico: parte del mayor id conocido para no repetir ids tras borrar rutas o recargar
+    with route_id_lock:
+        if route_ids["last"] is None:
+            known = [*active_routes, *route_history]
+            route_ids["last"] = max([len(known), *(_route_number(r.get("id")) for r in known)])
+        route_ids["last"] += 1
+        return f"R-{route_ids['last']:03d}"
 
 
 def _build_leg(origin: Dict, destination: Dict, label: str):
-    km = _haversine_km(origin, destination)
-    eta_minutes = max(8, math.ceil(km / 60 * 60))
-    return {
+    road = _road_travel(origin, destination)
+    if road is None:
+        eta_minutes = _eta_minutes_for_km(_haversine_km(origin, destination))
+    else:
+        eta_minutes = max(LEG_MIN_MINUTES, math.ceil(road["minutes"]))
+    leg = {
         "origin": origin,
         "destination": destination,
         "started_at": _now(),
         "eta_minutes": eta_minutes,
         "label": label,
     }
+    if road is not None:
+        leg["path"] = road["path"]
+    return leg
+
+
+def _position_on_path(path: List[List[float]], progress: float) -> Tuple[float, float]:
+    # path: [lat, lon, minuto acumulado]; interpola por tiempo a lo largo de la polilinea
+    total = path[-1][2]
+    if total <= 0:
+        return path[-1][0], path[-1][1]
+    at = progress * total
+    times = [point[2] for point in path]
+    i = min(max(bisect.bisect_right(times, at), 1), len(path) - 1)
+    a, b = path[i - 1], path[i]
+    span = b[2] - a[2]
+    t = (at - a[2]) / span if span > 0 else 1.0
+    return _lerp(a[0], b[0], t), _lerp(a[1], b[1], t)
 
 
 def _set_leg(route: Dict, truck: Dict, origin: Dict, destination: Dict, label: str):
@@ -1026,40 +3274,38 @@ def _set_leg(route: Dict, truck: Dict, origin: Dict, destination: Dict, label: s
 
 def _update_truck_positions():
     for tr in trucks:
-        route = next((r for r in active_routes if r["id"] == tr.get("route_id")), None)
-        if not route or not route.get("current_leg"):
-            continue
-        leg = route["current_leg"]
-        elapsed = (_now() - leg["started_at"]).total_seconds() / 60
-        progress = min(max(elapsed / leg["eta_minutes"], 0), 1)
-        tr["position"] = {
-            "lat": _lerp(leg["origin"]["lat"], leg["destination"]["lat"], progress),
-            "lon": _lerp(leg["origin"]["lon"], leg["destination"]["lon"], progress),
-            "name": leg["label"],
-        }
-        if progress >= 1 and tr["status"] in ("outbound", "returning"):
-            if route["status"] == "en_ruta":
-                tr["notes"] = "En destino, marca llegada"
-            elif route["status"] == "regresando":
-                tr["notes"] = "Marca llegada a almacen"
-
-
-def _order_centers_by_distance(center_batch: List[Dict], origin: Dict):
-    ordered = []
-    remaining = list(center_batch)
-    current = origin
-    while remaining:
-        nearest = min(remaining, key=lambda c: _haversine_km(current, c["location"]))
-        ordered.append(nearest)
-        remaining.remove(nearest)
-        current = nearest["location"]
-    return ordered
-
-
-def _build_auto_route_for_truck(truck: Dict, center_batch: List[Dict], worker: Optional[str] = None):
+        with _entity_lock("trucks", tr.get("id")):
+            route = _find_route(tr.get("route_id"))
+            if not route or not route.get("current_leg"):
+                continue
+            leg = route["current_leg"]
+            elapsed = (_now() - leg["started_at"]).total_seconds() / 60
+            progress = min(max(elapsed / leg["eta_minutes"], 0), 1)
+            if leg.get("path"):
+                lat, lon = _position_on_path(leg["path"], progress)
+            else:
+                lat = _lerp(leg["origin"]["lat"], leg["destination"]["lat"], progress)
+                lon = _lerp(leg["origin"]["lon"], leg["destination"]["lon"], progress)
+            tr["position"] = {"lat": lat, "lon": lon, "name": leg["label"]}
+            if progress >= 1 and tr["status"] in ("outbound", "returning"):
+                if route["status"] == "en_ruta":
+                    tr["notes"] = "En destino, marca llegada"
+                elif route["status"] == "regresando":
+                    tr["notes"] = "Marca llegada a almacen"
+
+
+def _order_centers_by_distance(
+    center_batch: List[Dict], origin: str = WAREHOUSE_SITE, matrix: Optional[Dict] = None
+):
+    matrix = matrix or _distance_matrix()
+    keys = [_center_site(c["center_id"]) for c in center_batch]
+    return [center_batch[i] for i in _nearest_neighbour_order(matrix, origin, keys)]
+
+
+def _greedy_stops_for_truck(truck: Dict, center_batch: List[Dict], matrix: Optional[Dict] = None) -> List[Dict]:
     if not center_batch:
-        return None
-    ordered_centers = _order_centers_by_distance(center_batch, WAREHOUSE)
+        return []
+    ordered_centers = _order_centers_by_distance(center_batch, _truck_depot_site(truck), matrix)
     stops = []
     remaining_capacity = truck.get("capacity_l", 0)
     first_center_id = None
@@ -1072,40 +3318,44 @@ def _build_auto_route_for_truck(truck: Dict, center_batch: List[Dict], worker: O
         if first_center_id is None:
             first_center_id = center_id
         # No abrir un centro nuevo si solo quedan migajas (<1000 L)
-        if center_id != first_center_id and min(remaining_capacity, center_total_deficit) < 1000:
+        if center_id != first_center_id and min(remaining_capacity, center_total_deficit) < PLANNER_MIN_STOP_L:
             continue
 
         for tank in sorted(center["tanks"], key=lambda t: t.get("deficit_l", 0), reverse=True):
             if remaining_capacity <= 0:
                 break
             liters = min(tank["deficit_l"], remaining_capacity)
-            if center_id != first_center_id and liters < 1000:
+            if center_id != first_center_id and liters < PLANNER_MIN_STOP_L:
                 continue
             if liters <= 0:
                 continue
-            stops.append(
-                {
-                    "center_id": center_id,
-                    "tank_id": tank["id"],
-                    "liters": liters,
-                    "product": tank["product"],
-                    "status": "pendiente",
-                    "arrival_at": None,
-                    "depart_at": None,
-                    "delivered_l": None,
-                }
-            )
+            stops.append(_new_stop(center_id, tank["id"], liters, tank["product"]))
             remaining_capacity -= liters
+    return stops
 
-    if not stops:
-        return None
 
+def _new_stop(center_id: str, tank_id: str, liters, product) -> Stop:
+    return Stop({
+        "center_id": center_id,
+        "tank_id": tank_id,
+        "liters": liters,
+        "product": product,
+        "status": "pendiente",
+        "arrival_at": None,
+        "depart_at": None,
+        "delivered_l": None,
+    })
+
+
+def _make_auto_route(truck: Dict, stops: List[Dict], worker: Optional[str] = None) -> Route:
     planned_load = sum(s["liters"] for s in stops)
-    route = {
+    depot = _truck_depot(truck)
+    return Route({
         "id": _new_route_id(),
         "worker": worker,
         "truck_id": truck["id"],
-        "origin": WAREHOUSE["name"],
+        "depot_id": depot["id"],
+        "origin": depot["name"],
         "product_type": "Multiproducto",
         "stops": stops,
         "status": "planificada",
@@ -1126,51 +3376,1077 @@ def _build_auto_route_for_truck(truck: Dict, center_batch: List[Dict], worker: O
         "auto_generated": True,
         "pending_worker": not bool(worker),
         "planned_load_l": planned_load,
-    }
-    return route
+    })
 
 
-def _auto_plan_urgent_routes():
-    reserved = _reserved_tank_pairs()
-    urgent = sorted(
-        _collect_urgent_centers(reserved),
-        key=lambda c: (c.get("urgent_count", 0), c["total_deficit"]),
-        reverse=True,
-    )
-    available_trucks = [
-        t for t in trucks if t["status"] == "parked" and not t.get("route_id") and t.get("capacity_l")
-    ]
-    if not urgent or not available_trucks:
-        return []
+def _build_auto_route_for_truck(
+    truck: Dict, center_batch: List[Dict], worker: Optional[str] = None, matrix: Optional[Dict] = None
+):
+    stops = _greedy_stops_for_truck(truck, center_batch, matrix)
+    if not stops:
+        return None
+    return _make_auto_route(truck, stops, worker)
 
-    worker_pool = list(WORKERS.keys())
-    random.shuffle(worker_pool)
 
+def _greedy_plan(urgent: List[Dict], available_trucks: List[Dict], matrix: Dict) -> List[Tuple[Dict, List[Dict]]]:
+    pending = {_center_site(c["center_id"]): c for c in urgent}
     assignments = {t["id"]: [] for t in available_trucks}
 
     # Asignar un centro prioritario a cada camion (prioriza centros con mas tanques en alerta)
     for tr in available_trucks:
-        if urgent:
-            assignments[tr["id"]].append(urgent.pop(0))
+        if pending:
+            assignments[tr["id"]].append(pending.pop(next(iter(pending))))
 
     # Repartir el resto intentando agrupar centros cercanos en la misma ruta
     idx = 0
-    while urgent:
+    while pending:
         tr = available_trucks[idx % len(available_trucks)]
         idx += 1
         batch = assignments.get(tr["id"], [])
-        last_loc = batch[-1]["location"] if batch else WAREHOUSE
-        nearest_idx = min(range(len(urgent)), key=lambda i: _haversine_km(last_loc, urgent[i]["location"]))
-        batch.append(urgent.pop(nearest_idx))
+        last_site = _center_site(batch[-1]["center_id"]) if batch else _truck_depot_site(tr)
+        batch.append(pending.pop(_nearest_pending_site(matrix, last_site, pending)))
         assignments[tr["id"]] = batch
 
+    plans = []
+    for tr in available_trucks:
+        stops = _greedy_stops_for_truck(tr, assignments.get(tr["id"], []), matrix)
+        if stops:
+            plans.append((tr, stops))
+    return plans
+
+
+def _nearest_pending_site(matrix: Dict, origin: str, pending: Dict[str, Dict]) -> str:
+    # Candidatos por cercania en linea recta desde el indice espacial; decide la matriz (carretera)
+    loc = matrix["locations"].get(origin)
+    candidates = []
+    if loc is not None:
+        candidates = [
+            key
+            for _km, key in _spatial_nearest(
+                loc["lat"], loc["lon"], PLANNER_NEAREST_CANDIDATES, "center", pending.__contains__
+            )
+            if key in matrix["index"]
+        ]
+    if not candidates:
+        candidates = list(pending)
+    return candidates[_nearest_site(matrix, origin, candidates)]
+
+
+def _demand_nodes(urgent: List[Dict], max_capacity: float) -> List[Dict]:
+    nodes = []
+    for center in urgent:
+        for tank in center.get("tanks", []):
+            demand = int(min(_to_float(tank.get("deficit_l"), 0.0) or 0.0, max_capacity))
+            if demand <= 0:
+                continue
+            hours_left = _to_float(tank.get("hours_left"))
+            nodes.append(
+                {
+                    "site": _tank_site(center["center_id"], tank["id"]),
+                    "center_id": center["center_id"],
+                    "tank_id": tank["id"],
+                    "product": tank.get("product"),
+                    "demand": demand,
+                    "due_min": hours_left * 60 if hours_left is not None else float("inf"),
+                }
+            )
+    return nodes
+
+
+def _travel_minutes(km: float) -> float:
+    return km * 60 / TRUCK_SPEED_KMH
+
+
+def _local_distances(matrix: Dict, sites: List[str], key: str = "km"):
+    idx = [matrix["index"][site] for site in sites]
+    if np is not None:
+        return matrix[key][np.ix_(idx, idx)].astype(np.float64)
+    return [[matrix[key][i][j] for j in idx] for i in idx]
+
+
+def _local_travel_minutes(matrix: Dict, sites: List[str]) -> List[List[float]]:
+    if matrix.get("minutes") is not None:
+        minutes = _local_distances(matrix, sites, "minutes")
+        return minutes.tolist() if np is not None else minutes
+    km = _local_distances(matrix, sites)
+    if np is not None:
+        return _travel_minutes(km).tolist()
+    return [[_travel_minutes(value) for value in row] for row in km]
+
+
+def _planner_ctx(matrix: Dict, sites: List[str], due: List[float], start_min: float = 0.0) -> Dict:
+    km = _local_distances(matrix, sites)
+    # Las listas de Python son mas rapidas que los escalares numpy en la busqueda local
+    return {
+        "km": km,
+        "dist": km.tolist() if np is not None else km,
+        "travel": _local_travel_minutes(matrix, sites),
+        "due": due,
+        "start_min": start_min,
+    }
+
+
+def _savings_pairs(dist, n: int) -> List[Tuple[int, int]]:
+    # Ahorro Clarke-Wright s(i, j) = d(0, i) + d(0, j) - d(i, j), de mayor a menor
+    if n < 2:
+        return []
+    if np is not None:
+        d = np.asarray(dist, dtype=np.float64)
+        d0 = d[0, 1:]
+        inner = d[1:, 1:]
+        k = PLANNER_SAVINGS_NEIGHBOURS
+        if n > 2 * k:
+            # Vecindario granular: solo se emparejan depositos con sus k vecinos mas cercanos
+            masked = inner.copy()
+            np.fill_diagonal(masked, np.inf)
+            neighbours = np.argpartition(masked, k, axis=1)[:, :k]
+            rows = np.repeat(np.arange(n), k)
+            cols = neighbours.ravel()
+            keys = np.unique(np.minimum(rows, cols) * n + np.maximum(rows, cols))
+            rows, cols = keys // n, keys % n
+        else:
+            rows, cols = np.triu_indices(n, k=1)
+        values = d0[rows] + d0[cols] - inner[rows, cols]
+        order = np.argsort(-values, kind="stable")
+        order = order[values[order] > 0]
+        return list(zip((rows[order] + 1).tolist(), (cols[order] + 1).tolist()))
+    pairs = []
+    for i in range(1, n + 1):
+        for j in range(i + 1, n + 1):
+            saving = dist[0][i] + dist[0][j] - dist[i][j]
+            if saving > 0:
+                pairs.append((saving, i, j))
+    pairs.sort(key=lambda item: -item[0])
+    return [(i, j) for _saving, i, j in pairs]
+
+
+def _route_km(dist: List[List[float]], route: List[int]) -> float:
+    if not route:
+        return 0.0
+    total = dist[0][route[0]] + dist[route[-1]][0]
+    for a, b in zip(route, route[1:]):
+        total += dist[a][b]
+    return total
+
+
+def _route_timing(ctx: Dict, route: List[int]) -> Tuple[float, float, List[float]]:
+    # Devuelve (minuto de regreso al almacen, minutos de retraso acumulados, llegadas por parada)
+    travel, due = ctx["travel"], ctx["due"]
+    t = ctx["start_min"]
+    prev = 0
+    late = 0.0
+    arrivals = []
+    for node in route:
+        t += travel[prev][node]
+        arrivals.append(t)
+        if t > due[node]:
+            late += t - due[node]
+        t += PLANNER_STOP_SERVICE_MIN
+        prev = node
+    if route:
+        t += travel[prev][0]
+    return t, late, arrivals
+
+
+def _route_late(ctx: Dict, route: List[int]) -> float:
+    return _route_timing(ctx, route)[1]
+
+
+def _route_cost(ctx: Dict, route: List[int]) -> float:
+    return _route_km(ctx["dist"], route) + PLANNER_LATE_PENALTY_KM * _route_late(ctx, route)
+
+
+def _savings_routes(ctx: Dict, liters: Dict[int, float], cap_limit: float) -> List[List[int]]:
+    routes = {node: [node] for node in liters}
+    route_of = {node: node for node in liters}
+    load = dict(liters)
+    late = {node: _route_late(ctx, [node]) for node in liters}
+    for i, j in _savings_pairs(ctx["km"], len(ctx["dist"]) - 1):
+        ri, rj = route_of[i], route_of[j]
+        if ri == rj or load[ri] + load[rj] > cap_limit:
+            continue
+        a, b = routes[ri], routes[rj]
+        # Solo se unen rutas por sus extremos: ...-i con j-...
+        if a[-1] == i:
+            head = a
+        elif a[0] == i:
+            head = a[::-1]
+        else:
+            continue
+        if b[0] == j:
+            tail = b
+        elif b[-1] == j:
+            tail = b[::-1]
+        else:
+            continue
+        merged = head + tail
+        merged_late = _route_late(ctx, merged)
+        # No se aceptan uniones que dejen algun deposito sin producto mas tarde que antes
+        if merged_late > late[ri] + late[rj] + 1e-6:
+            continue
+        routes[ri] = merged
+        load[ri] += load.pop(rj)
+        late[ri] = merged_late
+        late.pop(rj)
+        for node in tail:
+            route_of[node] = ri
+        del routes[rj]
+    return list(routes.values())
+
+
+def _two_opt(ctx: Dict, route: List[int], deadline: float) -> bool:
+    changed = False
+    improved = True
+    best = _route_cost(ctx, route)
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(len(route) - 1):
+            for k in range(i + 1, len(route)):
+                candidate = route[:i] + route[i : k + 1][::-1] + route[k + 1 :]
+                cost = _route_cost(ctx, candidate)
+                if cost < best - 1e-9:
+                    route[:] = candidate
+                    best = cost
+                    improved = changed = True
+    return changed
+
+
+def _or_opt(ctx: Dict, route: List[int], deadline: float) -> bool:
+    # Mueve segmentos de 1 a 3 paradas a la mejor posicion dentro de la misma ruta
+    changed = False
+    for seg_len in (1, 2, 3):
+        i = 0
+        while i + seg_len <= len(route) and time.perf_counter() < deadline:
+            best = _route_cost(ctx, route)
+            segment = route[i : i + seg_len]
+            rest = route[:i] + route[i + seg_len :]
+            best_pos = None
+            for pos in range(len(rest) + 1):
+                if pos == i:
+                    continue
+                cost = _route_cost(ctx, rest[:pos] + segment + rest[pos:])
+                if cost < best - 1e-9:
+                    best, best_pos = cost, pos
+            if best_pos is not None:
+                route[:] = rest[:best_pos] + segment + rest[best_pos:]
+                changed = True
+            i += 1
+    return changed
+
+
+def _best_insertion(ctx: Dict, route: List[int], node: int) -> Tuple[float, int]:
+    base = _route_cost(ctx, route)
+    best_delta, best_pos = float("inf"), 0
+    for pos in range(len(route) + 1):
+        delta = _route_cost(ctx, route[:pos] + [node] + route[pos:]) - base
+        if delta < best_delta:
+            best_delta, best_pos = delta, pos
+    return best_delta, best_pos
+
+
+def _relocate(
+    ctx: Dict,
+    routes: List[List[int]],
+    liters: Dict[int, float],
+    caps: List[float],
+    deadline: float,
+) -> bool:
+    # Mueve una parada a otra ruta si cabe en el camion y baja el coste total
+    changed = False
+    loads = [sum(liters[n] for n in r) for r in routes]
+    costs = [_route_cost(ctx, r) for r in routes]
+    for src, route in enumerate(routes):
+        pos = 0
+        while pos < len(route) and len(route) > 1 and time.perf_counter() < deadline:
+            node = route[pos]
+            reduced = route[:pos] + route[pos + 1 :]
+            removal_gain = costs[src] - _route_cost(ctx, reduced)
+            best = (-1e-9, None, None)
+            for dst, other in enumerate(routes):
+                if dst == src or loads[dst] + liters[node] > caps[dst]:
+                    continue
+                delta, ins = _best_insertion(ctx, other, node)
+                if delta - removal_gain < best[0]:
+                    best = (delta - removal_gain, dst, ins)
+            if best[1] is not None:
+                _gain, dst, ins = best
+                route[:] = reduced
+                routes[dst].insert(ins, node)
+                loads[src] -= liters[node]
+                loads[dst] += liters[node]
+                costs[src] = _route_cost(ctx, route)
+                costs[dst] = _route_cost(ctx, routes[dst])
+                changed = True
+                continue
+            pos += 1
+    return changed
+
+
+def _improve_routes(
+    ctx: Dict,
+    routes: List[List[int]],
+    liters: Dict[int, float],
+    caps: List[float],
+    deadline: float,
+):
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for route in routes:
+            improved |= _two_opt(ctx, route, deadline)
+            improved |= _or_opt(ctx, route, deadline)
+        improved |= _relocate(ctx, routes, liters, caps, deadline)
+
+
+def _fill_spare_capacity(
+    ctx: Dict,
+    routes: List[List[int]],
+    liters: Dict[int, float],
+    caps: List[float],
+    unserved: Dict[int, float],
+):
+    # Completa camiones con huecos usando la insercion mas barata; admite descargas parciales
+    # pero no desvios que empeoren demasiado los km por litro de la ruta ni retrasos nuevos
+    dist = ctx["dist"]
+    for idx, route in enumerate(routes):
+        load = sum(liters[n] for n in route)
+        spare = caps[idx] - load
+        max_km_per_l = _route_km(dist, route) / load * PLANNER_FILL_DETOUR_FACTOR if load else float("inf")
+        while spare >= PLANNER_MIN_STOP_L and unserved:
+            base_km = _route_km(dist, route)
+            base_late = _route_late(ctx, route)
+            candidates = []
+            for node, pending in unserved.items():
+                amount = min(pending, spare)
+                if amount < min(PLANNER_MIN_STOP_L, pending):
+                    continue
+                _delta, pos = _best_insertion(ctx, route, node)
+                candidate = route[:pos] + [node] + route[pos:]
+                extra_km = _route_km(dist, candidate) - base_km
+                if extra_km / amount > max_km_per_l or _route_late(ctx, candidate) > base_late + 1e-6:
+                    continue
+                candidates.append((extra_km / amount, node, pos, amount))
+            if not candidates:
+                break
+            _score, node, pos, amount = min(candidates)
+            route.insert(pos, node)
+            liters[node] = amount
+            spare -= amount
+            del unserved[node]
+
+
+def _vrp_plan(
+    urgent: List[Dict],
+    available_trucks: List[Dict],
+    matrix: Dict,
+    time_budget_s: Optional[float] = None,
+    start_min: float = 0.0,
+) -> List[Tuple[Dict, List[Dict]]]:
+    budget = PLANNER_TIME_BUDGET_S if time_budget_s is None else time_budget_s
+    deadline = time.perf_counter() + max(budget, 0.0)
+    fleet = sorted(available_trucks, key=lambda t: t.get("capacity_l", 0), reverse=True)
+    max_capacity = fleet[0].get("capacity_l", 0) if fleet else 0
+    nodes = _demand_nodes(urgent, max_capacity)
+    if not nodes or not max_capacity:
+        return []
+    # Con muchos depositos pendientes solo entran los que vencen antes, hasta
+    # PLANNER_CANDIDATE_FACTOR veces la capacidad de los camiones de esta ola
+    nodes.sort(key=lambda node: node["due_min"])
+    limit = PLANNER_CANDIDATE_FACTOR * sum(t.get("capacity_l", 0) for t in fleet)
+    accumulated = 0
+    for cut, node in enumerate(nodes, start=1):
+        accumulated += node["demand"]
+        if accumulated >= limit:
+            nodes = nodes[:cut]
+            break
+
+    # Indice 0 = almacen de la flota (todos los camiones de una llamada salen del mismo); 1..n = depositos
+    ctx = _planner_ctx(
+        matrix,
+        [_truck_depot_site(fleet[0])] + [node["site"] for node in nodes],
+        [float("inf")] + [node["due_min"] for node in nodes],
+        start_min,
+    )
+    dist = ctx["dist"]
+    demand = {i + 1: node["demand"] for i, node in enumerate(nodes)}
+    liters = dict(demand)
+
+    # Construccion por ahorros; con flota limitada se asignan antes las rutas que vencen antes
+    # y, dentro del mismo tramo de vencimiento, las que mas litros mueven por km
+    def _priority(route):
+        due_bucket = min(ctx["due"][n] for n in route) // PLANNER_DUE_BUCKET_MIN
+        return (due_bucket, -sum(demand[n] for n in route) / max(_route_km(dist, route), 0.1))
+
+    candidates = sorted(_savings_routes(ctx, demand, max_capacity), key=_priority)
+    free_trucks = list(fleet)
+    routes: List[List[int]] = []
+    route_trucks: List[Dict] = []
+    unserved: Dict[int, float] = {}
+    for route in candidates:
+        if not free_trucks:
+            unserved.update({n: demand[n] for n in route})
+            continue
+        load = sum(demand[n] for n in route)
+        fitting = [t for t in free_trucks if t.get("capacity_l", 0) >= load]
+        if fitting:
+            truck = fitting[-1]
+        else:
+            truck = free_trucks[0]
+            capacity = truck.get("capacity_l", 0)
+            while len(route) > 1 and load > capacity:
+                # Se aparta el deposito que mas tarde se queda sin producto
+                latest = max(route, key=lambda n: (ctx["due"][n], -demand[n]))
+                route.remove(latest)
+                load -= demand[latest]
+                unserved[latest] = demand[latest]
+            if load > capacity:
+                # Un solo deposito con mas deficit que el camion: descarga parcial
+                liters[route[0]] = capacity
+        free_trucks.remove(truck)
+        routes.append(route)
+        route_trucks.append(truck)
+
+    caps = [t.get("capacity_l", 0) for t in route_trucks]
+    _improve_routes(ctx, routes, liters, caps, deadline)
+    _fill_spare_capacity(ctx, routes, liters, caps, unserved)
+    _improve_routes(ctx, routes, liters, caps, deadline)
+
+    plans = []
+    for truck, route in zip(route_trucks, routes):
+        stops = [
+            _new_stop(nodes[n - 1]["center_id"], nodes[n - 1]["tank_id"], liters[n], nodes[n - 1]["product"])
+            for n in route
+        ]
+        if stops:
+            plans.append((truck, stops))
+    return plans
+
+
+def _plan_metrics(plans: List[Tuple[Dict, List[Dict]]], matrix: Dict) -> Dict:
+    total_km = 0.0
+    planned_l = 0.0
+    capacity_l = 0.0
+    stops_count = 0
+    for truck, stops in plans:
+        depot_site = _truck_depot_site(truck)
+        sites = [depot_site] + [_tank_site(s["center_id"], s["tank_id"]) for s in stops] + [depot_site]
+        total_km += sum(_matrix_km(matrix, a, b) for a, b in zip(sites, sites[1:]))
+        planned_l += sum(s["liters"] for s in stops)
+        capacity_l += truck.get("capacity_l", 0) or 0
+        stops_count += len(stops)
+    return {
+        "routes": len(plans),
+        "stops": stops_count,
+        "planned_l": round(planned_l, 1),
+        "total_km": round(total_km, 1),
+        "fill_rate": round(planned_l / capacity_l, 3) if capacity_l else 0.0,
+    }
+
+
+def _trip_timing(
+    stops: List[Dict], start_min: float, matrix: Dict, depot_site: str = WAREHOUSE_SITE
+) -> Tuple[float, List[float]]:
+    t = start_min
+    prev = depot_site
+    arrivals = []
+    for stop in stops:
+        site = _tank_site(stop["center_id"], stop["tank_id"])
+        t += _matrix_minutes(matrix, prev, site)
+        arrivals.append(t)
+        t += PLANNER_STOP_SERVICE_MIN
+        prev = site
+    if stops:
+        t += _matrix_minutes(matrix, prev, depot_site)
+    return t, arrivals
+
+
+def _consume_pending(pending: List[Dict], stops: List[Dict]):
+    served = {}
+    for stop in stops:
+        key = (stop["center_id"], stop["tank_id"])
+        served[key] = served.get(key, 0) + (stop.get("liters") or 0)
+    for center in pending:
+        kept = []
+        for tank in center["tanks"]:
+            remaining = tank["deficit_l"] - served.get((center["center_id"], tank["id"]), 0)
+            if (center["center_id"], tank["id"]) in served and remaining < PLANNER_MIN_STOP_L:
+                continue
+            tank["deficit_l"] = remaining
+            kept.append(tank)
+        center["tanks"] = kept
+        center["urgent_count"] = len(kept)
+        center["total_deficit"] = sum(t["deficit_l"] for t in kept)
+    pending[:] = [c for c in pending if c["tanks"]]
+
+
+def _schedule_horizon(
+    engine: str,
+    urgent: List[Dict],
+    available_trucks: List[Dict],
+    matrix: Dict,
+    horizon_h: float,
+    time_budget_s: Optional[float] = None,
+    deferred: Optional[List[Dict]] = None,
+):
+    # Encadena olas de viajes hasta el horizonte: cada camion vuelve a salir al regresar al almacen.
+    # La primera ola es la que se convierte en rutas; el resto sirve para medir retrasos y viajes.
+    # Los centros aplazados (se agotan en el horizonte sin pasar el umbral) entran desde la segunda ola;
+    # sin primera ola no hay viajes para ellos y salen en el informe como depositos en riesgo
+    budget = PLANNER_TIME_BUDGET_S if time_budget_s is None else time_budget_s
+    deadline = time.perf_counter() + budget
+    horizon_min = horizon_h * 60
+    pending = deepcopy(urgent)
+    later = deepcopy(deferred or [])
+    deferred_keys = {(c["center_id"], t["id"]) for c in later for t in c["tanks"]}
+    due = {
+        (c["center_id"], t["id"]): (t["hours_left"] * 60 if t.get("hours_left") is not None else float("inf"))
+        for c in urgent + (deferred or [])
+        for t in c["tanks"]
+    }
+    by_id = {t["id"]: t for t in available_trucks}
+    free_at = {t["id"]: 0.0 for t in available_trucks}
+    first_wave: List[Tuple[Dict, List[Dict]]] = []
+    trips = []
+    arrival_by_tank: Dict[Tuple[str, str], float] = {}
+    wave_idx = 0
+    while free_at:
+        if later and wave_idx:
+            pending.extend(later)
+            later = []
+            if engine != "greedy":
+                pending.sort(key=_center_earliest_runout_h)
+        if not pending:
+            break
+        first_free = min(free_at.values())
+        if wave_idx and first_free >= horizon_min:
+            break
+        # Los camiones que vuelven dentro de la misma ventana salen juntos
+        wave = [by_id[tid] for tid, ts in free_at.items() if ts <= first_free + PLANNER_WAVE_WINDOW_MIN]
+        start_min = max(free_at[t["id"]] for t in wave)
+        if engine == "greedy":
+            plans = _greedy_plan(pending, wave, matrix)
+        else:
+            # La primera ola (la que se ejecuta) se lleva la mitad del presupuesto; las siguientes,
+            # una cuarta parte de lo que quede cada una
+            remaining_s = max(deadline - time.perf_counter(), 0.0)
+            wave_budget = budget / 2 if wave_idx == 0 else remaining_s / 4
+            plans = _vrp_plan(pending, wave, matrix, wave_budget, start_min=start_min)
+        if not plans:
+            break
+        if wave_idx == 0:
+            first_wave = plans
+        for truck, stops in plans:
+            end_min, arrivals = _trip_timing(stops, start_min, matrix, _truck_depot_site(truck))
+            for stop, arrival in zip(stops, arrivals):
+                arrival_by_tank.setdefault((stop["center_id"], stop["tank_id"]), arrival)
+            trips.append({"truck_id": truck["id"], "start_min": start_min, "end_min": end_min})
+            free_at[truck["id"]] = end_min
+            _consume_pending(pending, stops)
+        used = {truck["id"] for truck, _stops in plans}
+        for truck in wave:
+            if truck["id"] not in used:
+                # Sin trabajo util para este camion en esta ola
+                free_at.pop(truck["id"], None)
+        wave_idx += 1
+
+    now = _now()
+    late = []
+    for key, due_min in due.items():
+        if due_min >= horizon_min and key not in arrival_by_tank:
+            continue
+        arrival = arrival_by_tank.get(key)
+        if arrival is None or arrival > due_min:
+            late.append(
+                {
+                    "center_id": key[0],
+                    "tank_id": key[1],
+                    "runout_eta": (now + timedelta(minutes=due_min)).isoformat(),
+                    "arrival_eta": (now + timedelta(minutes=arrival)).isoformat() if arrival is not None else None,
+                    "deferred": key in deferred_keys,
+                }
+            )
+    late.sort(key=lambda item: item["runout_eta"])
+    schedule = {
+        "horizon_h": horizon_h,
+        "trips": len(trips),
+        "waves": wave_idx,
+        "late_tanks": len(late),
+        "late": late[:50],
+    }
+    return first_wave, schedule
+
+
+def _center_earliest_runout_h(center: Dict) -> float:
+    hours = [t["hours_left"] for t in center["tanks"] if t.get("hours_left") is not None]
+    return min(hours) if hours else float("inf")
+
+
+def _group_by_depot(fleet: List[Dict]) -> Dict[str, List[Dict]]:
+    groups: Dict[str, List[Dict]] = {}
+    for truck in fleet:
+        groups.setdefault(_truck_depot(truck)["id"], []).append(truck)
+    return groups
+
+
+def _center_depots(matrix: Dict, center_ids: List[str], depot_ids: Optional[List[str]] = None) -> Dict[str, str]:
+    # Cada centro se asigna al almacen (de los que tienen camiones) mas cercano por la matriz
+    depot_ids = depot_ids or [d["id"] for d in DEPOTS]
+    if len(depot_ids) == 1:
+        return {center_id: depot_ids[0] for center_id in center_ids}
+    depot_sites = [_depot_site(depot_id) for depot_id in depot_ids]
+    return {
+        center_id: depot_ids[_nearest_site(matrix, _center_site(center_id), depot_sites)] for center_id in center_ids
+    }
+
+
+def _depot_available_l(
+    depot_id: str,
+    fleet: Optional[List[Dict]] = None,
+    routes: Optional[List[Dict]] = None,
+    stock: Optional[Dict[str, float]] = None,
+) -> Optional[float]:
+    # Stock del almacen menos lo ya reservado en rutas planificadas que aun no han cargado
+    depot = _find_depot(depot_id)
+    stock_l = (stock or {}).get(depot["id"], depot.get("stock_l"))
+    if stock_l is None:
+        return None
+    depot_trucks = {t["id"] for t in (trucks if fleet is None else fleet) if _truck_depot(t)["id"] == depot["id"]}
+    reserved = sum(
+        r.get("planned_load_l") or 0
+        for r in (active_routes if routes is None else routes)
+        if r.get("status") == "planificada" and r.get("truck_id") in depot_trucks
+    )
+    return max(stock_l - reserved, 0.0)
+
+
+def _cap_plans_to_stock(
+    plans: List[Tuple[Dict, List[Dict]]], depot_id: str, available: Optional[float] = None
+) -> List[Tuple[Dict, List[Dict]]]:
+    available = _depot_available_l(depot_id) if available is None else available
+    if available is None:
+        return plans
+    capped = []
+    for truck, stops in plans:
+        kept = []
+        for stop in stops:
+            liters = min(stop["liters"], available)
+            if liters < min(PLANNER_MIN_STOP_L, stop["liters"]):
+                continue
+            kept.append({**stop, "liters": liters})
+            available -= liters
+        if kept:
+            capped.append((truck, kept))
+    return capped
+
+
+def _submatrix(matrix: Dict, keys: List[str]) -> Dict:
+    # Recorte de la matriz para una particion: es lo que viaja al proceso del pool
+    idx = [matrix["index"][key] for key in keys]
+    minutes = matrix.get("minutes")
+    if np is not None:
+        km = np.ascontiguousarray(matrix["km"][np.ix_(idx, idx)])
+        minutes = np.ascontiguousarray(minutes[np.ix_(idx, idx)]) if minutes is not None else None
+    else:
+        km = [[matrix["km"][i][j] for j in idx] for i in idx]
+        minutes = [[minutes[i][j] for j in idx] for i in idx] if minutes is not None else None
+    return {
+        "keys": keys,
+        "index": {key: i for i, key in enumerate(keys)},
+        "locations": {key: matrix["locations"][key] for key in keys},
+        "km": km,
+        "minutes": minutes,
+    }
+
+
+def _partition_jobs(
+    engine: str,
+    urgent: List[Dict],
+    available_trucks: List[Dict],
+    matrix: Dict,
+    horizon_h: float,
+    time_budget_s: Optional[float],
+    snapshot: Optional[Dict] = None,
+    deferred: Optional[List[Dict]] = None,
+    compare: bool = False,
+) -> List[Dict]:
+    snapshot = snapshot or {}
+    deferred = deferred or []
+    fleets = _group_by_depot(available_trucks)
+    assigned = _center_depots(matrix, [c["center_id"] for c in urgent + deferred], list(fleets))
+    jobs = []
+    for depot_id, fleet in fleets.items():
+        depot_urgent = [c for c in urgent if assigned[c["center_id"]] == depot_id]
+        depot_deferred = [c for c in deferred if assigned[c["center_id"]] == depot_id]
+        if not depot_urgent and not depot_deferred:
+            continue
+        keys = [_depot_site(depot_id)]
+        for center in depot_urgent + depot_deferred:
+            keys.append(_center_site(center["center_id"]))
+            keys.extend(_tank_site(center["center_id"], t["id"]) for t in center["tanks"])
+        jobs.append(
+            {
+                "depot_id": depot_id,
+                "engine": engine,
+                "urgent": depot_urgent,
+                "deferred": depot_deferred,
+                "trucks": fleet,
+                "matrix": _submatrix(matrix, keys) if len(fleets) > 1 else matrix,
+                "horizon_h": horizon_h,
+                "time_budget_s": time_budget_s,
+                "compare": compare,
+                "spatial": _spatial_snapshot(),
+                "available_l": _depot_available_l(
+                    depot_id, snapshot.get("trucks"), snapshot.get("active_routes"), snapshot.get("stock")
+                ),
+            }
+        )
+    return jobs
+
+
+def _plan_partition(job: Dict) -> Dict:
+    # Se ejecuta en el pool de procesos: solo usa lo que trae el job, nunca el estado global mutable
+    _install_spatial_snapshot(job.get("spatial"))
+    matrix = job["matrix"]
+    result = {"depot_id": job["depot_id"]}
+    if job["engine"] == "greedy" or job.get("compare"):
+        # La comparacion con greedy solo se calcula si se pide: es otra pasada completa sobre el horizonte
+        baseline_urgent = sorted(
+            job["urgent"], key=lambda c: (c.get("urgent_count", 0), c["total_deficit"]), reverse=True
+        )
+        greedy, baseline_schedule = _schedule_horizon(
+            "greedy", baseline_urgent, job["trucks"], matrix, job["horizon_h"], deferred=job.get("deferred")
+        )
+        result["baseline"] = [(truck["id"], stops) for truck, stops in greedy]
+        result["baseline_schedule"] = baseline_schedule
+    if job["engine"] == "greedy":
+        plans, schedule = greedy, baseline_schedule
+    else:
+        plans, schedule = _schedule_horizon(
+            job["engine"],
+            job["urgent"],
+            job["trucks"],
+            matrix,
+            job["horizon_h"],
+            job["time_budget_s"],
+            job.get("deferred"),
+        )
+    plans = _cap_plans_to_stock(plans, job["depot_id"], job["available_l"])
+    result["plans"] = [(truck["id"], stops) for truck, stops in plans]
+    result["schedule"] = schedule
+    return result
+
+
+def _planner_worker_init():
+    # Tras el fork los locks se copian tal cual; si otro hilo tenia uno cogido el hijo se bloquearia
+    global spatial_index_lock, road_graph_lock, distance_matrix_lock, planner_lock
+    spatial_index_lock = threading.Lock()
+    road_graph_lock = threading.Lock()
+    distance_matrix_lock = threading.Lock()
+    planner_lock = threading.Lock()
+
+
+def _start_planner_pool():
+    # Se llama al importar el modulo, antes de que Flask arranque hilos: con fork todos los procesos se
+    # lanzan en el primer submit, asi que se bifurcan de un proceso sin locks cogidos. Nunca se recrea
+    # despues; si el pool se rompe se planifica en serie
+    if PLANNER_WORKERS <= 1:
+        return
+    executor = ProcessPoolExecutor(
+        max_workers=PLANNER_WORKERS,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_planner_worker_init,
+    )
+    try:
+        executor.submit(int).result()
+    except (BrokenProcessPool, OSError) as exc:
+        print("Pool del planificador no disponible, se planifica en serie:", exc)
+        executor.shutdown(wait=False, cancel_futures=True)
+        return
+    with planner_pool_lock:
+        planner_pool["executor"] = executor
+
+
+def _planner_executor() -> Optional[ProcessPoolExecutor]:
+    with planner_pool_lock:
+        return planner_pool["executor"]
+
+
+def _pool_map(fn, jobs: List[Dict], parallel: bool = True) -> List[Dict]:
+    executor = _planner_executor() if parallel and len(jobs) > 1 else None
+    if executor is not None:
+        try:
+            return list(executor.map(fn, jobs))
+        except (BrokenProcessPool, OSError) as exc:
+            # Solo fallos del pool; los errores del propio job se propagan
+            print("Planificacion en paralelo no disponible, se planifica en serie:", exc)
+            with planner_pool_lock:
+                if planner_pool["executor"] is executor:
+                    planner_pool["executor"] = None
+            executor.shutdown(wait=False, cancel_futures=True)
+    return [fn(job) for job in jobs]
+
+
+def _merge_schedules(schedules: List[Dict], horizon_h: float) -> Dict:
+    late = sorted((item for sched in schedules for item in sched.get("late", [])), key=lambda i: i["runout_eta"])
+    return {
+        "horizon_h": horizon_h,
+        "trips": sum(sched.get("trips", 0) for sched in schedules),
+        "waves": max((sched.get("waves", 0) for sched in schedules), default=0),
+        "late_tanks": sum(sched.get("late_tanks", 0) for sched in schedules),
+        "late": late[:50],
+    }
+
+
+def _plan_urgent(
+    engine: Optional[str] = None,
+    time_budget_s: Optional[float] = None,
+    horizon_h: Optional[float] = None,
+    snapshot: Optional[Dict] = None,
+    parallel: bool = False,
+    compare: bool = False,
+):
+    # Con snapshot se planifica sobre esa copia del estado y sin tocar los globales. parallel solo desde
+    # el proceso principal: las simulaciones ya corren dentro del pool
+    engine = engine or PLANNER_ENGINE
+    horizon_h = PLANNER_HORIZON_H if horizon_h is None else horizon_h
+    snap = snapshot or {}
+    reserved = _reserved_tank_pairs(snap.get("active_routes"))
+    urgent, deferred = _scan_urgent_centers(reserved, horizon_h, snap.get("centers"), snap.get("threshold"))
+    if engine == "greedy":
+        urgent.sort(key=lambda c: (c.get("urgent_count", 0), c["total_deficit"]), reverse=True)
+    else:
+        urgent.sort(key=_center_earliest_runout_h)
+    available_trucks = [
+        t
+        for t in snap.get("trucks", trucks)
+        if t["status"] == "parked" and not t.get("route_id") and t.get("capacity_l")
+    ]
+    if not (urgent or deferred) or not available_trucks:
+        return [], {"engine": engine}
+
+    # Una particion por almacen: sus camiones y los centros que le quedan mas cerca, planificadas en paralelo
+    matrix = snap.get("matrix") or _distance_matrix()
+    jobs = _partition_jobs(engine, urgent, available_trucks, matrix, horizon_h, time_budget_s, snap, deferred, compare)
+    results = _pool_map(_plan_partition, jobs, parallel=parallel or snapshot is None)
+    by_id = {t["id"]: t for t in available_trucks}
+    plans = [(by_id[truck_id], stops) for r in results for truck_id, stops in r["plans"]]
+    report = {
+        "engine": engine,
+        "metrics": _plan_metrics(plans, matrix),
+        "schedule": _merge_schedules([r["schedule"] for r in results], horizon_h),
+    }
+    if compare and engine != "greedy":
+        greedy = [(by_id[truck_id], stops) for r in results for truck_id, stops in r["baseline"]]
+        report["baseline"] = _plan_metrics(greedy, matrix)
+        report["baseline_schedule"] = _merge_schedules([r["baseline_schedule"] for r in results], horizon_h)
+    if len(DEPOTS) > 1:
+        report["depots"] = [
+            {
+                "depot_id": r["depot_id"],
+                "centers": len(job["urgent"]),
+                "trucks": len(job["trucks"]),
+                "routes": len(r["plans"]),
+                "planned_l": round(sum(s["liters"] for _t, stops in r["plans"] for s in stops), 1),
+            }
+            for job, r in zip(jobs, results)
+        ]
+    return plans, report
+
+
+def _auto_plan_urgent_routes(
+    engine: Optional[str] = None,
+    time_budget_s: Optional[float] = None,
+    horizon_h: Optional[float] = None,
+    compare: bool = False,
+):
+    # Se planifica sobre una copia tomada con el lock de lectura; el de escritura solo para confirmar
+    with state_lock.read():
+        snapshot = {
+            "centers": deepcopy(centers),
+            "trucks": deepcopy(trucks),
+            "active_routes": deepcopy(active_routes),
+        }
+    plans, report = _plan_urgent(engine, time_budget_s, horizon_h, snapshot, parallel=True, compare=compare)
+    if not plans:
+        return [], report
+    with state_lock.write():
+        return _commit_auto_plans(_revalidate_plans(plans)), report
+
+
+def _revalidate_plans(plans: List[Tuple[Dict, List[Dict]]]) -> List[Tuple[Dict, List[Dict]]]:
+    # Mientras se planificaba sin lock otra peticion pudo ocupar un camion o cubrir un deposito: esos
+    # camiones se descartan, esas paradas se quitan y el stock de cada almacen se vuelve a recortar
+    reserved = _reserved_tank_pairs()
+    by_id = {t["id"]: t for t in trucks}
+    by_depot: Dict[str, List[Tuple[Dict, List[Dict]]]] = {}
+    for planned, stops in plans:
+        truck = by_id.get(planned["id"])
+        if not truck or truck["status"] != "parked" or truck.get("route_id"):
+            continue
+        kept = [s for s in stops if (s["center_id"], s["tank_id"]) not in reserved]
+        if not kept:
+            continue
+        reserved.update((s["center_id"], s["tank_id"]) for s in kept)
+        by_depot.setdefault(_truck_depot(truck)["id"], []).append((truck, kept))
+    return [plan for depot_id, group in by_depot.items() for plan in _cap_plans_to_stock(group, depot_id)]
+
+
+SCENARIO_MAX = 8
+SCENARIO_TRUCK_DELTA_MAX = 50
+SCENARIO_HORIZON_MAX_H = 7 * 24.0
+SCENARIO_KPIS = ["km", "routes", "trips", "tanks_at_risk", "planned_l", "fill_rate", "consumed_l", "runouts_unserved"]
+
+
+def _forecast_consumption(source: List[Dict], horizon_h: float) -> Dict:
+    # Consumo previsto en el horizonte si no llegara ninguna entrega
+    consumed = 0.0
+    runouts = 0
+    for center in source:
+        for tank in center["tanks"]:
+            current_l = _to_float(tank.get("current_l"), 0.0) or 0.0
+            use_l = _tank_hourly_use(tank) * horizon_h
+            consumed += min(use_l, current_l)
+            if use_l >= current_l:
+                runouts += 1
+    return {"consumed_l": round(consumed, 1), "runouts_without_delivery": runouts}
+
+
+def _apply_scenario(snapshot: Dict, overrides: Dict) -> Dict:
+    snap = deepcopy(snapshot)
+    fleet = snap["trucks"]
+    removed = {str(t) for t in overrides.get("remove_trucks") or []}
+    delta = int(_to_float(overrides.get("truck_delta"), 0.0) or 0)
+    if delta < 0:
+        # "Un camion menos": se quitan los libres de menor capacidad
+        idle = sorted(
+            (t for t in fleet if t["status"] == "parked" and not t.get("route_id")), key=lambda t: t.get("capacity_l", 0)
+        )
+        removed.update(t["id"] for t in idle[:-delta])
+    fleet[:] = [t for t in fleet if t["id"] not in removed]
+    for i in range(max(delta, 0)):
+        template = max(fleet, key=lambda t: t.get("capacity_l", 0)) if fleet else {"capacity_l": 12000}
+        fleet.append(
+            {
+                **deepcopy(template),
+                "id": f"SIM-{i + 1:02d}",
+                "status": "parked",
+                "route_id": None,
+                "current_load_l": 0,
+            }
+        )
+    capacity = overrides.get("capacity_l")
+    for truck in fleet:
+        value = capacity.get(truck["id"]) if isinstance(capacity, dict) else capacity
+        # Mismo parseo que la validacion: admite coma decimal ("1,5")
+        value = _to_float(value)
+        if value is not None:
+            truck["capacity_l"] = value
+    factor = _to_float(overrides.get("consumption_factor"))
+    if factor is not None:
+        for center in snap["centers"]:
+            for tank in center["tanks"]:
+                tank["hourly_use_l"] = _tank_hourly_use(tank) * factor
+    threshold = _to_float(overrides.get("threshold"))
+    if threshold is not None:
+        snap["threshold"] = threshold
+    if overrides.get("stock_l") is not None:
+        snap["stock"] = {str(k): _to_float(v) for k, v in overrides["stock_l"].items()}
+    return snap
+
+
+def _scenario_error(scenario) -> Optional[str]:
+    if not isinstance(scenario, dict) or not isinstance(scenario.get("overrides", {}), dict):
+        return "Cada escenario necesita un objeto overrides"
+    overrides = scenario.get("overrides") or {}
+    numbers = [overrides.get(k) for k in ("truck_delta", "consumption_factor", "threshold", "horizon_h")]
+    capacity = overrides.get("capacity_l")
+    numbers.extend(capacity.values() if isinstance(capacity, dict) else [capacity])
+    stock = overrides.get("stock_l")
+    if stock is not None and not isinstance(stock, dict):
+        return "stock_l debe ser un objeto {almacen: litros}"
+    numbers.extend((stock or {}).values())
+    if any(value is not None and _to_float(value) is None for value in numbers):
+        return "Valores numericos no validos en el escenario"
+    if abs(_to_float(overrides.get("truck_delta"), 0.0)) > SCENARIO_TRUCK_DELTA_MAX:
+        return f"truck_delta debe estar entre -{SCENARIO_TRUCK_DELTA_MAX} y {SCENARIO_TRUCK_DELTA_MAX}"
+    if not isinstance(overrides.get("remove_trucks") or [], list):
+        return "remove_trucks debe ser una lista"
+    if overrides.get("engine") not in (None, "greedy", "vrp"):
+        return "Motor de planificacion no valido"
+    return None
+
+
+def _run_scenario(job: Dict) -> Dict:
+    # Se ejecuta en el pool de procesos sobre una copia del estado: nunca toca active_routes ni trucks
+    started = time.perf_counter()
+    _install_spatial_snapshot(job.get("spatial"))
+    overrides = job["overrides"]
+    snap = _apply_scenario(job["snapshot"], overrides)
+    snap["matrix"] = job["matrix"]
+    horizon_h = _to_float(overrides.get("horizon_h"), job["horizon_h"])
+    horizon_h = min(max(horizon_h, 0.0), SCENARIO_HORIZON_MAX_H)
+    plans, report = _plan_urgent(overrides.get("engine") or job["engine"], job["time_budget_s"], horizon_h, snap)
+    metrics = report.get("metrics", {})
+    schedule = report.get("schedule", {})
+    forecast = _forecast_consumption(snap["centers"], horizon_h)
+    return {
+        "name": job["name"],
+        "overrides": overrides,
+        "kpis": {
+            "km": metrics.get("total_km", 0.0),
+            "routes": metrics.get("routes", 0),
+            "trips": schedule.get("trips", 0),
+            "tanks_at_risk": schedule.get("late_tanks", 0),
+            "planned_l": metrics.get("planned_l", 0.0),
+            "fill_rate": metrics.get("fill_rate", 0.0),
+            "consumed_l": forecast["consumed_l"],
+            "runouts_unserved": forecast["runouts_without_delivery"],
+        },
+        "trucks": len(snap["trucks"]),
+        "at_risk": schedule.get("late", [])[:10],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def _run_scenarios(
+    scenarios: List[Dict], engine: Optional[str], time_budget_s: Optional[float], horizon_h: Optional[float]
+) -> Dict:
+    with state_lock.read():
+        snapshot = {
+            "centers": deepcopy(centers),
+            "trucks": deepcopy(trucks),
+            "active_routes": deepcopy(active_routes),
+        }
+    common = {
+        "snapshot": snapshot,
+        "spatial": _spatial_snapshot(),
+        "matrix": _distance_matrix(),
+        "engine": engine or PLANNER_ENGINE,
+        "time_budget_s": PLANNER_TIME_BUDGET_S if time_budget_s is None else time_budget_s,
+        "horizon_h": PLANNER_HORIZON_H if horizon_h is None else horizon_h,
+    }
+    jobs = [{**common, "name": "actual", "overrides": {}}]
+    jobs.extend(
+        {**common, "name": str(sc.get("name") or f"escenario {i + 1}"), "overrides": sc.get("overrides") or {}}
+        for i, sc in enumerate(scenarios)
+    )
+    results = _pool_map(_run_scenario, jobs)
+    baseline = results[0]
+    for result in results[1:]:
+        result["delta"] = {
+            key: round(result["kpis"][key] - baseline["kpis"][key], 3) for key in SCENARIO_KPIS
+        }
+    return {"baseline": baseline, "scenarios": results[1:]}
+
+
+def _commit_auto_plans(plans: List[Tuple[Dict, List[Dict]]]) -> List[Dict]:
+    worker_pool = list(WORKERS.keys())
+    random.shuffle(worker_pool)
+
     planned_routes = []
-    for idx, tr in enumerate(available_trucks):
-        center_batch = assignments.get(tr["id"], [])
+    for idx, (tr, stops) in enumerate(plans):
         worker = worker_pool[idx % len(worker_pool)] if worker_pool else None
-        route = _build_auto_route_for_truck(tr, center_batch, worker)
-        if not route:
-            continue
+        route = _make_auto_route(tr, stops, worker)
         tr["route_id"] = route["id"]
         tr["notes"] = f"Ruta urgente asignada a {worker}" if worker else "Ruta urgente planificada"
         tr["current_load_l"] = route.get("planned_load_l", 0)
@@ -1178,60 +4454,229 @@ def _auto_plan_urgent_routes():
         tr["started_at"] = None
         tr["eta_minutes"] = None
         planned_routes.append(route)
-        active_routes.append(route)
-        for stop in route.get("stops", []):
-            reserved.add((stop.get("center_id"), stop.get("tank_id")))
+        _add_active_route(route)
     return planned_routes
 
 
+def _is_tank_urgent(tank: Dict) -> bool:
+    pct, _status, _runout, _hours = _compute_tank_status(tank)
+    return pct <= PLANNER_URGENT_PCT
+
+
+def _tank_level_events() -> List[Dict]:
+    # Compara con la ultima foto de depositos urgentes y emite solo los que cruzan el umbral
+    current = {(center["id"], tank["id"]) for tank, center in _iter_tanks() if _is_tank_urgent(tank)}
+    with planner_lock:
+        previous = planner_state["urgent_tanks"]
+        planner_state["urgent_tanks"] = current
+    if previous is None:
+        return []
+    events = [
+        {"type": "tank", "center_id": c_id, "tank_id": t_id, "urgent": True}
+        for c_id, t_id in sorted(current - previous)
+    ]
+    events.extend(
+        {"type": "tank", "center_id": c_id, "tank_id": t_id, "urgent": False}
+        for c_id, t_id in sorted(previous - current)
+    )
+    return events
+
+
+def _stop_due_min(center_id: str, tank_id: str) -> float:
+    tank = _find_tank(center_id, tank_id)
+    if not tank:
+        return float("inf")
+    _pct, _status, _runout, hours_left = _compute_tank_status(tank)
+    return hours_left * 60 if hours_left is not None else float("inf")
+
+
+def _route_stop_ctx(
+    matrix: Dict, stops: List[Dict], extra: Optional[Dict] = None, depot_site: str = WAREHOUSE_SITE
+) -> Dict:
+    entries = list(stops) + ([extra] if extra else [])
+    sites = [depot_site] + [_tank_site(s["center_id"], s["tank_id"]) for s in entries]
+    due = [float("inf")] + [_stop_due_min(s["center_id"], s["tank_id"]) for s in entries]
+    return _planner_ctx(matrix, sites, due)
+
+
+def _insert_into_planned_routes(pending: List[Dict], matrix: Dict, deadline: float) -> List[Dict]:
+    # Solo se tocan rutas automaticas aun sin arrancar; sus paradas ya reservadas siguen en la ruta
+    editable = [r for r in active_routes if r.get("status") == "planificada" and r.get("auto_generated")]
+    trucks_by_id = {t["id"]: t for t in trucks}
+    touched: Dict[str, Dict] = {}
+    for center in pending:
+        kept = []
+        for tank in sorted(center["tanks"], key=lambda t: t.get("hours_left") or float("inf")):
+            if time.perf_counter() >= deadline:
+                kept.append(tank)
+                continue
+            best = None
+            for route in editable:
+                truck = trucks_by_id.get(route["truck_id"])
+                if not truck:
+                    continue
+                spare = (truck.get("capacity_l") or 0) - (route.get("planned_load_l") or 0)
+                amount = min(tank["deficit_l"], spare)
+                if amount <= 0 or amount < min(PLANNER_MIN_STOP_L, tank["deficit_l"]):
+                    continue
+                stop = _new_stop(center["center_id"], tank["id"], amount, tank.get("product"))
+                ctx = _route_stop_ctx(matrix, route["stops"], stop, _truck_depot_site(truck))
+                order = list(range(1, len(route["stops"]) + 1))
+                delta, pos = _best_insertion(ctx, order, len(route["stops"]) + 1)
+                if best is None or delta < best[0]:
+                    best = (delta, route, pos, stop)
+            if best is None:
+                kept.append(tank)
+                continue
+            _delta, route, pos, stop = best
+            route["stops"].insert(pos, stop)
+            route["planned_load_l"] = (route.get("planned_load_l") or 0) + stop["liters"]
+            truck = trucks_by_id.get(route["truck_id"])
+            if truck:
+                truck["current_load_l"] = route["planned_load_l"]
+            route.setdefault("history", []).append(
+                RouteEvent(
+                    event="replanificada",
+                    note=f"+ {stop['center_id']} / {stop['tank_id']} {stop['liters']} L",
+                    ts=_now(),
+                )
+            )
+            touched[route["id"]] = route
+        center["tanks"] = kept
+    pending[:] = [c for c in pending if c["tanks"]]
+
+    for route in touched.values():
+        ctx = _route_stop_ctx(matrix, route["stops"], depot_site=_depot_site(route.get("depot_id")))
+        order = list(range(1, len(route["stops"]) + 1))
+        _two_opt(ctx, order, deadline)
+        _or_opt(ctx, order, deadline)
+        route["stops"] = [route["stops"][n - 1] for n in order]
+    return list(touched.values())
+
+
+def _replan_on_events(events: List[Dict]) -> Dict:
+    if not PLANNER_AUTO_REPLAN or not events:
+        return {}
+    started = time.perf_counter()
+    deadline = started + PLANNER_REPLAN_BUDGET_S
+    candidates = set()
+    freed_truck_ids = set()
+    for event in events:
+        if event["type"] == "tank" and event.get("urgent"):
+            candidates.add((event["center_id"], event["tank_id"]))
+        elif event["type"] == "route" and event.get("action") == "deleted":
+            # Las paradas liberadas solo se recolocan en otras rutas: el camion lo ha soltado el admin
+            candidates.update((s["center_id"], s["tank_id"]) for s in event.get("stops", []))
+        elif event["type"] == "truck":
+            freed_truck_ids.add(event["truck_id"])
+
+    free_trucks = [
+        t
+        for t in trucks
+        if t["id"] in freed_truck_ids
+        and t["status"] == "parked"
+        and not t.get("route_id")
+        and t.get("capacity_l")
+    ]
+    urgent = _collect_urgent_centers(_reserved_tank_pairs(), horizon_h=PLANNER_HORIZON_H)
+    if not free_trucks:
+        urgent = [
+            {**c, "tanks": [t for t in c["tanks"] if (c["center_id"], t["id"]) in candidates]} for c in urgent
+        ]
+        urgent = [c for c in urgent if c["tanks"]]
+    urgent.sort(key=_center_earliest_runout_h)
+
+    updated: List[Dict] = []
+    created: List[Dict] = []
+    if urgent:
+        matrix = _distance_matrix()
+        # Si otro worker cambio una ruta, se recarga de su fila y la insercion en ella se descarta
+        updated = [r for r in _insert_into_planned_routes(urgent, matrix, deadline) if _claim_route_row(r)]
+        for route in updated:
+            _bump_route_version(route)
+            _persist_route(route)
+        if urgent and free_trucks:
+            # Cada camion liberado solo recoge centros de su almacen
+            assigned = _center_depots(matrix, [c["center_id"] for c in urgent])
+            for depot_id, fleet in _group_by_depot(free_trucks).items():
+                depot_urgent = [c for c in urgent if assigned.get(c["center_id"]) == depot_id]
+                if not depot_urgent:
+                    continue
+                remaining_s = max(deadline - time.perf_counter(), 0.0)
+                plans = _cap_plans_to_stock(_vrp_plan(depot_urgent, fleet, matrix, remaining_s), depot_id)
+                created.extend(_commit_auto_plans(plans))
+
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    result = {
+        "events": len(events),
+        "updated": [r["id"] for r in updated],
+        "created": [r["id"] for r in created],
+        "latency_ms": latency_ms,
+    }
+    with planner_lock:
+        planner_state["events"] += len(events)
+        planner_state["replans"] += 1
+        planner_state["last"] = {**result, "ts": _now().isoformat()}
+    return result
+
+
+def _notify_planner(*events: Dict) -> Dict:
+    # Punto de entrada de los endpoints para eventos de ruta/camion; los niveles van por _queue_tank_level_events
+    if not events:
+        return {}
+    with state_lock.write():
+        return _replan_on_events(list(events))
+
+
+def _queue_tank_level_events():
+    # Lo llaman la sincronizacion con Savian y el consumo simulado: el replan corre en el hilo del
+    # planificador, fuera de la peticion que trajo las lecturas
+    if not PLANNER_AUTO_REPLAN:
+        return
+    with state_lock.read():
+        events = _tank_level_events()
+    if not events:
+        return
+    with planner_lock:
+        thread = planner_worker["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_planner_events_loop, name="planner-events", daemon=True)
+            planner_worker["thread"] = thread
+            thread.start()
+    planner_events_queue.put(events)
+
+
+def _planner_events_loop():
+    while True:
+        events = planner_events_queue.get()
+        batches = 1
+        # Lo que llegue mientras se replanifica se agrupa en una sola pasada
+        while True:
+            try:
+                events = events + planner_events_queue.get_nowait()
+            except queue.Empty:
+                break
+            batches += 1
+        try:
+            with state_lock.write():
+                result = _replan_on_events(events)
+            if result.get("updated") or result.get("created"):
+                _save_state()
+        except Exception as exc:  # noqa: BLE001
+            print("No se pudo replanificar por niveles de deposito:", exc)
+        finally:
+            for _ in range(batches):
+                planner_events_queue.task_done()
+
+
 def _serialize_routes(routes: List[Dict]):
-    serialized = []
-    for r in routes:
-        serialized.append(
-            {
-                **{k: r.get(k) for k in ["id", "worker", "truck_id", "origin", "status", "success"]},
-                "started_at": r.get("started_at").isoformat() if r.get("started_at") else None,
-                "finished_at": r.get("finished_at").isoformat() if r.get("finished_at") else None,
-                "total_delivered": r.get("total_delivered", 0),
-                "product_type": r.get("product_type"),
-                "current_stop_idx": r.get("current_stop_idx", 0),
-                "pending_worker": r.get("pending_worker", False),
-                "auto_generated": r.get("auto_generated", False),
-                "planned_load_l": r.get("planned_load_l"),
-                "stops": [
-                    {
-                        **{k: stop.get(k) for k in ["center_id", "tank_id", "liters", "product", "status"]},
-                        "arrival_at": stop.get("arrival_at").isoformat() if stop.get("arrival_at") else None,
-                        "depart_at": stop.get("depart_at").isoformat() if stop.get("depart_at") else None,
-                        "delivered_l": stop.get("delivered_l"),
-                    }
-                    for stop in r.get("stops", [])
-                ],
-                "history": [
-                    {
-                        "event": h.get("event"),
-                        "note": h.get("note"),
-                        "ts": h["ts"].isoformat(),
-                    }
-                    for h in r.get("history", [])
-                ],
-                "current_leg": {
-                    **{k: r["current_leg"].get(k) for k in ["eta_minutes", "label"]},
-                    "started_at": r["current_leg"]["started_at"].isoformat()
-                    if r.get("current_leg")
-                    else None,
-                    "destination": r["current_leg"]["destination"],
-                }
-                if r.get("current_leg")
-                else None,
-            }
-        )
-    return serialized
+    return [Route.from_dict(r).to_api() for r in routes]
 
 
 def _serialize_state():
     _update_truck_positions()
     _simulate_sensors()
+    _flush_sensor_view()
 
     serialized_centers = []
     flat_tanks = []
@@ -1313,11 +4758,12 @@ def _serialize_state():
             "by": item["by"],
             "note": item["note"],
         }
-        for item in sorted(delivery_log, key=lambda x: x["ts"], reverse=True)[:12]
+        for item in delivery_log.latest(12)
     ]
 
     return {
         "warehouse": WAREHOUSE,
+        "depots": DEPOTS,
         "centers": serialized_centers,
         "tanks": flat_tanks,
         "trucks": serialized_trucks,
@@ -1385,6 +4831,107 @@ def _compute_external_tank_status(
     return "ok"
 
 
+def _hysteresis_status(
+    previous: str,
+    liters: Optional[float],
+    capacity_l: float,
+    orange_level: Optional[float],
+    red_level: Optional[float],
+) -> str:
+    status = _compute_external_tank_status(liters, capacity_l, orange_level, red_level)
+    if liters is None or ALERT_RANK[status] >= ALERT_RANK[previous]:
+        return status
+    # Subir de nivel es inmediato; para bajar la lectura tiene que salir de la banda, asi una
+    # lectura que oscila alrededor de NivelAlertaNaranja/Roja no abre y cierra la alerta cada vez
+    band = capacity_l * ALERT_HYSTERESIS_PCT if capacity_l else 0.0
+    sticky = _compute_external_tank_status(liters - band, capacity_l, orange_level, red_level)
+    if ALERT_RANK[sticky] <= ALERT_RANK[status]:
+        return status
+    return min(previous, sticky, key=ALERT_RANK.get)
+
+
+def _alert_transition(previous: str, status: str) -> Optional[str]:
+    if previous == status:
+        return None
+    if previous == "ok":
+        return "open"
+    if status == "ok":
+        return "resolve"
+    return "escalate" if ALERT_RANK[status] > ALERT_RANK[previous] else "deescalate"
+
+
+def _evaluate_tank_alert(key: Tuple[str, str], reading: Dict) -> Tuple[str, bool, Optional[str]]:
+    # Solo se recalcula el deposito si cambia su lectura o sus umbrales
+    signature = (reading["liters"], reading["capacity_l"], reading["orange_level"], reading["red_level"])
+    with alert_engine_lock:
+        record = alert_engine["tanks"].get(key)
+        if record is not None and record["signature"] == signature:
+            active = alert_engine["active"].get(key)
+            return record["status"], record["urgent"], active["opened_at"] if active else None
+        previous = record["status"] if record else "ok"
+        status = _hysteresis_status(previous, *signature)
+        urgent = reading["percentage"] <= 20 or status in ("alert", "critical")
+        if not urgent and record is not None and record["urgent"]:
+            urgent = reading["percentage"] <= 20 + ALERT_HYSTERESIS_PCT * 100
+        alert_engine["tanks"][key] = {"signature": signature, "status": status, "urgent": urgent}
+
+        now = _now().isoformat()
+        active = alert_engine["active"].get(key)
+        if status == "ok":
+            alert_engine["active"].pop(key, None)
+        else:
+            active = alert_engine["active"][key] = {
+                "center_id": key[0],
+                "tank_id": key[1],
+                "center": reading["center_name"],
+                "label": reading["label"],
+                "status": status,
+                "severity": "alta" if status in ("alert", "critical") else "media",
+                "liters": reading["liters"],
+                "percentage": reading["percentage"],
+                "opened_at": active["opened_at"] if active else now,
+                "updated_at": now,
+            }
+        transition = _alert_transition(previous, status)
+        if transition:
+            alert_engine["seq"] += 1
+            alert_engine["events"].append(
+                {
+                    "seq": alert_engine["seq"],
+                    "type": transition,
+                    "center_id": key[0],
+                    "tank_id": key[1],
+                    "center": reading["center_name"],
+                    "label": reading["label"],
+                    "status": status,
+                    "previous": previous,
+                    "liters": reading["liters"],
+                    "percentage": reading["percentage"],
+                    "ts": now,
+                }
+            )
+        return status, urgent, active["opened_at"] if status != "ok" else None
+
+
+def _alert_changes(since: Optional[int]) -> Dict:
+    with alert_engine_lock:
+        events = list(alert_engine["events"])
+        cursor = alert_engine["seq"]
+        active = sorted(
+            alert_engine["active"].values(),
+            key=lambda a: (-ALERT_RANK[a["status"]], a["percentage"]),
+        )
+    oldest = events[0]["seq"] if events else cursor + 1
+    # Sin cursor, o si el cliente se ha quedado mas atras que la cola, recibe el conjunto activo completo
+    reset = since is None or since < oldest - 1 or since > cursor
+    return {
+        "cursor": cursor,
+        "reset": reset,
+        "events": [] if reset else [e for e in events if e["seq"] > since],
+        "active": [dict(a) for a in active] if reset else None,
+    }
+
+
 def _fetch_center_deposit_screens(center_row: Dict) -> List[Dict]:
     center_id = _to_int(center_row.get("IdCentroTrabajo") or center_row.get("idCentroTrabajo"))
     if center_id is None:
@@ -1447,7 +4994,7 @@ def _sync_internal_runtime_from_external(serialized_centers: List[Dict]):
             if capacity_l > 0:
                 current_l = max(0.0, min(current_l, capacity_l))
             center_entry["tanks"].append(
-                {
+                Tank({
                     "id": str(tank.get("id")),
                     "label": tank.get("label") or str(tank.get("id")),
                     "product": tank.get("product") or "-",
@@ -1461,37 +5008,45 @@ def _sync_internal_runtime_from_external(serialized_centers: List[Dict]):
                         "name": center_entry["name"],
                     },
                     "sensors": _default_tank_sensors(),
-                }
+                    "hourly_use_l": _to_float(tank.get("hourly_use_l")),
+                })
             )
         synced_centers.append(center_entry)
 
     if synced_centers:
-        centers.clear()
-        centers.extend(synced_centers)
+        with state_lock.write():
+            centers.clear()
+            centers.extend(synced_centers)
+            _reindex_centers()
+        _rebuild_spatial_index()
 
 
 def _ensure_test_trucks():
-    current = {str(tr.get("id")): tr for tr in trucks}
-    synced = []
-    for base in TEST_TRUCKS:
-        existing = current.get(base["id"], {})
-        synced.append(
-            {
-                "id": base["id"],
-                "driver": existing.get("driver") or base["driver"],
-                "status": existing.get("status") or "parked",
-                "current_load_l": _to_int(existing.get("current_load_l"), 0) or 0,
-                "capacity_l": _to_int(existing.get("capacity_l"), base["capacity_l"]) or base["capacity_l"],
-                "position": existing.get("position") or deepcopy(WAREHOUSE),
-                "destination": existing.get("destination"),
-                "started_at": existing.get("started_at"),
-                "eta_minutes": existing.get("eta_minutes"),
-                "route_id": existing.get("route_id"),
-                "notes": existing.get("notes") or "Disponible en almacen",
-            }
-        )
-    trucks.clear()
-    trucks.extend(synced)
+    with state_lock.write():
+        current = {str(tr.get("id")): tr for tr in trucks}
+        synced = []
+        for base in TEST_TRUCKS:
+            existing = current.get(base["id"], {})
+            depot = _find_depot(base.get("depot_id") or existing.get("depot_id") or WAREHOUSE["id"])
+            synced.append(
+                Truck({
+                    "id": base["id"],
+                    "depot_id": depot["id"],
+                    "driver": existing.get("driver") or base["driver"],
+                    "status": existing.get("status") or "parked",
+                    "current_load_l": _to_int(existing.get("current_load_l"), 0) or 0,
+                    "capacity_l": _to_int(existing.get("capacity_l"), base["capacity_l"]) or base["capacity_l"],
+                    "position": existing.get("position") or deepcopy(depot),
+                    "destination": existing.get("destination"),
+                    "started_at": existing.get("started_at"),
+                    "eta_minutes": existing.get("eta_minutes"),
+                    "route_id": existing.get("route_id"),
+                    "notes": existing.get("notes") or "Disponible en almacen",
+                })
+            )
+        trucks.clear()
+        trucks.extend(synced)
+        _reindex_trucks()
 
 
 def _serialize_runtime_trucks() -> List[Dict]:
@@ -1500,11 +5055,12 @@ def _serialize_runtime_trucks() -> List[Dict]:
         serialized.append(
             {
                 "id": tr.get("id"),
+                "depot_id": _truck_depot(tr)["id"],
                 "driver": tr.get("driver"),
                 "status": tr.get("status") or "parked",
                 "current_load_l": _to_int(tr.get("current_load_l"), 0) or 0,
                 "capacity_l": _to_int(tr.get("capacity_l"), 0) or 0,
-                "position": tr.get("position") or deepcopy(WAREHOUSE),
+                "position": tr.get("position") or deepcopy(_truck_depot(tr)),
                 "destination": tr.get("destination"),
                 "eta_minutes": tr.get("eta_minutes"),
                 "notes": tr.get("notes") or "",
@@ -1516,7 +5072,7 @@ def _serialize_runtime_trucks() -> List[Dict]:
 
 def _serialize_runtime_log(limit: int = 40) -> List[Dict]:
     rows = []
-    for item in sorted(delivery_log, key=lambda x: x.get("ts") or _now(), reverse=True)[:limit]:
+    for item in delivery_log.latest(limit):
         ts = item.get("ts")
         ts_iso = ts.isoformat() if isinstance(ts, datetime) else str(ts or "")
         rows.append(
@@ -1533,6 +5089,180 @@ def _serialize_runtime_log(limit: int = 40) -> List[Dict]:
     return rows
 
 
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_DB_FETCH_ROWS = 500
+DELIVERY_EXPORT_FIELDS = ("ts", "truck_id", "tank_id", "center_id", "center", "delivered_l", "by", "note")
+ROUTE_EXPORT_FIELDS = ("id", "truck_id", "depot_id", "worker", "status", "started_at", "finished_at", "success", "total_delivered")
+ROUTE_EXPORT_CSV_FIELDS = ROUTE_EXPORT_FIELDS + (
+    "record",
+    "seq",
+    "center_id",
+    "tank_id",
+    "product",
+    "liters",
+    "delivered_l",
+    "arrival_at",
+    "depart_at",
+    "event",
+    "note",
+    "ts",
+)
+
+
+def _iter_store_array(field: str, conditions: List[str], params: List):
+    # Cursor de servidor sobre el array JSON guardado en app_state: se leen EXPORT_DB_FETCH_ROWS filas cada vez
+    conn = psycopg2.connect(DB_URL, sslmode="require")
+    try:
+        with conn.cursor(name=f"export_{field}") as cur:
+            cur.itersize = EXPORT_DB_FETCH_ROWS
+            where = "".join(f" and {condition}" for condition in conditions)
+            cur.execute(
+                f"select elem from app_state, jsonb_array_elements(data->'{field}') elem where key = %s{where}",
+                ["state", *params],
+            )
+            for (elem,) in cur:
+                yield elem
+    finally:
+        conn.close()
+
+
+def _iter_export_deliveries(since: Optional[datetime], until: Optional[datetime], filters: Dict[str, Optional[str]]):
+    if not _db_enabled():
+        for row in delivery_log.iter_rows(since, until, center_id=filters["center_id"], truck_id=filters["truck_id"]):
+            yield delivery_log.row(row)
+        return
+    conditions, params = [], []
+    if since:
+        conditions.append("elem->>'ts' >= %s")
+        params.append(since.isoformat())
+    if until:
+        conditions.append("elem->>'ts' <= %s")
+        params.append(until.isoformat())
+    for key in ("center_id", "truck_id"):
+        if filters[key]:
+            conditions.append(f"elem->>'{key}' = %s")
+            params.append(filters[key])
+    yield from _iter_store_array("delivery_log", conditions, params)
+
+
+def _route_export_moment(route: Dict):
+    moment = route.get("finished_at") or route.get("started_at")
+    return datetime.fromisoformat(moment) if isinstance(moment, str) else moment
+
+
+def _iter_export_routes(since: Optional[datetime], until: Optional[datetime], filters: Dict[str, Optional[str]]):
+    if not _db_enabled():
+        with state_lock.read():
+            routes = list(route_history)
+        for route in routes:
+            moment = _route_export_moment(route)
+            if (since or until) and not isinstance(moment, datetime):
+                continue
+            if (since and moment < since) or (until and moment > until):
+                continue
+            if filters["truck_id"] and route.get("truck_id") != filters["truck_id"]:
+                continue
+            if filters["center_id"] and all(s.get("center_id") != filters["center_id"] for s in route.get("stops", [])):
+                continue
+            yield route
+        return
+    conditions, params = [], []
+    moment = "coalesce(elem->>'finished_at', elem->>'started_at')"
+    if since:
+        conditions.append(f"{moment} >= %s")
+        params.append(since.isoformat())
+    if until:
+        conditions.append(f"{moment} <= %s")
+        params.append(until.isoformat())
+    if filters["truck_id"]:
+        conditions.append("elem->>'truck_id' = %s")
+        params.append(filters["truck_id"])
+    if filters["center_id"]:
+        conditions.append("exists (select 1 from jsonb_array_elements(elem->'stops') s where s->>'center_id' = %s)")
+        params.append(filters["center_id"])
+    yield from _iter_store_array("route_history", conditions, params)
+
+
+def _route_export_record(route: Dict) -> Dict:
+    record = {field: route.get(field) for field in ROUTE_EXPORT_FIELDS}
+    record["stops"] = route.get("stops", [])
+    record["history"] = route.get("history", [])
+    return record
+
+
+def _route_export_csv_rows(route: Dict):
+    # Una fila por parada y otra por evento del historial, repitiendo las columnas de la ruta
+    base = {field: route.get(field) for field in ROUTE_EXPORT_FIELDS}
+    stop_fields = [k for k in ROUTE_EXPORT_CSV_FIELDS if k not in ROUTE_EXPORT_FIELDS]
+    for seq, stop in enumerate(route.get("stops", []), start=1):
+        yield {**base, **{k: stop[k] for k in stop_fields if k in stop}, "record": "stop", "seq": seq}
+    for seq, event in enumerate(route.get("history", []), start=1):
+        yield {
+            **base,
+            "record": "event",
+            "seq": seq,
+            "event": event.get("event"),
+            "note": event.get("note"),
+            "ts": event.get("ts"),
+        }
+
+
+def _export_cell(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _iter_csv(fields: Tuple[str, ...], records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        writer.writerow({key: _export_cell(value) for key, value in record.items()})
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def _iter_ndjson(records):
+    chunk = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, default=_json_default, ensure_ascii=False) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    yield "".join(chunk)
+
+
+def _export_request_args():
+    export_format = (request.args.get("format") or "csv").lower()
+    if export_format not in ("csv", "ndjson"):
+        raise ValueError("Formato no valido (csv o ndjson)")
+    try:
+        since = _naive_utc(datetime.fromisoformat(request.args["from"])) if request.args.get("from") else None
+        until = _naive_utc(datetime.fromisoformat(request.args["to"])) if request.args.get("to") else None
+    except ValueError:
+        raise ValueError("from/to deben ser fechas ISO 8601")
+    if until is not None and len(request.args["to"]) == 10:
+        # Un "to" sin hora incluye el dia completo
+        until += timedelta(days=1) - timedelta(microseconds=1)
+    filters = {key: request.args.get(key) or None for key in ("center_id", "truck_id")}
+    return export_format, since, until, filters
+
+
+def _export_response(export_format: str, name: str, chunks):
+    extension, mimetype = ("csv", "text/csv") if export_format == "csv" else ("ndjson", "application/x-ndjson")
+    filename = f"{name}_{_now().strftime('%Y%m%d_%H%M')}.{extension}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 def _ensure_external_runtime_ready():
     try:
         _get_external_state_cached(force=False)
@@ -1540,6 +5270,25 @@ def _ensure_external_runtime_ready():
         return
 
 
+def _fill_external_runout(runout_targets: Dict[Tuple[str, str], List[Dict]]):
+    # targets[0] es la entrada del deposito; el resto, su alerta y su entrada de urgentes si las hay
+    rates = _estimate_consumption_rates(list(runout_targets))
+    now = _now()
+    for key, rate in rates.items():
+        targets = runout_targets[key]
+        liters = targets[0].get("current_l")
+        targets[0]["hourly_use_l"] = round(rate, 2)
+        if liters is None or rate <= 0:
+            continue
+        hours_left = round(liters / rate, 1)
+        runout_eta = (now + timedelta(hours=hours_left)).isoformat()
+        targets[0]["runout_hours"] = hours_left
+        for entry in targets:
+            entry["runout_eta"] = runout_eta
+            if "hours_left" in entry:
+                entry["hours_left"] = hours_left
+
+
 def _build_external_state() -> Dict:
     status, centers_response = _call_savian_api("GET", "ObtenerInformacionCentrosTrabajo")
     if status == 401:
@@ -1560,6 +5309,7 @@ def _build_external_state() -> Dict:
     flat_tanks: List[Dict] = []
     alerts: List[Dict] = []
     urgent_centers: List[Dict] = []
+    runout_targets: Dict[Tuple[str, str], List[Dict]] = {}
 
     for center_row in selected_rows:
         center_id = _to_int(center_row.get("IdCentroTrabajo") or center_row.get("idCentroTrabajo"))
@@ -1611,7 +5361,6 @@ def _build_external_state() -> Dict:
                     dep.get("NivelAlertaNaranja") or dep.get("nivelAlertaNaranja")
                 )
                 red_level = _to_float(dep.get("NivelAlertaRoja") or dep.get("nivelAlertaRoja"))
-                status_name = _compute_external_tank_status(liters, capacity_l, orange_level, red_level)
 
                 percentage = 0.0
                 if liters is not None and capacity_l > 0:
@@ -1624,6 +5373,18 @@ def _build_external_state() -> Dict:
                     deficit_l = round(capacity_l, 1)
 
                 tank_id = str(element_id) if element_id is not None else f"{center_id_str}-dep-{tank_index + 1}"
+                status_name, is_urgent, opened_at = _evaluate_tank_alert(
+                    (center_id_str, tank_id),
+                    {
+                        "center_name": center_name,
+                        "label": name,
+                        "liters": liters,
+                        "capacity_l": capacity_l,
+                        "percentage": percentage,
+                        "orange_level": orange_level,
+                        "red_level": red_level,
+                    },
+                )
                 point_offset = ((tank_index % 4) - 1.5) * 0.00018
                 tank_location = {
                     "lat": location["lat"] + point_offset,
@@ -1663,6 +5424,8 @@ def _build_external_state() -> Dict:
                 }
                 center_tanks.append(tank_entry)
                 flat_tanks.append(tank_entry)
+                _record_level_reading(center_id_str, tank_id, last_reading, liters)
+                targets = runout_targets.setdefault((center_id_str, tank_id), [tank_entry])
 
                 if status_name in ("warn", "alert", "critical"):
                     severity = "alta" if status_name in ("alert", "critical") else "media"
@@ -1683,10 +5446,12 @@ def _build_external_state() -> Dict:
                             "message": message,
                             "runout_eta": None,
                             "status": status_name,
+                            "opened_at": opened_at,
                         }
                     )
+                    targets.append(alerts[-1])
 
-                if percentage <= 20 or status_name in ("alert", "critical"):
+                if is_urgent:
                     urgent_tanks.append(
                         {
                             "id": tank_id,
@@ -1698,6 +5463,7 @@ def _build_external_state() -> Dict:
                             "hours_left": None,
                         }
                     )
+                    targets.append(urgent_tanks[-1])
 
         serialized_centers.append(
             {
@@ -1723,23 +5489,29 @@ def _build_external_state() -> Dict:
                 }
             )
 
+    _fill_external_runout(runout_targets)
     _sync_internal_runtime_from_external(serialized_centers)
+    _flush_level_history()
     _ensure_test_trucks()
-
-    return {
-        "warehouse": WAREHOUSE,
-        "centers": serialized_centers,
-        "tanks": flat_tanks,
-        "trucks": _serialize_runtime_trucks(),
-        "workers": list(WORKERS.keys()),
-        "alerts": alerts,
-        "routes": _serialize_routes(active_routes),
-        "route_history": _serialize_routes(route_history[:20]),
-        "delivery_log": _serialize_runtime_log(),
-        "server_time": _now().isoformat(),
-        "urgent_centers": urgent_centers,
-        "source": "savian-api",
-    }
+    # Los cruces de umbral que traen estas lecturas se replanifican en segundo plano, no en esta peticion
+    _queue_tank_level_events()
+
+    with state_lock.read():
+        return {
+            "warehouse": WAREHOUSE,
+            "depots": DEPOTS,
+            "centers": serialized_centers,
+            "tanks": flat_tanks,
+            "trucks": _serialize_runtime_trucks(),
+            "workers": list(WORKERS.keys()),
+            "alerts": alerts,
+            "routes": _serialize_routes(active_routes),
+            "route_history": _serialize_routes(route_history[:20]),
+            "delivery_log": _serialize_runtime_log(),
+            "server_time": _now().isoformat(),
+            "urgent_centers": urgent_centers,
+            "source": "savian-api",
+        }
 
 
 def _get_external_state_cached(force: bool = False) -> Dict:
@@ -1793,11 +5565,215 @@ def _guard_routes():
         return None
     if path == "/favicon.ico":
         return None
-    if _is_request_authenticated():
+    if _is_request_authenticated():
+        return None
+    if path.startswith("/api/"):
+        return jsonify({"ok": False, "error": "Sesion no iniciada"}), 401
+    return redirect(url_for("view_login"))
+
+
+def _idempotency_scope() -> Optional[str]:
+    key = (request.headers.get("Idempotency-Key") or "").strip()
+    if not key or request.method not in {"POST", "PUT", "PATCH", "DELETE"}:
+        return None
+    if not request.path.startswith(IDEMPOTENCY_PREFIXES):
+        return None
+    # La misma clave de otra sesion u otro endpoint es otra peticion
+    raw = f"{_session_id(create=False) or '-'}|{request.path}|{key}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _idempotency_local_get(scope: str) -> Optional[Dict]:
+    now = time.monotonic()
+    with idempotency_lock:
+        entry = idempotency_cache.get(scope)
+        if entry and entry["expires"] <= now:
+            idempotency_cache.pop(scope, None)
+            return None
+        return dict(entry) if entry else None
+
+
+def _idempotency_local_insert(scope: str, entry: Dict, now: float):
+    # Con idempotency_lock tomado; libera las caducadas y las mas antiguas por encima del limite
+    idempotency_cache.pop(scope, None)
+    while idempotency_cache:
+        oldest = next(iter(idempotency_cache))
+        if len(idempotency_cache) < IDEMPOTENCY_CACHE_SIZE and idempotency_cache[oldest]["expires"] > now:
+            break
+        idempotency_cache.pop(oldest)
+    idempotency_cache[scope] = {**entry, "expires": now + IDEMPOTENCY_TTL_S}
+
+
+def _idempotency_local_put(scope: str, entry: Dict):
+    with idempotency_lock:
+        _idempotency_local_insert(scope, entry, time.monotonic())
+
+
+def _idempotency_local_claim(scope: str, fingerprint: str) -> Optional[Dict]:
+    now = time.monotonic()
+    with idempotency_lock:
+        entry = idempotency_cache.get(scope)
+        if entry and entry["expires"] > now:
+            return dict(entry)
+        # status None marca la peticion en curso
+        _idempotency_local_insert(scope, {"fingerprint": fingerprint, "status": None}, now)
+    return None
+
+
+def _ensure_idempotency_table(conn):
+    # Una vez por proceso, no en cada peticion con clave
+    if idempotency_db["table_ready"]:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            create table if not exists idempotency_keys (
+                scope text primary key, fingerprint text, status integer,
+                mimetype text, body text, expires_at timestamptz not null
+            )
+            """
+        )
+    conn.commit()
+    idempotency_db["table_ready"] = True
+
+
+def _idempotency_conn():
+    # Una sola conexion por peticion para reservar la clave y guardar o liberar la respuesta; se cierra en teardown
+    conn = g.get("idempotency_conn")
+    if conn is None or conn.closed:
+        conn = g.idempotency_conn = psycopg2.connect(DB_URL, sslmode="require")
+        _ensure_idempotency_table(conn)
+    return conn
+
+
+def _idempotency_db(query: str, params: Tuple, fetch: bool = False):
+    conn = _idempotency_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            result = cur.fetchone() if fetch else cur.rowcount
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _idempotency_claim(scope: str, fingerprint: str) -> Optional[Dict]:
+    # None si esta peticion se queda la clave; si no, la entrada existente (terminada o en curso)
+    cached = _idempotency_local_get(scope)
+    if cached and cached["status"] is not None:
+        return cached
+    if not _db_enabled():
+        return _idempotency_local_claim(scope, fingerprint)
+    try:
+        row = _idempotency_db(
+            """
+            with purged as (delete from idempotency_keys where expires_at < now())
+            insert into idempotency_keys(scope, fingerprint, expires_at)
+            values (%s, %s, now() + %s * interval '1 second')
+            on conflict (scope) do update set fingerprint = EXCLUDED.fingerprint, status = null,
+                mimetype = null, body = null, expires_at = EXCLUDED.expires_at
+                where idempotency_keys.expires_at < now()
+            returning scope
+            """,
+            (scope, fingerprint, IDEMPOTENCY_TTL_S),
+            fetch=True,
+        )
+        if row:
+            return None
+        row = _idempotency_db(
+            "select fingerprint, status, mimetype, body from idempotency_keys where scope = %s",
+            (scope,),
+            fetch=True,
+        )
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo consultar Idempotency-Key en DB:", exc)
+        return _idempotency_local_claim(scope, fingerprint)
+    if not row:
+        return None
+    return {"fingerprint": row[0], "status": row[1], "mimetype": row[2], "body": row[3]}
+
+
+def _idempotency_store(scope: str, entry: Dict):
+    _idempotency_local_put(scope, entry)
+    if not _db_enabled():
+        return
+    try:
+        _idempotency_db(
+            "update idempotency_keys set status = %s, mimetype = %s, body = %s where scope = %s",
+            (entry["status"], entry["mimetype"], entry["body"], scope),
+        )
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo guardar Idempotency-Key en DB:", exc)
+
+
+def _idempotency_release(scope: str):
+    # La peticion fallo sin respuesta util: el reintento con la misma clave vuelve a ejecutarse
+    with idempotency_lock:
+        idempotency_cache.pop(scope, None)
+    if not _db_enabled():
+        return
+    try:
+        _idempotency_db("delete from idempotency_keys where scope = %s and status is null", (scope,))
+    except Exception as exc:  # noqa: BLE001
+        print("No se pudo liberar Idempotency-Key en DB:", exc)
+
+
+@app.before_request
+def _idempotency_begin():
+    scope = _idempotency_scope()
+    if not scope:
+        return None
+    fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+    entry = _idempotency_claim(scope, fingerprint)
+    if entry is None:
+        g.idempotency_scope = scope
+        g.idempotency_fingerprint = fingerprint
         return None
-    if path.startswith("/api/"):
-        return jsonify({"ok": False, "error": "Sesion no iniciada"}), 401
-    return redirect(url_for("view_login"))
+    if entry["fingerprint"] != fingerprint:
+        return jsonify({"ok": False, "error": "Idempotency-Key ya usada con otra peticion"}), 422
+    if entry["status"] is None:
+        return jsonify({"ok": False, "error": "La peticion con esta Idempotency-Key sigue en curso"}), 409
+    response = Response(entry["body"], status=entry["status"], mimetype=entry["mimetype"])
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@app.after_request
+def _idempotency_finish(response):
+    scope = g.pop("idempotency_scope", None)
+    if not scope:
+        return response
+    # Los 5xx y las respuestas en streaming no se guardan: el reintento se ejecuta de nuevo
+    if response.status_code >= 500 or response.is_streamed:
+        _idempotency_release(scope)
+        return response
+    _idempotency_store(
+        scope,
+        {
+            "fingerprint": g.pop("idempotency_fingerprint", None),
+            "status": response.status_code,
+            "mimetype": response.mimetype,
+            "body": response.get_data(as_text=True),
+        },
+    )
+    return response
+
+
+@app.teardown_request
+def _idempotency_abort(_exc):
+    # Excepcion sin respuesta: after_request no llega a ejecutarse
+    scope = g.pop("idempotency_scope", None)
+    if scope:
+        _idempotency_release(scope)
+    for name in ("idempotency_conn", "route_store_conn"):
+        conn = g.pop(name, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
 
 @app.route("/login")
@@ -1877,6 +5853,142 @@ def api_state():
         return jsonify({"ok": False, "error": str(exc)}), 502
 
 
+@app.route("/api/map/tanks")
+def api_map_tanks():
+    # Solo los centros y depositos dentro de la ventana del mapa: bbox=sur,oeste,norte,este.
+    # Con fleet=1 anade almacen, camiones y rutas (la pagina del mapa no pide el estado completo);
+    # sin bbox en ese caso solo se devuelve la flota, para el primer encuadre
+    with_fleet = request.args.get("fleet") in ("1", "true")
+    raw_bbox = request.args.get("bbox")
+    bbox = None
+    try:
+        if raw_bbox or not with_fleet:
+            bbox = [float(v) for v in (raw_bbox or "").split(",")]
+            south, west, north, east = bbox
+    except ValueError:
+        return jsonify({"ok": False, "error": "bbox debe ser sur,oeste,norte,este"}), 400
+    try:
+        state = _get_external_state_cached()
+    except PermissionError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 401
+    except Exception as exc:  # noqa: BLE001
+        return jsonify({"ok": False, "error": str(exc)}), 502
+
+    visible: Dict[str, set] = {}
+    for key in _spatial_bbox(south, west, north, east, kind="tank") if bbox else ():
+        point = _spatial_point(key)
+        if point:
+            visible.setdefault(str(point[3]), set()).add(str(point[4]))
+    in_view = []
+    for center in state.get("centers", []):
+        tank_ids = visible.get(str(center["id"]))
+        if tank_ids:
+            in_view.append({**center, "tanks": [t for t in center.get("tanks", []) if str(t["id"]) in tank_ids]})
+    result = {"ok": True, "bbox": bbox, "centers": in_view, "tanks": sum(len(c["tanks"]) for c in in_view)}
+    if with_fleet:
+        result.update({key: state.get(key) for key in ("warehouse", "trucks", "routes")})
+    return jsonify(result)
+
+
+@app.route("/api/tanks/<center_id>/<tank_id>/levels")
+def api_tank_levels(center_id, tank_id):
+    # Historico de lecturas de Savian: from/to en ISO 8601 (UTC), limit = ultimas N lecturas del rango
+    try:
+        since = datetime.fromisoformat(request.args["from"]) if request.args.get("from") else None
+        until = datetime.fromisoformat(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "from/to deben ser fechas ISO 8601"}), 400
+    limit = _to_int(request.args.get("limit"))
+    if limit is not None and limit <= 0:
+        return jsonify({"ok": False, "error": "limit debe ser positivo"}), 400
+    readings = _level_history_range(center_id, tank_id, since, until, limit)
+    return jsonify(
+        {
+            "ok": True,
+            "center_id": center_id,
+            "tank_id": tank_id,
+            "readings": readings,
+            "count": len(readings),
+            "capacity": LEVEL_HISTORY_SIZE,
+        }
+    )
+
+
+@app.route("/api/rollups")
+def api_rollups():
+    # Consumo, descargas y nivel agregados por centro (center_id=* para toda la flota)
+    try:
+        until = _naive_utc(datetime.fromisoformat(request.args["to"])) if request.args.get("to") else _now()
+        since = (
+            _naive_utc(datetime.fromisoformat(request.args["from"]))
+            if request.args.get("from")
+            else until - timedelta(days=7)
+        )
+    except (ValueError, OverflowError):
+        return jsonify({"ok": False, "error": "from/to deben ser fechas ISO 8601"}), 400
+    if since > until:
+        return jsonify({"ok": False, "error": "from debe ser anterior a to"}), 400
+    resolution = request.args.get("resolution") or _rollup_resolution_for((until - since).total_seconds())
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"ok": False, "error": "resolution debe ser minute, hour o day"}), 400
+    center_id = request.args.get("center_id") or ROLLUP_ALL
+    buckets = _rollup_range(center_id, resolution, since, until)
+    return jsonify(
+        {
+            "ok": True,
+            "center_id": center_id,
+            "resolution": resolution,
+            "from": since.isoformat(),
+            "to": until.isoformat(),
+            "buckets": buckets,
+            "totals": {
+                "consumed_l": round(sum(b["consumed_l"] for b in buckets), 1),
+                "delivered_l": round(sum(b["delivered_l"] for b in buckets), 1),
+                "deliveries": sum(b["deliveries"] for b in buckets),
+            },
+        }
+    )
+
+
+@app.route("/api/alerts/changes")
+def api_alert_changes():
+    # Transiciones open/escalate/deescalate/resolve desde el cursor ?since=<seq>
+    since = request.args.get("since")
+    if since is not None and _to_int(since) is None:
+        return jsonify({"ok": False, "error": "since debe ser un entero"}), 400
+    _ensure_external_runtime_ready()
+    return jsonify({"ok": True, **_alert_changes(_to_int(since))})
+
+
+@app.route("/api/reports")
+def api_reports():
+    # Rango de dias inclusivo: from/to como YYYY-MM-DD (por defecto, los ultimos 30 dias)
+    try:
+        until = _naive_utc(datetime.fromisoformat(request.args["to"])) if request.args.get("to") else _now()
+        since = (
+            _naive_utc(datetime.fromisoformat(request.args["from"]))
+            if request.args.get("from")
+            else until - timedelta(days=30)
+        )
+    except (ValueError, OverflowError):
+        return jsonify({"ok": False, "error": "from/to deben ser fechas ISO 8601"}), 400
+    if since > until:
+        return jsonify({"ok": False, "error": "from debe ser anterior a to"}), 400
+    if (until.date() - since.date()).days >= REPORT_MAX_DAYS:
+        return jsonify({"ok": False, "error": f"El rango no puede superar {REPORT_MAX_DAYS} dias"}), 400
+    filters = {key: request.args.get(key) or None for key in ("center_id", "truck_id", "worker")}
+    report = _build_report(since, until, filters)
+    return jsonify(
+        {
+            "ok": True,
+            "from": since.date().isoformat(),
+            "to": until.date().isoformat(),
+            "filters": filters,
+            **report,
+        }
+    )
+
+
 @app.route("/api/login", methods=["POST"])
 def api_login():
     payload = request.get_json(force=True) or {}
@@ -1924,7 +6036,13 @@ def api_auth_status():
 
 @app.route("/api/simulate-drain", methods=["POST"])
 def api_simulate_drain():
-    _simulate_drain()
+    payload = request.get_json(silent=True) or {}
+    hours = _to_float(payload.get("hours"))
+    if hours is not None:
+        hours = min(max(hours, 0.0), 7 * 24.0)
+    with state_lock.write():
+        _simulate_drain(hours)
+    _queue_tank_level_events()
     _save_state()
     return jsonify({"ok": True, "message": "Consumo simulado"}), 200
 
@@ -1932,11 +6050,69 @@ def api_simulate_drain():
 @app.route("/api/admin/auto-plan", methods=["POST"])
 def api_admin_auto_plan():
     _ensure_external_runtime_ready()
-    planned = _auto_plan_urgent_routes()
+    payload = request.get_json(silent=True) or {}
+    engine = payload.get("engine") or PLANNER_ENGINE
+    if engine not in ("vrp", "greedy"):
+        return jsonify({"ok": False, "error": "Motor de planificacion no valido"}), 400
+    time_budget_s = _to_float(payload.get("time_budget_s"))
+    if time_budget_s is not None:
+        time_budget_s = min(max(time_budget_s, 0.0), 10.0)
+    horizon_h = _to_float(payload.get("horizon_h"))
+    if horizon_h is not None:
+        horizon_h = min(max(horizon_h, 0.0), 7 * 24.0)
+    # compare=1 anade al informe la planificacion greedy de referencia (cuesta otra pasada del horizonte)
+    compare = payload.get("compare") in (True, 1, "1", "true") or request.args.get("compare") in ("1", "true")
+    # Planifica sin lock global: solo la confirmacion de rutas toma el de escritura
+    planned, report = _auto_plan_urgent_routes(engine, time_budget_s, horizon_h, compare)
     if not planned:
-        return jsonify({"ok": False, "error": "Sin centros urgentes o camiones libres"}), 400
+        # El informe va igualmente: lista los depositos aplazados que se agotan dentro del horizonte
+        return jsonify({"ok": False, "error": "Sin centros urgentes o camiones libres", "report": report}), 400
+    with state_lock.read():
+        serialized = _serialize_routes(planned)
     _save_state()
-    return jsonify({"ok": True, "created": len(planned), "routes": _serialize_routes(planned)})
+    return jsonify({"ok": True, "created": len(planned), "routes": serialized, "report": report})
+
+
+@app.route("/api/admin/scenarios", methods=["POST"])
+def api_admin_scenarios():
+    _ensure_external_runtime_ready()
+    payload = request.get_json(silent=True) or {}
+    scenarios = payload.get("scenarios")
+    if not isinstance(scenarios, list) or not scenarios:
+        return jsonify({"ok": False, "error": "Debes enviar una lista de escenarios"}), 400
+    if len(scenarios) > SCENARIO_MAX:
+        return jsonify({"ok": False, "error": f"Maximo {SCENARIO_MAX} escenarios por peticion"}), 400
+    for sc in scenarios:
+        error = _scenario_error(sc)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+    engine = payload.get("engine")
+    if engine and engine not in ("greedy", "vrp"):
+        return jsonify({"ok": False, "error": "Motor de planificacion no valido"}), 400
+    time_budget_s = _to_float(payload.get("time_budget_s"))
+    if time_budget_s is not None:
+        time_budget_s = min(max(time_budget_s, 0.0), 10.0)
+    horizon_h = _to_float(payload.get("horizon_h"))
+    if horizon_h is not None:
+        horizon_h = min(max(horizon_h, 0.0), SCENARIO_HORIZON_MAX_H)
+    started = time.perf_counter()
+    result = _run_scenarios(scenarios, engine, time_budget_s, horizon_h)
+    return jsonify({"ok": True, **result, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+
+@app.route("/api/admin/planner")
+def api_admin_planner():
+    with planner_lock:
+        stats = {k: v for k, v in planner_state.items() if k != "urgent_tanks"}
+        stats["urgent_tanks"] = len(planner_state["urgent_tanks"] or ())
+    return jsonify(
+        {
+            "ok": True,
+            "auto_replan": PLANNER_AUTO_REPLAN,
+            "budget_ms": round(PLANNER_REPLAN_BUDGET_S * 1000, 1),
+            **stats,
+        }
+    )
 
 
 @app.route("/api/admin/reassign-route", methods=["POST"])
@@ -1948,45 +6124,68 @@ def api_admin_reassign_route():
     if not route_id or not truck_id:
         return jsonify({"ok": False, "error": "Faltan datos"}), 400
 
-    route = next((r for r in active_routes if r["id"] == route_id), None)
+    route = _find_route(route_id)
     if not route:
         return jsonify({"ok": False, "error": "Ruta no encontrada"}), 404
-    if route.get("status") not in ["planificada"]:
-        return jsonify({"ok": False, "error": "Solo puedes editar rutas planificadas"}), 400
-
-    new_truck = next((t for t in trucks if t["id"] == truck_id), None)
-    if not new_truck:
-        return jsonify({"ok": False, "error": "Camion no valido"}), 400
-
-    busy_other = new_truck.get("route_id") and new_truck.get("route_id") != route_id
-    if busy_other or new_truck.get("status") not in ["parked", "maintenance", None]:
-        return jsonify({"ok": False, "error": "Camion no disponible"}), 400
-
-    old_truck = next((t for t in trucks if t.get("route_id") == route_id), None)
-    if old_truck and old_truck["id"] != new_truck["id"]:
-        old_truck["route_id"] = None
-        old_truck["notes"] = "Libre"
-        if old_truck.get("status") != "outbound":
-            old_truck["status"] = "parked"
-        old_truck["current_load_l"] = 0
-        old_truck["destination"] = None
-
-    route["truck_id"] = new_truck["id"]
-    new_truck["route_id"] = route["id"]
-    new_truck["status"] = "parked"
-    new_truck["notes"] = payload.get("notes") or f"Ruta {route_id} asignada manual"
-    new_truck["current_load_l"] = route.get("planned_load_l", new_truck.get("current_load_l", 0))
-
-    if worker:
-        if worker not in WORKERS:
+    locked_truck_id = route.get("truck_id")
+    with _route_access(route, truck_id):
+        if _find_route(route_id) is not route:
+            return jsonify({"ok": False, "error": "Ruta no encontrada"}), 404
+        if route.get("truck_id") != locked_truck_id:
+            # Otra reasignacion cambio el camion mientras se esperaba el lock
+            return _route_conflict(route)
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        if route.get("status") not in ["planificada"]:
+            return jsonify({"ok": False, "error": "Solo puedes editar rutas planificadas"}), 400
+
+        new_truck = _find_truck(truck_id)
+        if not new_truck:
+            return jsonify({"ok": False, "error": "Camion no valido"}), 400
+
+        busy_other = new_truck.get("route_id") and new_truck.get("route_id") != route_id
+        if busy_other or new_truck.get("status") not in ["parked", "maintenance", None]:
+            return jsonify({"ok": False, "error": "Camion no disponible"}), 400
+        if worker and worker not in WORKERS:
             return jsonify({"ok": False, "error": "Operario no valido"}), 400
-        route["worker"] = worker
-        route["pending_worker"] = False
-
-    route.setdefault("history", []).append(
-        {"event": "reasignada", "note": f"Asignada al camion {truck_id}", "ts": _now()}
-    )
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+
+        old_truck = _truck_for_route(route_id)
+        if old_truck and old_truck["id"] != new_truck["id"]:
+            old_truck["route_id"] = None
+            old_truck["notes"] = "Libre"
+            if old_truck.get("status") != "outbound":
+                old_truck["status"] = "parked"
+            old_truck["current_load_l"] = 0
+            old_truck["destination"] = None
+
+        _unindex_route(route)
+        route["truck_id"] = new_truck["id"]
+        _index_route(route)
+        new_depot = _truck_depot(new_truck)
+        if route.get("depot_id") != new_depot["id"]:
+            route["depot_id"] = new_depot["id"]
+            route["origin"] = new_depot["name"]
+        new_truck["route_id"] = route["id"]
+        new_truck["status"] = "parked"
+        new_truck["notes"] = payload.get("notes") or f"Ruta {route_id} asignada manual"
+        new_truck["current_load_l"] = route.get("planned_load_l", new_truck.get("current_load_l", 0))
+
+        if worker:
+            route["worker"] = worker
+            route["pending_worker"] = False
+
+        route.setdefault("history", []).append(
+            RouteEvent(event="reasignada", note=f"Asignada al camion {truck_id}", ts=_now())
+        )
+        _bump_route_version(route)
+        _persist_route(route)
 
+    if old_truck and old_truck["id"] != new_truck["id"]:
+        _notify_planner({"type": "truck", "truck_id": old_truck["id"]})
     _save_state()
     return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
 
@@ -1997,26 +6196,113 @@ def api_admin_delete_route():
     route_id = payload.get("route_id")
     if not route_id:
         return jsonify({"ok": False, "error": "Falta route_id"}), 400
-    route = next((r for r in active_routes if r["id"] == route_id), None)
+    route = _find_route(route_id)
     if not route:
         return jsonify({"ok": False, "error": "Ruta no encontrada"}), 404
-    if not route.get("auto_generated"):
-        return jsonify({"ok": False, "error": "Solo puedes eliminar rutas auto generadas"}), 400
-    if route.get("status") != "planificada":
-        return jsonify({"ok": False, "error": "Solo rutas planificadas pueden eliminarse"}), 400
-
-    active_routes[:] = [r for r in active_routes if r["id"] != route_id]
-    truck = next((t for t in trucks if t.get("route_id") == route_id), None)
-    if truck:
-        truck["route_id"] = None
-        truck["status"] = "parked"
-        truck["notes"] = "Libre"
-        truck["current_load_l"] = 0
-        truck["destination"] = None
+    with _route_access(route):
+        if _find_route(route_id) is not route:
+            return jsonify({"ok": False, "error": "Ruta no encontrada"}), 404
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        if not route.get("auto_generated"):
+            return jsonify({"ok": False, "error": "Solo puedes eliminar rutas auto generadas"}), 400
+        if route.get("status") != "planificada":
+            return jsonify({"ok": False, "error": "Solo rutas planificadas pueden eliminarse"}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+
+        truck = _truck_for_route(route_id)
+        # "eliminada" la deja fuera de todos los endpoints y del planificador hasta que se quite de la lista
+        route["status"] = "eliminada"
+        _unindex_route(route)
+        _bump_route_version(route)
+        if truck:
+            truck["route_id"] = None
+            truck["status"] = "parked"
+            truck["notes"] = "Libre"
+            truck["current_load_l"] = 0
+            truck["destination"] = None
+        _persist_route(route)
+    with state_lock.write():
+        active_routes[:] = [r for r in active_routes if r is not route]
+    _notify_planner({"type": "route", "action": "deleted", "route_id": route_id, "stops": route.get("stops", [])})
     _save_state()
     return jsonify({"ok": True, "deleted": route_id})
 
 
+@app.route("/api/admin/qr-export")
+def api_admin_qr_export():
+    export_format = (request.args.get("format") or "zip").lower()
+    if export_format not in ("zip", "sheet"):
+        return jsonify({"ok": False, "error": "Formato no valido (zip o sheet)"}), 400
+    kind = (request.args.get("kind") or "all").lower()
+    if kind not in ("all", "truck", "center", "warehouse"):
+        return jsonify({"ok": False, "error": "Tipo no valido"}), 400
+    center_id = request.args.get("center_id") or None
+    ids = {item.strip() for item in (request.args.get("ids") or "").split(",") if item.strip()}
+
+    all_targets = _qr_targets(_get_base_url())
+    targets = _filter_qr_targets(all_targets, kind=kind, center_id=center_id, ids=ids or None)
+    if not targets:
+        return jsonify({"ok": False, "error": "Sin codigos QR para el filtro indicado"}), 404
+
+    version = _qr_fleet_version(all_targets)
+    key = (export_format, kind, center_id, tuple(sorted(ids)))
+    # Cada formato y filtro es otro documento: el ETag combina version de flota y peticion
+    etag = hashlib.sha1(f"{version}|{key!r}".encode("utf-8")).hexdigest()[:16]
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    if export_format == "zip":
+        producer = _iter_qr_zip(targets)
+        mimetype = "application/zip"
+        filename = f"qr_{kind}_{version}.zip"
+        disposition = "attachment"
+    else:
+        producer = _iter_qr_sheet(targets, "Etiquetas QR - Arbolani")
+        mimetype = "text/html"
+        filename = f"qr_{kind}_{version}.html"
+        disposition = "inline"
+    return Response(
+        stream_with_context(_cached_qr_export(version, key, producer)),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'{disposition}; filename="{filename}"',
+            "ETag": f'"{etag}"',
+            "X-Fleet-Version": version,
+        },
+    )
+
+
+@app.route("/api/export/deliveries")
+def api_export_deliveries():
+    try:
+        export_format, since, until, filters = _export_request_args()
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    records = _iter_export_deliveries(since, until, filters)
+    if export_format == "csv":
+        chunks = _iter_csv(DELIVERY_EXPORT_FIELDS, records)
+    else:
+        chunks = _iter_ndjson(records)
+    return _export_response(export_format, "descargas", chunks)
+
+
+@app.route("/api/export/routes")
+def api_export_routes():
+    try:
+        export_format, since, until, filters = _export_request_args()
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    routes = _iter_export_routes(since, until, filters)
+    if export_format == "csv":
+        chunks = _iter_csv(ROUTE_EXPORT_CSV_FIELDS, (row for route in routes for row in _route_export_csv_rows(route)))
+    else:
+        chunks = _iter_ndjson(_route_export_record(route) for route in routes)
+    return _export_response(export_format, "rutas", chunks)
+
+
 @app.route("/api/routes/claim", methods=["POST"])
 def api_claim_route():
     _ensure_external_runtime_ready()
@@ -2026,45 +6312,59 @@ def api_claim_route():
     if worker not in WORKERS:
         return jsonify({"ok": False, "error": "Trabajador no valido"}), 400
 
-    truck = next((t for t in trucks if t["id"] == truck_id), None)
+    truck = _find_truck(truck_id)
     if not truck:
         return jsonify({"ok": False, "error": "Camion no encontrado"}), 400
 
-    route = next(
-        (r for r in active_routes if r["truck_id"] == truck_id and r.get("status") == "planificada"),
-        None,
-    )
+    route = next((r for r in _truck_routes(truck_id) if r.get("status") == "planificada"), None)
     if not route:
         return jsonify({"ok": False, "error": "No hay ruta planificada para este camion"}), 400
-    if route.get("worker") and route.get("worker") != worker:
-        return jsonify({"ok": False, "error": "Ruta asignada a otro operario"}), 400
-
-    route["worker"] = worker
-    route["pending_worker"] = False
-    route["status"] = "en_ruta"
-    route["started_at"] = _now()
-    route["history"].append({"event": "asignada", "note": f"Tomada por {worker}", "ts": _now()})
-
-    planned_load = route.get("planned_load_l") or sum(s["liters"] for s in route["stops"])
-    truck["status"] = "outbound"
-    truck["route_id"] = route["id"]
-    truck["notes"] = f"Asignada a {worker}"
-    truck["current_load_l"] = planned_load
-
-    first_stop = route["stops"][0]
-    dest_center = _find_center(first_stop["center_id"])
-    dest_tank = _find_tank(first_stop["center_id"], first_stop["tank_id"])
-    leg_origin = {**WAREHOUSE, "name": route.get("origin") or WAREHOUSE["name"]}
-    leg_dest = {
-        "lat": dest_tank["location"]["lat"],
-        "lon": dest_tank["location"]["lon"],
-        "name": f"{dest_center['name']} / {dest_tank['label']}"
-        if dest_center and dest_tank
-        else first_stop["center_id"],
-        "center_id": dest_center["id"] if dest_center else first_stop["center_id"],
-        "tank_id": dest_tank["id"] if dest_tank else first_stop["tank_id"],
-    }
-    _set_leg(route, truck, leg_origin, leg_dest, f"Hacia {dest_center['name']}" if dest_center else "Primer destino")
+    with _route_access(route):
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        if route.get("status") != "planificada" or route.get("truck_id") != truck["id"]:
+            # Otro operario la activo (o se reasigno) mientras se esperaba el lock
+            return jsonify({"ok": False, "error": "No hay ruta planificada para este camion"}), 400
+        if route.get("worker") and route.get("worker") != worker:
+            return jsonify({"ok": False, "error": "Ruta asignada a otro operario"}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+
+        route["worker"] = worker
+        route["pending_worker"] = False
+        route["status"] = "en_ruta"
+        route["started_at"] = _now()
+        route["history"].append(RouteEvent(event="asignada", note=f"Tomada por {worker}", ts=_now()))
+
+        planned_load = route.get("planned_load_l") or sum(s["liters"] for s in route["stops"])
+        depot = _truck_depot(truck)
+        if depot.get("stock_l") is not None:
+            # La carga sale del almacen del camion al activar la ruta
+            with _entity_lock("depots", depot["id"]):
+                depot["stock_l"] = max(depot["stock_l"] - planned_load, 0.0)
+        truck["status"] = "outbound"
+        truck["route_id"] = route["id"]
+        truck["notes"] = f"Asignada a {worker}"
+        truck["current_load_l"] = planned_load
+
+        first_stop = route["stops"][0]
+        dest_center = _find_center(first_stop["center_id"])
+        dest_tank = _find_tank(first_stop["center_id"], first_stop["tank_id"])
+        leg_origin = {**depot, "name": route.get("origin") or depot["name"]}
+        leg_dest = {
+            "lat": dest_tank["location"]["lat"],
+            "lon": dest_tank["location"]["lon"],
+            "name": f"{dest_center['name']} / {dest_tank['label']}"
+            if dest_center and dest_tank
+            else first_stop["center_id"],
+            "center_id": dest_center["id"] if dest_center else first_stop["center_id"],
+            "tank_id": dest_tank["id"] if dest_tank else first_stop["tank_id"],
+        }
+        _set_leg(route, truck, leg_origin, leg_dest, f"Hacia {dest_center['name']}" if dest_center else "Primer destino")
+        _bump_route_version(route)
+        _persist_route(route)
     _save_state()
     return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
 
@@ -2075,7 +6375,7 @@ def api_plan_route():
     payload = request.get_json(force=True)
     worker = payload.get("worker")
     truck_id = payload.get("truck_id")
-    origin = payload.get("origin") or WAREHOUSE["name"]
+    origin = payload.get("origin")
     load_l = payload.get("load_l")
     product_type = payload.get("product_type")
     stops = payload.get("stops", [])
@@ -2084,120 +6384,120 @@ def api_plan_route():
     if worker not in WORKERS:
         return jsonify({"ok": False, "error": "Trabajador no valido"}), 400
 
-    truck = next((t for t in trucks if t["id"] == truck_id), None)
-    if not truck:
-        return jsonify({"ok": False, "error": "Camion no encontrado"}), 400
-    if truck["status"] != "parked":
-        return jsonify({"ok": False, "error": "Camion no disponible"}), 400
-
-    if not stops:
-        return jsonify({"ok": False, "error": "Debes definir destinos"}), 400
-
-    validated_stops = []
-    for stop in stops:
-        center_id = stop.get("center_id")
-        tank_id = stop.get("tank_id")
-        liters = stop.get("liters", 0)
-        product = stop.get("product") or product_type
-        center = _find_center(center_id)
-        tank = _find_tank(center_id, tank_id)
-        if not center or not tank:
-            return jsonify({"ok": False, "error": "Destino no valido"}), 400
-        validated_stops.append(
-            {
-                "center_id": center_id,
-                "tank_id": tank_id,
-                "liters": liters,
-                "product": product,
-                "status": "pendiente",
-                "arrival_at": None,
-                "depart_at": None,
-                "delivered_l": None,
-            }
-        )
-
-    total_planned = sum(s["liters"] or 0 for s in validated_stops)
-    truck_capacity = truck["capacity_l"]
-    if load_l is None:
-        load_l = total_planned
-    if load_l <= 0 or load_l > truck_capacity:
-        return jsonify({"ok": False, "error": "Carga fuera de limite"}), 400
-
-    route_id = _new_route_id()
-    route = {
-        "id": route_id,
-        "worker": worker,
-        "truck_id": truck_id,
-        "origin": origin,
-        "product_type": product_type,
-        "stops": validated_stops,
-        "status": "planificada",
-        "current_stop_idx": 0,
-        "started_at": None,
-        "finished_at": None,
-        "history": [
-            {"event": "planificada", "note": f"{len(validated_stops)} destinos", "ts": _now()}
-        ],
-        "current_leg": None,
-        "total_delivered": 0,
-        "success": None,
-        "auto_generated": auto_generated,
-        "pending_worker": False,
-        "planned_load_l": load_l,
-    }
-    active_routes.append(route)
+    with state_lock.write():
+        truck = _find_truck(truck_id)
+        if not truck:
+            return jsonify({"ok": False, "error": "Camion no encontrado"}), 400
+        if truck["status"] != "parked":
+            return jsonify({"ok": False, "error": "Camion no disponible"}), 400
+        depot = _truck_depot(truck)
+        origin = origin or depot["name"]
+
+        if not stops:
+            return jsonify({"ok": False, "error": "Debes definir destinos"}), 400
+
+        validated_stops = []
+        for stop in stops:
+            center_id = stop.get("center_id")
+            tank_id = stop.get("tank_id")
+            liters = stop.get("liters", 0)
+            product = stop.get("product") or product_type
+            center = _find_center(center_id)
+            tank = _find_tank(center_id, tank_id)
+            if not center or not tank:
+                return jsonify({"ok": False, "error": "Destino no valido"}), 400
+            validated_stops.append(
+                {
+                    "center_id": center_id,
+                    "tank_id": tank_id,
+                    "liters": liters,
+                    "product": product,
+                    "status": "pendiente",
+                    "arrival_at": None,
+                    "depart_at": None,
+                    "delivered_l": None,
+                }
+            )
 
-    first_stop = validated_stops[0]
-    dest_center = _find_center(first_stop["center_id"])
-    dest_tank = _find_tank(first_stop["center_id"], first_stop["tank_id"])
-    leg_origin = {**WAREHOUSE, "name": origin}
-    leg_dest = {
-        "lat": dest_tank["location"]["lat"],
-        "lon": dest_tank["location"]["lon"],
-        "name": f"{dest_center['name']} / {dest_tank['label']}",
-        "center_id": dest_center["id"],
-        "tank_id": dest_tank["id"],
-    }
-    truck["status"] = "parked"
-    truck["route_id"] = route_id
-    truck["current_load_l"] = load_l
-    truck["notes"] = "Ruta planificada manual"
-    truck["destination"] = None
+        total_planned = sum(s["liters"] or 0 for s in validated_stops)
+        truck_capacity = truck["capacity_l"]
+        if load_l is None:
+            load_l = total_planned
+        if load_l <= 0 or load_l > truck_capacity:
+            return jsonify({"ok": False, "error": "Carga fuera de limite"}), 400
+
+        route_id = _new_route_id()
+        route = Route({
+            "id": route_id,
+            "worker": worker,
+            "truck_id": truck_id,
+            "depot_id": depot["id"],
+            "origin": origin,
+            "product_type": product_type,
+            "stops": validated_stops,
+            "status": "planificada",
+            "current_stop_idx": 0,
+            "started_at": None,
+            "finished_at": None,
+            "history": [
+                {"event": "planificada", "note": f"{len(validated_stops)} destinos", "ts": _now()}
+            ],
+            "current_leg": None,
+            "total_delivered": 0,
+            "success": None,
+            "auto_generated": auto_generated,
+            "pending_worker": False,
+            "planned_load_l": load_l,
+        })
+        _add_active_route(route)
+
+        first_stop = validated_stops[0]
+        dest_center = _find_center(first_stop["center_id"])
+        dest_tank = _find_tank(first_stop["center_id"], first_stop["tank_id"])
+        leg_origin = {**depot, "name": origin}
+        leg_dest = {
+            "lat": dest_tank["location"]["lat"],
+            "lon": dest_tank["location"]["lon"],
+            "name": f"{dest_center['name']} / {dest_tank['label']}",
+            "center_id": dest_center["id"],
+            "tank_id": dest_tank["id"],
+        }
+        truck["status"] = "parked"
+        truck["route_id"] = route_id
+        truck["current_load_l"] = load_l
+        truck["notes"] = "Ruta planificada manual"
+        truck["destination"] = None
 
     _save_state()
     return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
 
 
-@app.route("/api/routes/arrive", methods=["POST"])
-def api_arrive_stop():
-    payload = request.get_json(force=True)
-    route_id = payload.get("route_id")
-    route = next((r for r in active_routes if r["id"] == route_id), None)
-    if not route:
-        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
-
+# Paso de ruta (llegada, descarga, vuelta al almacen) separado en comprobacion y aplicacion. Con
+# dry_run solo cambian los campos de la ruta: el lote los aplica sobre una copia para validar la
+# secuencia entera antes de tocar camiones, depositos, registro o historial
+def _arrive_error(route: Dict) -> Optional[str]:
     if route.get("status") == "planificada":
-        return jsonify(
-            {
-                "ok": False,
-                "error": "Debes escanear primero el QR del camion para activar la ruta",
-            }
-        ), 400
-    if route.get("status") in {"regresando", "finalizada"}:
-        return jsonify({"ok": False, "error": "La ruta ya no admite llegadas a centro"}), 400
-
+        return "Debes escanear primero el QR del camion para activar la ruta"
+    if route.get("status") in {"regresando", "finalizada", "eliminada"}:
+        return "La ruta ya no admite llegadas a centro"
     idx = route.get("current_stop_idx", 0)
     if idx >= len(route["stops"]):
-        return jsonify({"ok": False, "error": "No hay destinos pendientes"}), 400
-    stop = route["stops"][idx]
-    if stop.get("arrival_at"):
-        return jsonify({"ok": False, "error": "Ya marcado"}), 400
-    stop["arrival_at"] = _now()
+        return "No hay destinos pendientes"
+    if route["stops"][idx].get("arrival_at"):
+        return "Ya marcado"
+    return None
+
+
+def _apply_arrive(route: Dict, at: datetime, dry_run: bool = False):
+    stop = route["stops"][route.get("current_stop_idx", 0)]
+    stop["arrival_at"] = at
     stop["status"] = "en_descarga"
-    route["history"].append(
-        {"event": "llegada", "note": f"{stop['center_id']} / {stop['tank_id']}", "ts": _now()}
-    )
-    truck = next((t for t in trucks if t["id"] == route["truck_id"]), None)
+    route["history"].append(RouteEvent(event="llegada", note=f"{stop['center_id']} / {stop['tank_id']}", ts=at))
+    route["status"] = "en_destino"
+    route["current_leg"] = None
+    if dry_run:
+        return
+    truck = _find_truck(route["truck_id"])
     if truck:
         truck["status"] = "delivering"
         truck["notes"] = "En descarga"
@@ -2209,77 +6509,73 @@ def api_arrive_stop():
                 "center_id": stop["center_id"],
                 "tank_id": stop["tank_id"],
             }
-    route["status"] = "en_destino"
-    route["current_leg"] = None
-    _save_state()
-    return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
-
-
-@app.route("/api/routes/complete-stop", methods=["POST"])
-def api_complete_stop():
-    payload = request.get_json(force=True)
-    route_id = payload.get("route_id")
-    delivered_l = payload.get("delivered_l")
-    note = payload.get("note") or ""
+    _bump_route_version(route)
 
-    route = next((r for r in active_routes if r["id"] == route_id), None)
-    if not route:
-        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
 
+def _complete_stop_error(route: Dict, delivered_l) -> Optional[str]:
     idx = route.get("current_stop_idx", 0)
     if idx >= len(route["stops"]):
-        return jsonify({"ok": False, "error": "Sin destinos activos"}), 400
-
+        return "Sin destinos activos"
     stop = route["stops"][idx]
     if not stop.get("arrival_at"):
-        return jsonify({"ok": False, "error": "Marca llegada primero"}), 400
-    if delivered_l is None or delivered_l < 0:
-        return jsonify({"ok": False, "error": "Cantidad invalida"}), 400
+        return "Marca llegada primero"
+    if stop.get("depart_at"):
+        return "Ya marcado"
+    if isinstance(delivered_l, bool) or not isinstance(delivered_l, (int, float)) or delivered_l < 0:
+        return "Cantidad invalida"
+    return None
+
 
-    stop["depart_at"] = _now()
+def _apply_complete_stop(route: Dict, delivered_l, note: str, at: datetime, dry_run: bool = False):
+    idx = route.get("current_stop_idx", 0)
+    stop = route["stops"][idx]
+    stop["depart_at"] = at
     stop["status"] = "completado"
     stop["delivered_l"] = delivered_l
     route["total_delivered"] += delivered_l
-    duration_min = None
-    if stop.get("arrival_at"):
-        duration_min = max(
-            0, math.ceil((stop["depart_at"] - stop["arrival_at"]).total_seconds() / 60)
-        )
+    duration_min = max(0, math.ceil((stop["depart_at"] - stop["arrival_at"]).total_seconds() / 60))
+    note_text = f"{stop['center_id']} / {stop['tank_id']} {delivered_l} L en {duration_min} min"
+    route["history"].append(RouteEvent(event="descarga", note=note_text, ts=at))
+    has_more = idx + 1 < len(route["stops"])
+    if has_more:
+        route["current_stop_idx"] = idx + 1
+        route["status"] = "en_ruta"
+    else:
+        route["status"] = "regresando"
+        route["history"].append(RouteEvent(event="salida_destino", note="Ultimo destino", ts=at))
+    if dry_run:
+        return
 
     center = _find_center(stop["center_id"])
     tank = _find_tank(stop["center_id"], stop["tank_id"])
     if tank:
-        tank["current_l"] = min(tank["current_l"] + delivered_l, tank["capacity_l"])
+        # Dos rutas pueden descargar en el mismo deposito a la vez
+        with _entity_lock("tanks", (stop["center_id"], stop["tank_id"])):
+            tank["current_l"] = min(tank["current_l"] + delivered_l, tank["capacity_l"])
 
-    truck = next((t for t in trucks if t["id"] == route["truck_id"]), None)
+    truck = _find_truck(route["truck_id"])
     if truck:
         truck["current_load_l"] = max(truck["current_load_l"] - delivered_l, 0)
 
-    note_text = f"{stop['center_id']} / {stop['tank_id']} {delivered_l} L"
-    if duration_min is not None:
-        note_text += f" en {duration_min} min"
-    route["history"].append({"event": "descarga", "note": note_text, "ts": _now()})
-
     delivery_log.append(
         {
-            "ts": _now(),
+            "ts": at,
             "truck_id": route["truck_id"],
             "tank_id": stop["tank_id"],
+            "center_id": stop["center_id"],
             "center": center["name"] if center else stop["center_id"],
             "delivered_l": delivered_l,
             "by": route["worker"],
             "note": note or "Descarga confirmada",
         }
     )
+    _rollup_delivery(stop["center_id"], at, delivered_l)
 
-    has_more = idx + 1 < len(route["stops"])
     if has_more:
         next_stop = route["stops"][idx + 1]
-        route["current_stop_idx"] = idx + 1
-        route["status"] = "en_ruta"
         dest_center = _find_center(next_stop["center_id"])
         dest_tank = _find_tank(next_stop["center_id"], next_stop["tank_id"])
-        leg_origin = tank["location"] if tank else WAREHOUSE
+        leg_origin = tank["location"] if tank else _find_depot(route.get("depot_id"))
         leg_dest = {
             "lat": dest_tank["location"]["lat"],
             "lon": dest_tank["location"]["lon"],
@@ -2291,38 +6587,39 @@ def api_complete_stop():
             truck["status"] = "outbound"
             truck["notes"] = "Siguiente destino"
             _set_leg(route, truck, leg_origin, leg_dest, f"Hacia {dest_center['name']}")
-    else:
-        route["status"] = "regresando"
-        route["history"].append({"event": "salida_destino", "note": "Ultimo destino", "ts": _now()})
-        if truck:
-            truck["status"] = "returning"
-            truck["notes"] = "Volviendo a almacen"
-            _set_leg(route, truck, tank["location"] if tank else WAREHOUSE, WAREHOUSE, "Retorno")
-
-    _save_state()
-    return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
+    elif truck:
+        truck["status"] = "returning"
+        truck["notes"] = "Volviendo a almacen"
+        depot = _truck_depot(truck)
+        _set_leg(route, truck, tank["location"] if tank else depot, depot, "Retorno")
+    _bump_route_version(route)
 
 
-@app.route("/api/routes/arrive-warehouse", methods=["POST"])
-def api_arrive_warehouse():
-    payload = request.get_json(force=True)
-    route_id = payload.get("route_id")
-    success = payload.get("success", True)
-
-    route = next((r for r in active_routes if r["id"] == route_id), None)
-    if not route:
-        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+def _arrive_warehouse_error(route: Dict) -> Optional[str]:
+    if route.get("status") in ("finalizada", "eliminada"):
+        return "La ruta ya esta cerrada"
     if route.get("current_stop_idx", 0) < len(route.get("stops", [])) and route.get("status") != "regresando":
-        return jsonify({"ok": False, "error": "Aun quedan destinos por cerrar"}), 400
+        return "Aun quedan destinos por cerrar"
+    return None
 
-    truck = next((t for t in trucks if t["id"] == route["truck_id"]), None)
+
+def _apply_arrive_warehouse(route: Dict, success, at: datetime, dry_run: bool = False):
+    # Devuelve el camion liberado (o None) para avisar al planificador
     route["status"] = "finalizada"
-    route["finished_at"] = _now()
-    route["history"].append({"event": "almacen", "note": "Ruta cerrada", "ts": _now()})
+    route["finished_at"] = at
+    route["history"].append(RouteEvent(event="almacen", note="Ruta cerrada", ts=at))
     route["success"] = bool(success)
     route["current_leg"] = None
+    if dry_run:
+        return None
 
+    truck = _find_truck(route["truck_id"])
     if truck:
+        depot = _truck_depot(truck)
+        if depot.get("stock_l") is not None:
+            # Lo que vuelve sin descargar regresa al stock del almacen
+            with _entity_lock("depots", depot["id"]):
+                depot["stock_l"] += max(_to_float(truck.get("current_load_l"), 0.0) or 0.0, 0.0)
         truck["status"] = "parked"
         truck["destination"] = None
         truck["current_load_l"] = 0
@@ -2330,15 +6627,190 @@ def api_arrive_warehouse():
         truck["eta_minutes"] = None
         truck["notes"] = "Listo en almacen"
         truck["route_id"] = None
-        truck["position"] = deepcopy(WAREHOUSE)
+        truck["position"] = deepcopy(depot)
+    _bump_route_version(route)
+    # Deja de encontrarse por id ya; el paso a route_history lo hace _archive_route al soltar los locks
+    _unindex_route(route)
+    return truck
+
+
+@app.route("/api/routes/arrive", methods=["POST"])
+def api_arrive_stop():
+    payload = request.get_json(force=True)
+    route_id = payload.get("route_id")
+    route = _find_route(route_id)
+    if not route:
+        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+
+    with _route_access(route):
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        error = _arrive_error(route)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+        _apply_arrive(route, _now())
+        _persist_route(route)
+    _save_state()
+    return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
+
+
+@app.route("/api/routes/complete-stop", methods=["POST"])
+def api_complete_stop():
+    payload = request.get_json(force=True)
+    route_id = payload.get("route_id")
+    delivered_l = payload.get("delivered_l")
+    note = payload.get("note") or ""
+
+    route = _find_route(route_id)
+    if not route:
+        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+
+    with _route_access(route):
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        error = _complete_stop_error(route, delivered_l)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+        _apply_complete_stop(route, delivered_l, note, _now())
+        _persist_route(route)
+
+    _save_state()
+    return jsonify({"ok": True, "route": _serialize_routes([route])[0]})
+
+
+@app.route("/api/routes/arrive-warehouse", methods=["POST"])
+def api_arrive_warehouse():
+    payload = request.get_json(force=True)
+    route_id = payload.get("route_id")
+    success = payload.get("success", True)
 
-    # mover ruta al historial
-    active_routes.remove(route)
-    route_history.insert(0, route)
+    route = _find_route(route_id)
+    if not route:
+        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+    with _route_access(route):
+        if _find_route(route_id) is not route:
+            return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        error = _arrive_warehouse_error(route)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+        truck = _apply_arrive_warehouse(route, success, _now())
+        _persist_route(route)
+    _archive_route(route)
+    if truck:
+        _notify_planner({"type": "truck", "truck_id": truck["id"]})
     _save_state()
     return jsonify({"ok": True, "message": "Ruta cerrada", "route": _serialize_routes([route])[0]})
 
 
+ROUTE_BATCH_MAX = int(os.environ.get("ROUTE_BATCH_MAX", "50"))
+
+
+def _batch_event_time(value, floor: Optional[datetime], now: datetime) -> datetime:
+    # Hora en que el operario hizo la accion sin cobertura; acotada entre la accion anterior y ahora
+    epoch = _reading_epoch(value) if value else None
+    at = now if epoch is None else datetime(1970, 1, 1) + timedelta(seconds=epoch)
+    if floor is not None and at < floor:
+        at = floor
+    return min(at, now)
+
+
+def _route_batch_error(route: Dict, events: List[Dict]) -> Optional[Tuple[int, str]]:
+    # Una pasada sobre una copia de la ruta: el lote entero es valido o no se aplica nada
+    draft = deepcopy(route)
+    floor = draft["history"][-1]["ts"] if draft.get("history") else None
+    now = _now()
+    for i, event in enumerate(events):
+        kind = event.get("type") if isinstance(event, dict) else None
+        at = _batch_event_time(event.get("ts"), floor, now) if kind else now
+        if kind == "arrive":
+            error = _arrive_error(draft)
+            if not error:
+                _apply_arrive(draft, at, dry_run=True)
+        elif kind == "complete-stop":
+            error = _complete_stop_error(draft, event.get("delivered_l"))
+            if not error:
+                _apply_complete_stop(draft, event["delivered_l"], "", at, dry_run=True)
+        elif kind == "arrive-warehouse":
+            error = _arrive_warehouse_error(draft)
+            if not error:
+                _apply_arrive_warehouse(draft, True, at, dry_run=True)
+        else:
+            error = "Tipo de evento no valido"
+        if error:
+            return i, error
+        floor = at
+    return None
+
+
+@app.route("/api/routes/batch", methods=["POST"])
+def api_route_batch():
+    # Cola offline del operario: llegadas, descargas y vuelta al almacen de una ruta, en orden
+    payload = request.get_json(force=True)
+    route_id = payload.get("route_id")
+    events = payload.get("events")
+    if not isinstance(events, list) or not events:
+        return jsonify({"ok": False, "error": "Debes enviar una lista de eventos"}), 400
+    if len(events) > ROUTE_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"Maximo {ROUTE_BATCH_MAX} eventos por lote"}), 400
+
+    route = _find_route(route_id)
+    if not route:
+        return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+    with _route_access(route):
+        if _find_route(route_id) is not route:
+            return jsonify({"ok": False, "error": "Ruta no encontrada"}), 400
+        conflict = _route_version_conflict(route, payload)
+        if conflict:
+            return conflict
+        invalid = _route_batch_error(route, events)
+        if invalid:
+            index, error = invalid
+            return jsonify({"ok": False, "error": error, "index": index, "applied": 0}), 400
+        claim = _claim_route_version(route)
+        if claim:
+            return claim
+
+        floor = route["history"][-1]["ts"] if route.get("history") else None
+        now = _now()
+        planner_events = []
+        for event in events:
+            at = _batch_event_time(event.get("ts"), floor, now)
+            if event["type"] == "arrive":
+                _apply_arrive(route, at)
+            elif event["type"] == "complete-stop":
+                _apply_complete_stop(route, event["delivered_l"], event.get("note") or "", at)
+            else:
+                truck = _apply_arrive_warehouse(route, event.get("success", True), at)
+                if truck:
+                    planner_events.append({"type": "truck", "truck_id": truck["id"]})
+            floor = at
+        _persist_route(route)
+
+    if route.get("status") == "finalizada":
+        _archive_route(route)
+    if planner_events:
+        _notify_planner(*planner_events)
+    _save_state()
+    return jsonify({"ok": True, "applied": len(events), "route": _serialize_routes([route])[0]})
+
+
+_start_planner_pool()
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5009)
 
@@ -0,0 +1,82 @@
+"""Benchmark de la matriz de distancias del planificador.
+
+Compara el orden por vecino mas cercano llamando a _haversine_km par a par
+(como hacia el planificador antes) contra la matriz precalculada.
+
+    python benchmarks/distance_matrix.py --sizes 50 500 5000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import app  # noqa: E402
+
+
+def _synthetic_sites(n: int, seed: int):
+    rng = random.Random(seed)
+    sites = [(app.WAREHOUSE_SITE, app.WAREHOUSE["lat"], app.WAREHOUSE["lon"])]
+    for i in range(n - 1):
+        sites.append((app._center_site(f"S{i}"), 36.75 + rng.random() * 0.2, -2.70 + rng.random() * 0.6))
+    return sites
+
+
+def _legacy_order(sites):
+    # Copia del algoritmo original: min(...) con trigonometria en Python por cada par
+    points = [{"center_id": key, "location": {"lat": lat, "lon": lon}} for key, lat, lon in sites[1:]]
+    remaining = list(points)
+    current = app.WAREHOUSE
+    ordered = []
+    while remaining:
+        nearest = min(remaining, key=lambda c: app._haversine_km(current, c["location"]))
+        ordered.append(nearest)
+        remaining.remove(nearest)
+        current = nearest["location"]
+    return ordered
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run(sizes, seed: int, legacy_limit: int):
+    print(f"numpy: {'si' if app.np is not None else 'no'}")
+    print(f"{'sitios':>7} {'build ms':>10} {'orden matriz ms':>16} {'orden legacy ms':>16} {'consulta us':>12}")
+    for n in sizes:
+        sites = _synthetic_sites(n, seed)
+        matrix, build_ms = _timed(app._build_distance_matrix, sites)
+        keys = [key for key, _lat, _lon in sites[1:]]
+        _order, order_ms = _timed(app._nearest_neighbour_order, matrix, app.WAREHOUSE_SITE, keys)
+
+        legacy = "-"
+        if n <= legacy_limit:
+            _ordered, legacy_ms = _timed(_legacy_order, sites)
+            legacy = f"{legacy_ms:.1f}"
+
+        rng = random.Random(seed)
+        pairs = [(rng.choice(keys), rng.choice(keys)) for _ in range(10000)]
+        start = time.perf_counter()
+        for a, b in pairs:
+            app._matrix_km(matrix, a, b)
+        lookup_us = (time.perf_counter() - start) * 1e6 / len(pairs)
+
+        print(f"{n:>7} {build_ms:>10.1f} {order_ms:>16.1f} {legacy:>16} {lookup_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=500,
+        help="no ejecutar el algoritmo par a par por encima de este numero de sitios",
+    )
+    args = parser.parse_args()
+    run(args.sizes, args.seed, args.legacy_limit)
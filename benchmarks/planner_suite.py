@@ -0,0 +1,216 @@
+"""Suite de benchmarks del planificador con flotas sinteticas.
+
+Genera almacen, centros, depositos y camiones a varias escalas, ejecuta el
+planificador (_auto_plan_urgent_routes / _build_auto_route_for_truck) y los
+serializadores, y guarda tiempos, memoria pico, km y llenado en JSON para
+comparar versiones.
+
+    python benchmarks/planner_suite.py --scales s m l --out benchmarks/results/actual.json
+    python benchmarks/planner_suite.py --compare benchmarks/results/anterior.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import app  # noqa: E402
+
+SCALES = {
+    "s": {"centers": 15, "tanks_per_center": 3, "trucks": 3},
+    "m": {"centers": 100, "tanks_per_center": 3, "trucks": 10},
+    "l": {"centers": 400, "tanks_per_center": 3, "trucks": 25},
+    "xl": {"centers": 1500, "tanks_per_center": 3, "trucks": 60},
+}
+PRODUCTS = ["NPK 15-5-30", "Calcio + nitrato", "Potasio liquido", "Urea foliar", "Micros mixtos"]
+
+
+def synthetic_fleet(n_centers: int, tanks_per_center: int, n_trucks: int, seed: int):
+    rng = random.Random(seed)
+    centers = []
+    for c in range(n_centers):
+        lat = app.WAREHOUSE["lat"] + rng.uniform(-0.12, 0.12)
+        lon = app.WAREHOUSE["lon"] + rng.uniform(-0.35, 0.45)
+        tanks = []
+        for t in range(1, tanks_per_center + 1):
+            capacity = rng.choice([4000, 8000, 14000, 16000, 20000])
+            offset = (t - 2) * 0.0012
+            tanks.append(
+                {
+                    "id": f"S{c}-{t}",
+                    "label": f"Deposito {t}",
+                    "product": rng.choice(PRODUCTS),
+                    "capacity_l": capacity,
+                    "current_l": round(capacity * rng.uniform(0.03, 0.9)),
+                    "warn_at": 0.32,
+                    "crit_at": 0.18,
+                    "location": {"lat": lat + offset, "lon": lon + offset, "name": f"S{c}"},
+                    "sensors": app._default_tank_sensors(),
+                }
+            )
+        centers.append({"id": f"s{c}", "name": f"Sintetico {c}", "location": {"lat": lat, "lon": lon}, "tanks": tanks})
+    trucks = []
+    for i in range(n_trucks):
+        trucks.append(
+            {
+                "id": f"TS-{i:03d}",
+                "driver": f"Conductor {i}",
+                "status": "parked",
+                "current_load_l": 0,
+                "capacity_l": rng.choice([10000, 12000, 14000, 18000]),
+                "position": dict(app.WAREHOUSE),
+                "destination": None,
+                "started_at": None,
+                "eta_minutes": None,
+                "route_id": None,
+                "notes": "",
+            }
+        )
+    return centers, trucks
+
+
+def install(centers, trucks):
+    for center in centers:
+        center["tanks"] = [app.Tank.from_dict(t) for t in center["tanks"]]
+    app.centers[:] = centers
+    app.trucks[:] = [app.Truck.from_dict(t) for t in trucks]
+    app.active_routes.clear()
+    app.planner_state["urgent_tanks"] = None
+    app._reindex_registry()
+    app._rebuild_spatial_index()
+
+
+def measure(fn, trace_memory: bool):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    wall_ms = (time.perf_counter() - start) * 1000
+    peak_kb = None
+    if trace_memory:
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_kb = round(peak / 1024, 1)
+    return result, round(wall_ms, 2), peak_kb
+
+
+def run_case(scale: str, engine: str, seed: int, budget: float, horizon: float):
+    spec = SCALES[scale]
+    case = {"scale": scale, "engine": engine, **spec}
+
+    for trace in (False, True):
+        # Primera pasada para tiempos; la segunda, con tracemalloc, solo para memoria pico
+        random.seed(seed)
+        install(*synthetic_fleet(spec["centers"], spec["tanks_per_center"], spec["trucks"], seed))
+        app._distance_matrix()
+        (routes, report), plan_ms, plan_kb = measure(
+            lambda: app._auto_plan_urgent_routes(engine, budget, horizon), trace
+        )
+        _serialized, ser_ms, ser_kb = measure(lambda: app._serialize_routes(app.active_routes), trace)
+        key = "peak_kb" if trace else "wall_ms"
+        case.setdefault("plan", {})[key] = plan_kb if trace else plan_ms
+        case.setdefault("serialize_routes", {})[key] = ser_kb if trace else ser_ms
+
+    urgent = app._collect_urgent_centers(set())
+    truck = max(app.trucks, key=lambda t: t["capacity_l"])
+    _route, build_ms, _kb = measure(lambda: app._build_auto_route_for_truck(truck, urgent), False)
+
+    metrics = report.get("metrics", {})
+    schedule = report.get("schedule", {})
+    case.update(
+        {
+            "build_route_ms": build_ms,
+            "routes": len(routes),
+            "stops": metrics.get("stops", 0),
+            "km": metrics.get("total_km", 0.0),
+            "fill_rate": metrics.get("fill_rate", 0.0),
+            "planned_l": metrics.get("planned_l", 0.0),
+            "trips_horizon": schedule.get("trips"),
+            "late_tanks": schedule.get("late_tanks"),
+        }
+    )
+    return case
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        return out.stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous_path: Path):
+    previous = json.loads(previous_path.read_text())
+    old = {(c["scale"], c["engine"]): c for c in previous.get("cases", [])}
+    print(f"\nComparacion con {previous_path} ({previous.get('revision')})")
+    for case in current["cases"]:
+        prev = old.get((case["scale"], case["engine"]))
+        if not prev:
+            continue
+        parts = []
+        for label, getter in (
+            ("plan ms", lambda c: c["plan"]["wall_ms"]),
+            ("pico KB", lambda c: c["plan"]["peak_kb"]),
+            ("km", lambda c: c["km"]),
+            ("llenado", lambda c: c["fill_rate"]),
+        ):
+            before, after = getter(prev), getter(case)
+            delta = ((after - before) / before * 100) if before else 0.0
+            parts.append(f"{label} {before} -> {after} ({delta:+.1f}%)")
+        print(f"  {case['scale']:>3} {case['engine']:<6} " + " | ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", nargs="+", default=["s", "m", "l"], choices=sorted(SCALES))
+    parser.add_argument("--engines", nargs="+", default=["greedy", "vrp"], choices=["greedy", "vrp"])
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--time-budget", type=float, default=app.PLANNER_TIME_BUDGET_S)
+    parser.add_argument("--horizon", type=float, default=app.PLANNER_HORIZON_H)
+    parser.add_argument("--out", type=Path, help="fichero JSON de resultados")
+    parser.add_argument("--compare", type=Path, help="JSON de una ejecucion anterior")
+    args = parser.parse_args()
+
+    results = {
+        "revision": _git_revision(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "numpy": getattr(app.np, "__version__", None),
+        "seed": args.seed,
+        "time_budget_s": args.time_budget,
+        "horizon_h": args.horizon,
+        "cases": [],
+    }
+    header = f"{'escala':>6} {'motor':<6} {'plan ms':>9} {'pico KB':>9} {'serial ms':>9} {'km':>8} {'llenado':>8} {'tarde':>6}"
+    print(header)
+    for scale in args.scales:
+        for engine in args.engines:
+            case = run_case(scale, engine, args.seed, args.time_budget, args.horizon)
+            results["cases"].append(case)
+            print(
+                f"{scale:>6} {engine:<6} {case['plan']['wall_ms']:>9.1f} {case['plan']['peak_kb']:>9.1f} "
+                f"{case['serialize_routes']['wall_ms']:>9.2f} {case['km']:>8.1f} {case['fill_rate']:>8.3f} "
+                f"{case['late_tanks'] if case['late_tanks'] is not None else '-':>6}"
+            )
+
+    if args.out:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(json.dumps(results, indent=2))
+        print(f"\nResultados guardados en {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
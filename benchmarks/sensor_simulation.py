@@ -0,0 +1,47 @@
+"""Benchmark del simulador de sensores y consumo.
+
+Compara el bucle por deposito sobre los dicts (_simulate_sensors_loop) contra
+el simulador por columnas NumPy (_simulate_sensors / _simulate_drain) con
+flotas sinteticas de miles de depositos.
+
+    python benchmarks/sensor_simulation.py --tanks 300 3000 30000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import app  # noqa: E402
+import planner_suite  # noqa: E402
+
+
+def _timed(fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def run(sizes, seed: int, repeat: int):
+    print(f"numpy: {'si' if app.np is not None else 'no'}")
+    print(f"{'depositos':>9} {'bucle ms':>10} {'columnas ms':>12} {'volcado ms':>11} {'consumo ms':>11}")
+    for n in sizes:
+        planner_suite.install(*planner_suite.synthetic_fleet(max(n // 3, 1), 3, 1, seed))
+        app._seed_sensor_sim(seed)
+        loop_ms = _timed(app._simulate_sensors_loop, repeat)
+        app._simulate_sensors()
+        columns_ms = _timed(app._simulate_sensors, repeat)
+        flush_ms = _timed(lambda: (app._simulate_sensors(), app._flush_sensor_view()), repeat) - columns_ms
+        drain_ms = _timed(lambda: app._simulate_drain(0.5), repeat)
+        print(f"{n:>9} {loop_ms:>10.2f} {columns_ms:>12.2f} {flush_ms:>11.2f} {drain_ms:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tanks", type=int, nargs="+", default=[300, 3000, 30000])
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.tanks, args.seed, args.repeat)
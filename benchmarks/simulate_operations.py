@@ -0,0 +1,227 @@
+"""Simulacion de eventos discretos de la operacion (camiones, entregas y consumo).
+
+Avanza el reloj de simulacion de la app (_set_sim_clock) de evento en evento
+en lugar de esperar en tiempo real, y ejercita los mismos endpoints que usan
+admin y operarios: consumo, auto-plan, claim, llegada, descarga y vuelta al
+almacen. Una semana de operacion corre en segundos. Al final muestra el
+rendimiento por endpoint (peticiones, latencia p50/p95/max) y los KPIs de
+operacion.
+
+    python benchmarks/simulate_operations.py --days 7
+    python benchmarks/simulate_operations.py --days 2 --synthetic m --out benchmarks/results/sim.json
+"""
+import argparse
+import heapq
+import json
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import app  # noqa: E402
+
+
+class Recorder:
+    def __init__(self, client):
+        self.client = client
+        self.calls = {}
+
+    def post(self, path, payload):
+        start = time.perf_counter()
+        res = self.client.post(path, json=payload)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats = self.calls.setdefault(path, {"latencies": [], "errors": 0})
+        stats["latencies"].append(elapsed_ms)
+        if res.status_code >= 400:
+            stats["errors"] += 1
+        return res.status_code, res.get_json(silent=True) or {}
+
+    def summary(self, wall_s):
+        rows = {}
+        for path, stats in sorted(self.calls.items()):
+            lat = sorted(stats["latencies"])
+            rows[path] = {
+                "requests": len(lat),
+                "errors": stats["errors"],
+                "p50_ms": round(statistics.median(lat), 2),
+                "p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))], 2),
+                "max_ms": round(lat[-1], 2),
+                "req_per_s": round(len(lat) / wall_s, 1) if wall_s else None,
+            }
+        return rows
+
+
+class Simulation:
+    def __init__(self, recorder, start, args):
+        self.rec = recorder
+        self.start = start
+        self.args = args
+        self.queue = []
+        self.seq = 0
+        self.scheduled = set()
+        self.kpis = {
+            "routes_claimed": 0,
+            "routes_closed": 0,
+            "deliveries": 0,
+            "delivered_l": 0.0,
+            "empty_tank_ticks": 0,
+            "tanks_emptied": set(),
+        }
+
+    def push(self, at, kind, data=None):
+        self.seq += 1
+        heapq.heappush(self.queue, (at, self.seq, kind, data or {}))
+
+    def leg_minutes(self, route):
+        leg = route.get("current_leg") or {}
+        return leg.get("eta_minutes") or app.LEG_MIN_MINUTES
+
+    def claim_pending(self, now):
+        # Cualquier ruta planificada (auto-plan o replanificacion por eventos) se activa a los pocos minutos
+        for route in list(app.active_routes):
+            if route.get("status") == "planificada" and route["id"] not in self.scheduled:
+                self.scheduled.add(route["id"])
+                self.push(now + timedelta(minutes=self.args.claim_delay_min), "claim", {"route_id": route["id"]})
+
+    def on_tick(self, now, _data):
+        self.rec.post("/api/simulate-drain", {"hours": self.args.tick_min / 60})
+        for tank, center in app._iter_tanks():
+            if tank["current_l"] <= 0:
+                self.kpis["empty_tank_ticks"] += 1
+                self.kpis["tanks_emptied"].add((center["id"], tank["id"]))
+        self.claim_pending(now)
+        self.push(now + timedelta(minutes=self.args.tick_min), "tick")
+
+    def on_plan(self, now, _data):
+        self.rec.post("/api/admin/auto-plan", {"time_budget_s": self.args.time_budget})
+        self.claim_pending(now)
+        self.push(now + timedelta(hours=self.args.plan_every_h), "plan")
+
+    def on_claim(self, now, data):
+        route = next((r for r in app.active_routes if r["id"] == data["route_id"]), None)
+        if not route or route.get("status") != "planificada":
+            return
+        worker = route.get("worker") or next(iter(app.WORKERS))
+        status, body = self.rec.post("/api/routes/claim", {"worker": worker, "truck_id": route["truck_id"]})
+        if status == 200:
+            self.kpis["routes_claimed"] += 1
+            self.push(now + timedelta(minutes=self.leg_minutes(body["route"])), "arrive", data)
+
+    def on_arrive(self, now, data):
+        status, _body = self.rec.post("/api/routes/arrive", {"route_id": data["route_id"]})
+        if status == 200:
+            self.push(now + timedelta(minutes=self.args.service_min), "complete", data)
+
+    def on_complete(self, now, data):
+        route = next((r for r in app.active_routes if r["id"] == data["route_id"]), None)
+        if not route:
+            return
+        stop = route["stops"][route.get("current_stop_idx", 0)]
+        tank = app._find_tank(stop["center_id"], stop["tank_id"])
+        room = (tank["capacity_l"] - tank["current_l"]) if tank else stop["liters"]
+        delivered = int(max(min(stop["liters"], room), 0))
+        status, body = self.rec.post("/api/routes/complete-stop", {"route_id": data["route_id"], "delivered_l": delivered})
+        if status != 200:
+            return
+        self.kpis["deliveries"] += 1
+        self.kpis["delivered_l"] += delivered
+        kind = "warehouse" if body["route"]["status"] == "regresando" else "arrive"
+        self.push(now + timedelta(minutes=self.leg_minutes(body["route"])), kind, data)
+
+    def on_warehouse(self, now, data):
+        status, _body = self.rec.post("/api/routes/arrive-warehouse", {"route_id": data["route_id"]})
+        if status == 200:
+            self.kpis["routes_closed"] += 1
+        self.claim_pending(now)
+
+    def run(self, days):
+        end = self.start + timedelta(days=days)
+        self.push(self.start, "tick")
+        self.push(self.start, "plan")
+        events = 0
+        while self.queue:
+            at, _seq, kind, data = heapq.heappop(self.queue)
+            if at > end:
+                break
+            app._set_sim_clock(at)
+            getattr(self, f"on_{kind}")(at, data)
+            events += 1
+        return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--tick-min", type=float, default=30, help="minutos entre pasos de consumo")
+    parser.add_argument("--plan-every-h", type=float, default=4)
+    parser.add_argument("--service-min", type=float, default=app.PLANNER_STOP_SERVICE_MIN)
+    parser.add_argument("--claim-delay-min", type=float, default=10)
+    parser.add_argument("--time-budget", type=float, default=0.2)
+    parser.add_argument("--synthetic", choices=["s", "m", "l", "xl"], help="flota sintetica de planner_suite")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--out", type=Path, help="fichero JSON de resultados")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app._seed_sensor_sim(args.seed)
+    # El arnes no pasa por el login ni por la API de Savian: trabaja sobre el estado en memoria
+    app._is_request_authenticated = lambda: True
+    app._ensure_external_runtime_ready = lambda: None
+    app._save_state = lambda: None
+    if args.synthetic:
+        import planner_suite
+
+        spec = planner_suite.SCALES[args.synthetic]
+        fleet = planner_suite.synthetic_fleet(spec["centers"], spec["tanks_per_center"], spec["trucks"], args.seed)
+        planner_suite.install(*fleet)
+    app.active_routes.clear()
+
+    start = app._now().replace(minute=0, second=0, microsecond=0)
+    sim = Simulation(Recorder(app.app.test_client()), start, args)
+    wall_start = time.perf_counter()
+    try:
+        events = sim.run(args.days)
+    finally:
+        app._set_sim_clock(None)
+    wall_s = time.perf_counter() - wall_start
+
+    kpis = dict(sim.kpis)
+    kpis["tanks_emptied"] = len(kpis["tanks_emptied"])
+    kpis["delivered_l"] = round(kpis["delivered_l"], 1)
+    sim_hours = args.days * 24
+    result = {
+        "days": args.days,
+        "events": events,
+        "wall_s": round(wall_s, 2),
+        "speedup": round(sim_hours * 3600 / wall_s) if wall_s else None,
+        "events_per_s": round(events / wall_s, 1) if wall_s else None,
+        "tanks": sum(len(c["tanks"]) for c in app.centers),
+        "trucks": len(app.trucks),
+        "kpis": kpis,
+        "endpoints": sim.rec.summary(wall_s),
+    }
+
+    print(
+        f"{args.days:g} dias simulados en {result['wall_s']} s (x{result['speedup']}), "
+        f"{events} eventos, {result['events_per_s']} eventos/s"
+    )
+    print(f"{'endpoint':<32} {'peticiones':>10} {'errores':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'req/s':>8}")
+    for path, row in result["endpoints"].items():
+        print(
+            f"{path:<32} {row['requests']:>10} {row['errors']:>8} {row['p50_ms']:>8.2f} "
+            f"{row['p95_ms']:>8.2f} {row['max_ms']:>8.2f} {row['req_per_s']:>8}"
+        )
+    print("KPIs:", json.dumps(kpis))
+    if args.out:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(json.dumps(result, indent=2))
+        print(f"Resultados guardados en {args.out}")
+
+
+if __name__ == "__main__":
+    main()
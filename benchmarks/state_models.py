@@ -0,0 +1,159 @@
+"""Benchmark de los modelos con __slots__ (Tank, Truck, Route, Stop) frente a dicts.
+
+Construye rutas, depositos y camiones sinteticos en las dos representaciones y
+mide memoria por objeto (tracemalloc), el tiempo de _serialize_routes frente a
+la version anterior basada en dicts, y el ida y vuelta de persistencia
+(to_dict + json.dumps, json.loads + from_dict).
+
+"store encode" codifica todas las rutas desde cero (el primer guardado tras
+arrancar). "store encode historial" es lo que paga cada _save_state despues:
+el JSON de las rutas del historial se reutiliza y solo se codifican las nuevas.
+
+    python benchmarks/state_models.py --routes 2000 --stops 6
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from datetime import timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import app  # noqa: E402
+import planner_suite  # noqa: E402
+
+
+def _synthetic_routes(n_routes: int, n_stops: int, trucks, centers, seed: int):
+    rng = random.Random(seed)
+    tanks = [(c["id"], t) for c in centers for t in c["tanks"]]
+    now = app._now()
+    routes = []
+    for i in range(n_routes):
+        picked = rng.sample(tanks, min(n_stops, len(tanks)))
+        stops = [app._new_stop(cid, t["id"], rng.randint(500, 3000), t["product"]) for cid, t in picked]
+        route = app._make_auto_route(rng.choice(trucks), stops)
+        route["id"] = f"B-{i:05d}"
+        route["started_at"] = now
+        for n, stop in enumerate(stops):
+            stop["arrival_at"] = now + timedelta(minutes=30 * n)
+            stop["status"] = "completado"
+            route["history"].append(
+                app.RouteEvent(event="llegada", note=f"{stop['center_id']} / {stop['tank_id']}", ts=stop["arrival_at"])
+            )
+        route["current_leg"] = {"eta_minutes": 25, "label": "Siguiente", "started_at": now, "destination": dict(app.WAREHOUSE)}
+        routes.append(route)
+    return routes
+
+
+def _legacy_serialize_routes(routes):
+    # Copia del serializador anterior, que recorria los dicts campo a campo
+    serialized = []
+    for r in routes:
+        serialized.append(
+            {
+                **{k: r.get(k) for k in ["id", "worker", "truck_id", "depot_id", "origin", "status", "success"]},
+                "started_at": r.get("started_at").isoformat() if r.get("started_at") else None,
+                "finished_at": r.get("finished_at").isoformat() if r.get("finished_at") else None,
+                "total_delivered": r.get("total_delivered", 0),
+                "product_type": r.get("product_type"),
+                "current_stop_idx": r.get("current_stop_idx", 0),
+                "pending_worker": r.get("pending_worker", False),
+                "auto_generated": r.get("auto_generated", False),
+                "planned_load_l": r.get("planned_load_l"),
+                "stops": [
+                    {
+                        **{k: stop.get(k) for k in ["center_id", "tank_id", "liters", "product", "status"]},
+                        "arrival_at": stop.get("arrival_at").isoformat() if stop.get("arrival_at") else None,
+                        "depart_at": stop.get("depart_at").isoformat() if stop.get("depart_at") else None,
+                        "delivered_l": stop.get("delivered_l"),
+                    }
+                    for stop in r.get("stops", [])
+                ],
+                "history": [
+                    {"event": h.get("event"), "note": h.get("note"), "ts": h["ts"].isoformat()}
+                    for h in r.get("history", [])
+                ],
+                "current_leg": {
+                    **{k: r["current_leg"].get(k) for k in ["eta_minutes", "label"]},
+                    "started_at": r["current_leg"]["started_at"].isoformat(),
+                    "destination": r["current_leg"]["destination"],
+                }
+                if r.get("current_leg")
+                else None,
+            }
+        )
+    return serialized
+
+
+def _memory_kb(build):
+    tracemalloc.start()
+    objects = build()
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return objects, current / 1024
+
+
+def _timed(fn, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(args):
+    centers, trucks = planner_suite.synthetic_fleet(args.centers, 3, args.trucks, args.seed)
+    models = _synthetic_routes(args.routes, args.stops, [app.Truck(t) for t in trucks], centers, args.seed)
+    plain = [r.to_dict() for r in models]
+    tanks = [t for c in centers for t in c["tanks"]]
+    payload = json.dumps(plain, default=app._json_default)
+
+    print(f"{'objeto':<8} {'n':>7} {'dict B/obj':>11} {'slots B/obj':>12} {'ahorro':>8}")
+    for label, items, cls in (("route", plain, app.Route), ("tank", tanks, app.Tank), ("truck", trucks, app.Truck)):
+        _objs, dict_kb = _memory_kb(lambda: deepcopy(items))
+        _objs, slot_kb = _memory_kb(lambda: [cls.from_dict(deepcopy(x)) for x in items])
+        dict_b, slot_b = dict_kb * 1024 / len(items), slot_kb * 1024 / len(items)
+        print(f"{label:<8} {len(items):>7} {dict_b:>11.0f} {slot_b:>12.0f} {1 - slot_b / dict_b:>8.1%}")
+
+    print(f"\n{'operacion':<28} {'dict ms':>9} {'slots ms':>9}")
+    rows = (
+        ("serialize_routes", lambda: _legacy_serialize_routes(plain), lambda: app._serialize_routes(models)),
+        ("deepcopy", lambda: deepcopy(plain), lambda: deepcopy(models)),
+        (
+            "store encode",
+            lambda: json.dumps(plain, default=app._json_default),
+            lambda: json.dumps([app._plain(r) for r in models], default=app._json_default),
+        ),
+        (
+            "store encode historial",
+            lambda: json.dumps(plain, default=app._json_default),
+            lambda: app._encoded_route_history(),
+        ),
+        (
+            "store decode",
+            lambda: app._convert_dates(json.loads(payload)),
+            lambda: [app.Route.from_dict(r) for r in app._convert_dates(json.loads(payload))],
+        ),
+    )
+    app.route_history[:] = models
+    app._encoded_route_history()
+    for label, legacy, current in rows:
+        print(f"{label:<28} {_timed(legacy, args.repeat):>9.1f} {_timed(current, args.repeat):>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, default=2000)
+    parser.add_argument("--stops", type=int, default=6)
+    parser.add_argument("--centers", type=int, default=400)
+    parser.add_argument("--trucks", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=11)
+    run(parser.parse_args())
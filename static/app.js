@@ -219,13 +219,13 @@ async function forceLoginRedirect() {
   }
 }
 
-async function postJSON(url, body) {
+async function postJSON(url, body, headers = {}) {
 
   const res = await fetch(url, {
 
     method: "POST",
 
-    headers: { "Content-Type": "application/json" },
+    headers: { "Content-Type": "application/json", ...headers },
     credentials: "same-origin",
 
     body: JSON.stringify(body),
@@ -242,6 +242,177 @@ async function postJSON(url, body) {
 
 
 
+// Cola offline de pasos de ruta (llegada, descarga, almacen): una cola por ruta, en orden y con la hora
+// de cada paso. Se envia a /api/routes/batch, que aplica el lote entero o nada
+function getRouteQueues() {
+  try {
+    const raw = localStorage.getItem("pendingRouteEvents");
+    const parsed = raw ? JSON.parse(raw) : {};
+    // Formato anterior: una sola cola {route_id, events}
+    if (parsed?.route_id) return { [parsed.route_id]: parsed };
+    return parsed || {};
+  } catch (_e) {
+    return {};
+  }
+}
+
+function saveRouteQueues(queues) {
+  localStorage.setItem("pendingRouteEvents", JSON.stringify(queues));
+}
+
+function saveRejectedRouteBatch(batch) {
+  // Un lote rechazado no se borra: queda apartado para revisarlo con oficina
+  try {
+    const raw = localStorage.getItem("rejectedRouteEvents");
+    const rejected = raw ? JSON.parse(raw) : [];
+    rejected.push(batch);
+    localStorage.setItem("rejectedRouteEvents", JSON.stringify(rejected));
+  } catch (_e) {
+    /* ignore */
+  }
+}
+
+function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+function applyRouteStepLocally(route, event) {
+  // Mismo avance que hace el servidor, para que la vista offline no ofrezca otra vez un paso ya guardado
+  const idx = route.current_stop_idx || 0;
+  const stop = route.stops?.[idx];
+  if (event.type === "arrive" && stop) {
+    stop.arrival_at = event.ts;
+    stop.status = "en_descarga";
+    route.status = "en_destino";
+  } else if (event.type === "complete-stop" && stop) {
+    stop.depart_at = event.ts;
+    stop.status = "completado";
+    stop.delivered_l = event.delivered_l;
+    route.total_delivered = (route.total_delivered || 0) + event.delivered_l;
+    if (idx + 1 < route.stops.length) {
+      route.current_stop_idx = idx + 1;
+      route.status = "en_ruta";
+    } else {
+      route.status = "regresando";
+    }
+  } else if (event.type === "arrive-warehouse") {
+    route.status = "finalizada";
+    route.finished_at = event.ts;
+  }
+  route.current_leg = null;
+  return route;
+}
+
+function withQueuedSteps(state) {
+  // La foto del servidor (o la cacheada) mas los pasos que aun estan en cola
+  const queues = getRouteQueues();
+  for (const queue of Object.values(queues)) {
+    const route = state?.routes?.find((r) => r.id === queue.route_id);
+    if (route) queue.events.forEach((event) => applyRouteStepLocally(route, event));
+  }
+  return state;
+}
+
+function queueRouteEvent(route, event) {
+  const queues = getRouteQueues();
+  const queue = queues[route.id] || { route_id: route.id, version: route.version, events: [] };
+  const step = { ...event, ts: new Date().toISOString() };
+  queue.events.push(step);
+  // Cada cambio del lote es otra peticion; si se pierde la respuesta el reenvio usa la misma clave
+  queue.key = newIdempotencyKey();
+  queues[route.id] = queue;
+  saveRouteQueues(queues);
+  return { ok: true, queued: true, route: applyRouteStepLocally(route, step) };
+}
+
+async function postRouteEvent(url, route, event) {
+  // Con pasos pendientes de esta ruta el nuevo va detras para no adelantarse a ellos
+  if (!navigator.onLine || getRouteQueues()[route.id]) {
+    return queueRouteEvent(route, event);
+  }
+  const { type: _type, ...fields } = event;
+  const body = { route_id: route.id, version: route.version, ...fields };
+  // Misma clave en cada reintento: si el primer envio llego y se perdio la respuesta, el servidor la repite
+  const headers = { "Idempotency-Key": newIdempotencyKey() };
+  for (let attempt = 0; attempt < 3; attempt += 1) {
+    try {
+      return await postJSON(url, body, headers);
+    } catch (_e) {
+      if (!navigator.onLine) break;
+      await new Promise((resolve) => setTimeout(resolve, 500 * (attempt + 1)));
+    }
+  }
+  return queueRouteEvent(route, event);
+}
+
+async function postRouteBatch(queue) {
+  const { key, ...batch } = queue;
+  const res = await fetch("/api/routes/batch", {
+    method: "POST",
+    headers: { "Content-Type": "application/json", ...(key ? { "Idempotency-Key": key } : {}) },
+    credentials: "same-origin",
+    body: JSON.stringify(batch),
+  });
+  return { status: res.status, data: await parseJSONResponse(res) };
+}
+
+let routeQueueFlushing = false;
+
+async function flushRouteQueue() {
+  const queues = getRouteQueues();
+  if (!Object.keys(queues).length || !navigator.onLine || routeQueueFlushing) return;
+  routeQueueFlushing = true;
+  try {
+    for (const routeId of Object.keys(queues)) {
+      const queue = queues[routeId];
+      let res = await postRouteBatch(queue);
+      if (res.status === 409 && res.data.conflict && queue.version !== undefined) {
+        // La ruta cambio en el servidor: se reenvia sin version y el servidor valida los pasos sobre la ruta actual
+        delete queue.version;
+        queue.key = newIdempotencyKey();
+        saveRouteQueues(queues);
+        res = await postRouteBatch(queue);
+      }
+      if (res.status === 401) {
+        await forceLoginRedirect();
+        return;
+      }
+      if (res.data.ok) {
+        delete queues[routeId];
+        saveRouteQueues(queues);
+        flash(`Sincronizados ${res.data.applied} pasos de la ruta ${routeId}`);
+        continue;
+      }
+      // Solo un 4xx con respuesta de la app es definitivo; 5xx, pasarela o 409 en curso se reintentan luego
+      if (res.status >= 400 && res.status < 500 && ![408, 409, 429].includes(res.status) && res.data.error) {
+        saveRejectedRouteBatch({ ...queue, error: res.data.error, index: res.data.index, rejected_at: new Date().toISOString() });
+        delete queues[routeId];
+        saveRouteQueues(queues);
+        flash(`Ruta ${routeId}: no se pudieron sincronizar los pasos (${res.data.error}). Avisa a oficina.`);
+      }
+    }
+  } catch (_e) {
+    /* sin red: se reintenta en el siguiente evento online o intervalo */
+  } finally {
+    routeQueueFlushing = false;
+  }
+}
+
+window.addEventListener("online", () => flushRouteQueue());
+
+async function fetchStateOrCache() {
+  // Pantallas del operario: sin red siguen con la ultima foto; en ambos casos con los pasos en cola aplicados
+  try {
+    return withQueuedSteps(await fetchState());
+  } catch (e) {
+    const cached = getCachedState();
+    if (!(e instanceof TypeError) || !cached) throw e;
+    lastState = withQueuedSteps(cached);
+    return lastState;
+  }
+}
+
 async function fetchState() {
 
   const res = await fetch("/api/state", { credentials: "same-origin" });
@@ -1838,67 +2009,47 @@ function renderUrgentPreview(state) {
     .join("")}</div>`;
 }
 
-function collectStopDurations(routes = []) {
-  const rows = [];
-  routes.forEach((r) => {
-    const worker = r.worker || "sin_operario";
-    (r.stops || []).forEach((s) => {
-      if (!s.arrival_at || !s.depart_at) return;
-      const arrival = new Date(s.arrival_at);
-      const depart = new Date(s.depart_at);
-      const minutes = Math.max(0, Math.round((depart - arrival) / 60000));
-      rows.push({
-        center_id: s.center_id,
-        tank_id: s.tank_id,
-        worker,
-        minutes,
-        route_id: r.id,
-        arrival,
-      });
-    });
-  });
-  return rows;
+async function fetchReport(params) {
+  const query = new URLSearchParams(Object.entries(params).filter(([, v]) => v && v !== "all"));
+  try {
+    const res = await fetch(`/api/reports?${query}`, { credentials: "same-origin" });
+    const data = await parseJSONResponse(res);
+    return res.ok && data?.ok ? data : null;
+  } catch (err) {
+    return null;
+  }
 }
 
-function renderReportsChart(rows, centersMap, filters) {
+function renderReportsChart(report, centersMap) {
   const box = document.getElementById("report-chart");
   if (!box) return;
-  const { centerId, worker } = filters;
-  const filtered = rows.filter((row) => {
-    const centerOk = centerId === "all" || row.center_id === centerId;
-    const workerOk = worker === "all" || row.worker === worker;
-    return centerOk && workerOk;
-  });
+  const rows = report?.by_center_worker || [];
 
-  if (!filtered.length) {
+  if (!rows.length) {
     box.innerHTML = `<div class="muted small">Sin datos de tiempos con los filtros actuales.</div>`;
     return;
   }
 
-  const grouped = filtered.reduce((acc, row) => {
+  const grouped = rows.reduce((acc, row) => {
     acc[row.center_id] = acc[row.center_id] || [];
     acc[row.center_id].push(row);
     return acc;
   }, {});
 
-  const maxMinutes = Math.max(...filtered.map((r) => r.minutes), 1);
-
-  const totalMinutes = filtered.reduce((sum, r) => sum + r.minutes, 0);
+  const maxMinutes = Math.max(...rows.map((r) => r.dwell_min), 1);
+  const totals = report.totals || {};
 
   const cards = Object.entries(grouped)
     .map(([centerId, list]) => {
       const centerName = centersMap[centerId]?.name || centerId;
-      const byWorker = list.reduce((acc, row) => {
-        acc[row.worker] = (acc[row.worker] || 0) + row.minutes;
-        return acc;
-      }, {});
-      const rowsHtml = Object.entries(byWorker)
-        .sort((a, b) => b[1] - a[1])
-        .map(([w, minutes]) => {
-          const pct = Math.max(4, Math.round((minutes / maxMinutes) * 100));
+      const rowsHtml = [...list]
+        .sort((a, b) => b.dwell_min - a.dwell_min)
+        .map((row) => {
+          const minutes = Math.round(row.dwell_min);
+          const pct = Math.max(4, Math.round((row.dwell_min / maxMinutes) * 100));
           return `
             <div class="bar-row">
-              <span class="muted small">${w}</span>
+              <span class="muted small">${row.worker}</span>
               <div class="bar-track"><div class="bar-fill" style="width:${pct}%"></div></div>
               <span class="bar-meta">${minutes} min</span>
             </div>
@@ -1914,10 +2065,14 @@ function renderReportsChart(rows, centersMap, filters) {
     })
     .join("");
 
+  const successPct = totals.success_rate == null ? "-" : `${Math.round(totals.success_rate * 100)}%`;
   box.innerHTML = `
     <div class="row" style="gap:8px; flex-wrap:wrap; margin-bottom:8px;">
-      <span class="chip soft">Paradas: ${filtered.length}</span>
-      <span class="chip soft">Min totales: ${totalMinutes}</span>
+      <span class="chip soft">Paradas: ${totals.deliveries || 0}</span>
+      <span class="chip soft">Min totales: ${Math.round(totals.dwell_min || 0)}</span>
+      <span class="chip soft">Litros: ${Math.round(totals.delivered_l || 0)}</span>
+      <span class="chip soft">Tramo medio: ${totals.avg_leg_min ?? "-"} min</span>
+      <span class="chip soft">Exito: ${successPct}</span>
       <span class="chip soft">Centros: ${Object.keys(grouped).length}</span>
     </div>
     <div class="mini-grid">${cards}</div>
@@ -1944,8 +2099,11 @@ async function initReports() {
     return acc;
   }, {});
 
-  const allRoutes = [...(state.route_history || []), ...(state.routes || [])];
-  const rows = collectStopDurations(allRoutes);
+  const fromInput = document.getElementById("filter-from");
+  const toInput = document.getElementById("filter-to");
+  const today = new Date();
+  if (toInput && !toInput.value) toInput.value = today.toISOString().slice(0, 10);
+  if (fromInput && !fromInput.value) fromInput.value = new Date(today - 30 * 86400000).toISOString().slice(0, 10);
 
   if (centerSelect) {
     centerSelect.innerHTML =
@@ -1953,24 +2111,31 @@ async function initReports() {
       centers.map((c) => `<option value="${c.id}">${c.name}</option>`).join("");
   }
 
+  const initial = await fetchReport({ from: fromInput?.value, to: toInput?.value });
   if (workerSelect) {
-    const workers = Array.from(new Set(rows.map((r) => r.worker))).sort();
+    const workers = (initial?.by_worker || []).map((r) => r.key).sort();
     workerSelect.innerHTML =
       `<option value="all">Todos los operarios</option>` +
       workers.map((w) => `<option value="${w}">${w}</option>`).join("");
   }
 
-  const render = () => {
-    renderReportsChart(rows, centersMap, {
-      centerId: centerSelect?.value || "all",
+  // Los agregados se calculan en el servidor: cada cambio de filtro es una consulta a /api/reports
+  const render = async () => {
+    const report = await fetchReport({
+      from: fromInput?.value,
+      to: toInput?.value,
+      center_id: centerSelect?.value || "all",
       worker: workerSelect?.value || "all",
     });
+    renderReportsChart(report, centersMap);
   };
 
   centerSelect?.addEventListener("change", render);
   workerSelect?.addEventListener("change", render);
+  fromInput?.addEventListener("change", render);
+  toInput?.addEventListener("change", render);
 
-  render();
+  renderReportsChart(initial, centersMap);
 }
 
 async function initAlertsPage() {
@@ -1998,15 +2163,49 @@ async function initMapPage() {
     return;
   }
   ensureGlobalQRButton();
-  const load = async () => {
-    const state = await fetchState();
-    renderMap(state, "map-full");
-    renderTruckStatusColumns(state.trucks || [], state.routes || []);
+  let mapState = null;
+  // Todo sale de /api/map/tanks: flota y almacen en cada refresco, y solo los depositos de la ventana visible
+  const load = async (withFleet = true) => {
+    const data = await fetchMapViewport(mapInstances["map-full"], withFleet);
+    if (!data) return;
+    if (withFleet) {
+      mapState = { ...mapState, warehouse: data.warehouse, trucks: data.trucks || [], routes: data.routes || [] };
+      renderTruckStatusColumns(mapState.trucks, mapState.routes);
+    }
+    if (!mapState) return;
+    mapState.centers = data.centers || [];
+    const firstRender = !mapInstances["map-full"];
+    renderMap(mapState, "map-full");
+    if (firstRender) {
+      // El primer encuadre se hace sobre el almacen; a partir de ahi cada movimiento pide su ventana
+      mapInstances["map-full"].on("moveend", () => load(false));
+      await load(false);
+    }
   };
   load();
   setInterval(load, 15000);
 }
 
+async function fetchMapViewport(mapObj, withFleet = false) {
+  const params = new URLSearchParams();
+  if (mapObj) {
+    const b = mapObj.getBounds();
+    params.set("bbox", [b.getSouth(), b.getWest(), b.getNorth(), b.getEast()].map((v) => v.toFixed(5)).join(","));
+  }
+  if (withFleet) params.set("fleet", "1");
+  try {
+    const res = await fetch(`/api/map/tanks?${params}`, { credentials: "same-origin" });
+    if (res.status === 401) {
+      await forceLoginRedirect();
+      return null;
+    }
+    const data = await parseJSONResponse(res);
+    return res.ok && data?.ok ? data : null;
+  } catch (err) {
+    return null;
+  }
+}
+
 async function initHub() {
   await ensureBrowserSessionFromServer();
   refreshSessionBadges();
@@ -3034,7 +3233,12 @@ async function initSalida() {
       return;
     }
 
-    const res = await postJSON("/api/routes/claim", { worker: workerSession.user, truck_id: truckId });
+    const target = planned.find((r) => r.truck_id === truckId);
+    const res = await postJSON("/api/routes/claim", {
+      worker: workerSession.user,
+      truck_id: truckId,
+      version: target?.version,
+    });
     if (!res.ok) {
       const plannedForMe = planned.find((r) => r.worker === workerSession.user);
       if (plannedForMe) {
@@ -3333,7 +3537,7 @@ async function initDestino() {
       return;
     }
 
-    const state = await fetchState();
+    const state = await fetchStateOrCache();
 
     const routeId = getSession("activeRouteId");
 
@@ -3386,14 +3590,38 @@ async function initDestino() {
 
       }
 
-      const body = { route_id: route.id, delivered_l: Number(form.delivered.value), note: form.note.value };
+      const res = await postRouteEvent("/api/routes/complete-stop", route, {
+        type: "complete-stop",
+        delivered_l: Number(form.delivered.value),
+        note: form.note.value,
+      });
+
+      if (res.queued) {
+
+        flash("Sin conexion: descarga guardada, se enviara al recuperar la red");
+
+        if (res.route.status === "regresando") {
+
+          saveSession("activeRouteId", res.route.id);
 
-      const res = await postJSON("/api/routes/complete-stop", body);
+          setTimeout(() => (window.location.href = "/llegada"), 400);
+
+        } else {
+
+          load();
+
+        }
+
+        return;
+
+      }
 
       if (!res.ok) {
 
         flash(res.error || "Error");
 
+        if (res.conflict) load();
+
         return;
 
       }
@@ -3441,9 +3669,19 @@ async function initDestino() {
         flash(`Ese QR es de otro tanque. Busca ${targetTank}.`);
         return;
       }
-      const res = await postJSON("/api/routes/arrive", { route_id: route.id });
+      if (currentStop.arrival_at) {
+        flash("Llegada ya marcada en este destino.");
+        return;
+      }
+      const res = await postRouteEvent("/api/routes/arrive", route, { type: "arrive" });
+      if (res.queued) {
+        flash("Sin conexion: llegada guardada, se enviara al recuperar la red");
+        saveSession("activeRouteId", route.id);
+        await load();
+        return;
+      }
       flash(res.ok ? "Llegada marcada por QR" : res.error || "Error");
-      if (res.ok) {
+      if (res.ok || res.conflict) {
         saveSession("activeRouteId", route.id);
         await load();
       }
@@ -3606,7 +3844,7 @@ async function initLlegada() {
       return;
     }
 
-    const state = await fetchState();
+    const state = await fetchStateOrCache();
 
     const routeId = getSession("activeRouteId");
 
@@ -3653,7 +3891,7 @@ async function initLlegada() {
 
     }
 
-    const state = await fetchState();
+    const state = await fetchStateOrCache();
 
     const routeId = getSession("activeRouteId");
 
@@ -3685,12 +3923,26 @@ async function initLlegada() {
 
     }
 
-    const res = await postJSON("/api/routes/arrive-warehouse", { route_id: route.id, success: true });
+    const res = await postRouteEvent("/api/routes/arrive-warehouse", route, { type: "arrive-warehouse", success: true });
+
+    if (res.queued) {
+
+      flash("Sin conexion: cierre guardado, se enviara al recuperar la red");
+
+      saveSession("activeRouteId", null);
+
+      setTimeout(() => (window.location.href = "/"), 600);
+
+      return;
+
+    }
 
     if (!res.ok) {
 
       flash(res.error || "Error");
 
+      if (res.conflict) load();
+
       return;
 
     }
@@ -4300,10 +4552,15 @@ async function initAdmin() {
       btn.onclick = async () => {
         const routeId = btn.getAttribute("data-delete-route");
         btn.disabled = true;
-        const res = await postJSON("/api/admin/delete-route", { route_id: routeId });
+        const version = planned.find((r) => r.id === routeId)?.version;
+        const res = await postJSON("/api/admin/delete-route", { route_id: routeId, version });
         btn.disabled = false;
         if (!res.ok) {
           flash(res.error || "No se pudo eliminar");
+          if (res.conflict) {
+            load();
+            close();
+          }
           return;
         }
         flash("Ruta eliminada");
@@ -4340,6 +4597,7 @@ async function initAdmin() {
           route_id: change.routeId,
           truck_id: change.truckId,
           worker: change.worker,
+          version: planned.find((r) => r.id === change.routeId)?.version,
         });
         if (!res.ok) {
           flash(res.error || "No se pudo reasignar");
@@ -4486,7 +4744,15 @@ async function initAdmin() {
       if (!res.ok) {
         flash(res.error || "No se pudo generar rutas urgentes");
       } else {
-        flash(`Rutas generadas: ${res.created}`);
+        const metrics = res.report?.metrics;
+        const schedule = res.report?.schedule;
+        let detail = metrics
+          ? ` · ${metrics.total_km} km · llenado ${Math.round((metrics.fill_rate || 0) * 100)}%`
+          : "";
+        if (schedule) {
+          detail += ` · ${schedule.late_tanks} depositos en riesgo (${schedule.horizon_h} h)`;
+        }
+        flash(`Rutas generadas: ${res.created}${detail}`);
       }
       btn.textContent = original || "Generar ruta";
       btn.disabled = false;
@@ -4551,6 +4817,10 @@ document.addEventListener("DOMContentLoaded", () => {
 
   refreshSessionBadges();
 
+  flushRouteQueue();
+
+  setInterval(flushRouteQueue, 60000);
+
   const page = document.body.dataset.page;
 
   if (page === "login") initLoginPage();
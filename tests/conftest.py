@@ -0,0 +1,78 @@
+import os
+import sys
+from copy import deepcopy
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+# Sin Postgres ni pool de procesos: todo en memoria y en este proceso
+os.environ.pop("DATABASE_URL", None)
+os.environ.setdefault("PLANNER_WORKERS", "1")
+
+import app as A  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(A, "_is_request_authenticated", lambda: True)
+    monkeypatch.setattr(A, "_ensure_external_runtime_ready", lambda: None)
+    monkeypatch.setattr(A, "_save_state", lambda: None)
+    monkeypatch.setattr(A, "DB_URL", None)
+    A.idempotency_cache.clear()
+    yield A.app.test_client()
+    A.idempotency_cache.clear()
+
+
+@pytest.fixture
+def route():
+    # Ruta en curso con dos paradas sobre el primer camion y los dos primeros depositos del primer centro
+    truck = A.trucks[0]
+    center = A.centers[0]
+    saved = deepcopy(truck), [deepcopy(t) for t in center["tanks"]]
+    stops = [
+        {
+            "center_id": center["id"],
+            "tank_id": tank["id"],
+            "liters": 1000,
+            "product": tank.get("product"),
+            "status": "pendiente",
+            "arrival_at": None,
+            "depart_at": None,
+            "delivered_l": None,
+        }
+        for tank in center["tanks"][:2]
+    ]
+    item = A.Route.from_dict(
+        {
+            "id": "R-TEST",
+            "worker": None,
+            "truck_id": truck["id"],
+            "depot_id": A.WAREHOUSE["id"],
+            "origin": A.WAREHOUSE["name"],
+            "product_type": "Multiproducto",
+            "stops": stops,
+            "status": "en_ruta",
+            "current_stop_idx": 0,
+            "started_at": A._now(),
+            "finished_at": None,
+            "total_delivered": 0,
+            "history": [{"ts": A._now(), "event": "asignada", "note": "test"}],
+            "success": None,
+            "auto_generated": False,
+            "pending_worker": False,
+            "planned_load_l": 2000,
+            "version": 3,
+        }
+    )
+    truck["route_id"] = item["id"]
+    A._add_active_route(item)
+    yield item
+    A._unindex_route(item)
+    A.active_routes[:] = [r for r in A.active_routes if r is not item]
+    A.route_history[:] = [r for r in A.route_history if r is not item]
+    truck.clear()
+    truck.update(saved[0])
+    for tank, old in zip(center["tanks"], saved[1]):
+        tank.clear()
+        tank.update(old)
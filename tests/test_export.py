@@ -0,0 +1,28 @@
+import json
+from datetime import datetime
+
+import app as A
+
+
+def _export(client, query):
+    response = client.get(f"/api/export/deliveries?format=ndjson&{query}")
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+
+
+def test_export_deliveries_filters_by_date(client, monkeypatch):
+    log = A._DeliveryLog()
+    for day, hour, center in [(1, 23, "c1"), (2, 0, "c1"), (2, 18, "c2"), (2, 23, "c1"), (3, 0, "c1")]:
+        log.append({"ts": datetime(2026, 3, day, hour, 30), "center_id": center, "delivered_l": day * 100 + hour})
+    monkeypatch.setattr(A, "delivery_log", log)
+
+    # Un "to" sin hora incluye el dia completo
+    assert [r["delivered_l"] for r in _export(client, "from=2026-03-02&to=2026-03-02")] == [200, 218, 223]
+    assert [r["delivered_l"] for r in _export(client, "from=2026-03-02T12:00:00")] == [218, 223, 300]
+    assert [r["delivered_l"] for r in _export(client, "to=2026-03-02T00:30:00")] == [123, 200]
+    assert [r["delivered_l"] for r in _export(client, "from=2026-03-02&to=2026-03-02&center_id=c1")] == [200, 223]
+
+
+def test_export_rejects_bad_dates_and_formats(client):
+    assert client.get("/api/export/deliveries?from=ayer").status_code == 400
+    assert client.get("/api/export/deliveries?format=xml").status_code == 400
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import app as A
+
+
+def test_delivery_log_indexes_stay_in_time_order():
+    log = A._DeliveryLog()
+    base = datetime(2026, 3, 1, 8, 0)
+    # Llegan desordenadas (p.ej. un lote offline con horas anteriores)
+    for minutes, center, truck in [(30, "c1", "TR-01"), (10, "c2", "TR-01"), (50, "c1", "TR-02"), (20, "c1", "TR-01")]:
+        log.append({"ts": base + timedelta(minutes=minutes), "center_id": center, "truck_id": truck, "delivered_l": minutes})
+
+    def liters(rows):
+        return [log.row(row)["delivered_l"] for row in rows]
+
+    assert liters(log.iter_rows()) == [10, 20, 30, 50]
+    assert liters(log.iter_rows(center_id="c1")) == [20, 30, 50]
+    assert liters(log.iter_rows(center_id="c1", truck_id="TR-01")) == [20, 30]
+    assert liters(log.iter_rows(newest_first=True, truck_id="TR-01")) == [30, 20, 10]
+    assert liters(log.iter_rows(base + timedelta(minutes=15), base + timedelta(minutes=30))) == [20, 30]
+    assert [item["delivered_l"] for item in log.latest(2, center_id="c1")] == [50, 30]
+    assert list(log.iter_rows(center_id="desconocido")) == []
+
+
+def test_rollup_slot_is_reused_for_newer_bucket_only():
+    step, slots = A.ROLLUP_RESOLUTIONS["minute"]
+    series = A._new_rollup_scope()["minute"]
+    epoch = 1_000 * step + 5
+    base = A._rollup_slot(series, step, slots, epoch)
+    series["cols"][base] = 12.0
+    series["cols"][base + 5] = 300.0
+
+    # Mismo cubo: misma posicion y los acumulados siguen
+    assert A._rollup_slot(series, step, slots, epoch + 30) == base
+    assert series["cols"][base] == 12.0
+
+    # Un cubo una vuelta despues recicla la posicion y la deja a cero
+    later = epoch + slots * step
+    assert A._rollup_slot(series, step, slots, later) == base
+    assert series["bucket"][base // len(A.ROLLUP_FIELDS)] == int(later // step)
+    assert series["cols"][base] == 0.0
+    assert series["cols"][base + 3] == float("inf") and series["cols"][base + 4] == float("-inf")
+
+    # Una lectura del cubo antiguo ya no tiene sitio
+    assert A._rollup_slot(series, step, slots, epoch) is None
@@ -0,0 +1,87 @@
+import hashlib
+import json
+
+import app as A
+
+
+def _post(client, path, payload, key=None):
+    headers = {"Idempotency-Key": key} if key else {}
+    return client.post(path, data=json.dumps(payload), content_type="application/json", headers=headers)
+
+
+def test_idempotent_replay_returns_stored_response(client, route):
+    payload = {"route_id": route["id"]}
+    first = _post(client, "/api/routes/arrive", payload, key="k-arrive")
+    assert first.status_code == 200
+    version = route["version"]
+
+    # Sin la clave la llegada repetida falla; con ella se devuelve la respuesta guardada sin volver a aplicarla
+    replay = _post(client, "/api/routes/arrive", payload, key="k-arrive")
+    assert replay.status_code == 200
+    assert replay.headers.get("Idempotent-Replayed") == "true"
+    assert replay.get_json() == first.get_json()
+    assert route["version"] == version
+    assert _post(client, "/api/routes/arrive", payload).status_code == 400
+
+
+def test_idempotency_key_reused_with_other_body_is_422(client, route):
+    assert _post(client, "/api/routes/arrive", {"route_id": route["id"]}, key="k-reuse").status_code == 200
+    response = _post(client, "/api/routes/arrive", {"route_id": route["id"], "note": "otra"}, key="k-reuse")
+    assert response.status_code == 422
+    assert response.get_json()["ok"] is False
+
+
+def test_idempotency_key_in_progress_is_409(client, route):
+    payload = json.dumps({"route_id": route["id"]})
+    with A.app.test_request_context(
+        "/api/routes/arrive", method="POST", data=payload, headers={"Idempotency-Key": "k-busy"}
+    ):
+        scope = A._idempotency_scope()
+    # Otra peticion con la misma clave tiene la reserva y aun no ha respondido
+    A._idempotency_local_claim(scope, hashlib.sha256(payload.encode("utf-8")).hexdigest())
+    response = client.post(
+        "/api/routes/arrive", data=payload, content_type="application/json", headers={"Idempotency-Key": "k-busy"}
+    )
+    assert response.status_code == 409
+    assert route["stops"][0]["arrival_at"] is None
+
+
+def test_batch_is_all_or_nothing(client, route):
+    version = route["version"]
+    history = len(route["history"])
+    events = [
+        {"type": "arrive"},
+        {"type": "complete-stop", "delivered_l": 500},
+        {"type": "arrive"},
+        {"type": "complete-stop", "delivered_l": -1},
+    ]
+    response = _post(client, "/api/routes/batch", {"route_id": route["id"], "events": events})
+    assert response.status_code == 400
+    body = response.get_json()
+    assert body["applied"] == 0 and body["index"] == 3
+    # Los eventos validos anteriores tampoco se aplican
+    assert route["stops"][0]["arrival_at"] is None
+    assert route["total_delivered"] == 0
+    assert route["version"] == version and len(route["history"]) == history
+
+    events[-1]["delivered_l"] = 400
+    response = _post(client, "/api/routes/batch", {"route_id": route["id"], "events": events})
+    assert response.status_code == 200
+    assert response.get_json()["applied"] == 4
+    assert route["total_delivered"] == 900
+    assert all(stop["depart_at"] for stop in route["stops"])
+
+
+def test_stale_version_is_409_with_current_route(client, route):
+    stale = _post(client, "/api/routes/arrive", {"route_id": route["id"], "version": route["version"] - 1})
+    assert stale.status_code == 409
+    body = stale.get_json()
+    assert body["conflict"] is True
+    assert body["route"]["version"] == route["version"]
+    assert route["stops"][0]["arrival_at"] is None
+
+    current = route["version"]
+    response = _post(client, "/api/routes/arrive", {"route_id": route["id"], "version": current})
+    assert response.status_code == 200
+    assert route["version"] == current + 1
+    assert response.get_json()["route"]["version"] == current + 1
@@ -0,0 +1,124 @@
+"""Convierte un extracto OpenStreetMap (.osm XML) en el grafo de carreteras de la app.
+
+El resultado es el JSON que lee app._load_road_graph (ROAD_GRAPH_PATH):
+
+    {"nodes": [[id, lat, lon], ...], "edges": [[desde, hasta, km, kmh, sentido_unico], ...]}
+
+Solo se conservan las vias aptas para camion y los nodos que usan. Los nodos
+intermedios de cada via se mantienen para que el mapa siga la carretera.
+
+    python tools/osm_road_graph.py almeria.osm data/road_graph.json.gz --bbox 36.6 -2.9 37.0 -2.2
+"""
+import argparse
+import gzip
+import json
+import math
+import sys
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+# Velocidad por defecto (km/h) segun el tipo de via cuando no hay maxspeed
+HIGHWAY_SPEEDS = {
+    "motorway": 100,
+    "motorway_link": 60,
+    "trunk": 90,
+    "trunk_link": 50,
+    "primary": 70,
+    "primary_link": 40,
+    "secondary": 60,
+    "secondary_link": 40,
+    "tertiary": 50,
+    "tertiary_link": 30,
+    "unclassified": 40,
+    "residential": 30,
+    "service": 20,
+    "track": 15,
+}
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(h))
+
+
+def _speed(tags, highway):
+    raw = (tags.get("maxspeed") or "").split()[0] if tags.get("maxspeed") else ""
+    try:
+        return float(raw)
+    except ValueError:
+        return float(HIGHWAY_SPEEDS[highway])
+
+
+def _oneway(tags, highway):
+    value = tags.get("oneway")
+    if value in ("yes", "true", "1"):
+        return 1
+    if value == "-1":
+        return -1
+    return 1 if highway in ("motorway", "motorway_link") or tags.get("junction") == "roundabout" else 0
+
+
+def parse_osm(path: Path, bbox=None):
+    nodes = {}
+    ways = []
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rb") as fh:
+        tags = {}
+        refs = []
+        for _event, elem in ET.iterparse(fh, events=("end",)):
+            if elem.tag == "node":
+                lat, lon = float(elem.get("lat")), float(elem.get("lon"))
+                if bbox is None or (bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]):
+                    nodes[elem.get("id")] = (lat, lon)
+                elem.clear()
+            elif elem.tag == "nd":
+                refs.append(elem.get("ref"))
+            elif elem.tag == "tag":
+                tags[elem.get("k")] = elem.get("v")
+            elif elem.tag == "way":
+                highway = tags.get("highway")
+                if highway in HIGHWAY_SPEEDS and tags.get("access") not in ("no", "private"):
+                    ways.append((refs, _speed(tags, highway), _oneway(tags, highway)))
+                tags, refs = {}, []
+                elem.clear()
+            elif elem.tag == "relation":
+                tags, refs = {}, []
+                elem.clear()
+    return nodes, ways
+
+
+def build_graph(nodes, ways):
+    used = {}
+    edges = []
+    for refs, speed, oneway in ways:
+        if oneway == -1:
+            refs = list(reversed(refs))
+        for a, b in zip(refs, refs[1:]):
+            if a not in nodes or b not in nodes or a == b:
+                continue
+            km = _haversine_km(*nodes[a], *nodes[b])
+            for ref in (a, b):
+                used.setdefault(ref, len(used))
+            edges.append([used[a], used[b], round(km, 4), speed, 1 if oneway else 0])
+    out_nodes = [[idx, round(nodes[ref][0], 6), round(nodes[ref][1], 6)] for ref, idx in used.items()]
+    return {"nodes": out_nodes, "edges": edges}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("osm", type=Path, help="extracto .osm o .osm.gz")
+    parser.add_argument("out", type=Path, help="JSON de salida (.json o .json.gz)")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LAT_MIN", "LON_MIN", "LAT_MAX", "LON_MAX"))
+    args = parser.parse_args()
+
+    nodes, ways = parse_osm(args.osm, args.bbox)
+    graph = build_graph(nodes, ways)
+    raw = json.dumps(graph, separators=(",", ":")).encode("utf-8")
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    args.out.write_bytes(gzip.compress(raw) if args.out.suffix == ".gz" else raw)
+    print(f"{len(graph['nodes'])} nodos, {len(graph['edges'])} tramos -> {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()